@@ -40,7 +40,7 @@ def async_func(a=0, b=0.0, **kwargs):
     return ret
 
 
-@PypvFunction(async=False, prefix='test:sync:')
+@PypvFunction(async_=False, prefix='test:sync:')
 def sync_func(a=0, b=0.0, **kwargs):
     '''Synchronously executed PypvFunction.
     Do not block in these functions.
@@ -76,7 +76,7 @@ def array_func(value=0.0):
 
 
 @PypvFunction(type_=np.int32, count=10,
-              async=False)
+              async_=False)
 def no_arg_func():
     '''No arguments taken in the function, returns an int array of 10
     elements'''
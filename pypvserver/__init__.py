@@ -7,13 +7,54 @@
    :synopsis: Channel access server implementation, based on pcaspy
 '''
 
+import importlib
 import logging
+import sys
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
-from .server import PypvServer
-from .pv import (Limits, PyPV, PypvRecord)
-from .motor import PypvMotor
-from .errors import (UndefinedValueError, AsyncCompletion)
-from .function import PypvFunction
+# Top-level names are imported on first use, so that `import pypvserver`
+# (e.g., just for pypvserver.utils) does not load pcaspy, numpy or pyepics
+_lazy_imports = {'PypvServer': '.server',
+                 'Limits': '.pv',
+                 'PyPV': '.pv',
+                 'PypvRecord': '.pv',
+                 'PypvMotor': '.motor',
+                 'MoveStatus': '.motor',
+                 'PypvPseudoMotor': '.motor',
+                 'PseudoMotorGroup': '.motor',
+                 'SimMotorFarm': '.simmotor',
+                 'UndefinedValueError': '.errors',
+                 'AsyncCompletion': '.errors',
+                 'PypvFunction': '.function',
+                 'PypvCompress': '.compress',
+                 }
+
+
+def __getattr__(name):
+    try:
+        module_name = _lazy_imports[name]
+    except KeyError:
+        raise AttributeError('module {!r} has no attribute {!r}'
+                             ''.format(__name__, name))
+
+    value = getattr(importlib.import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()).union(_lazy_imports))
+
+
+if sys.version_info < (3, 7):
+    # Module-level __getattr__ (PEP 562) is unavailable; import eagerly
+    from .server import PypvServer
+    from .pv import (Limits, PyPV, PypvRecord)
+    from .motor import (PypvMotor, MoveStatus, PypvPseudoMotor,
+                        PseudoMotorGroup)
+    from .simmotor import SimMotorFarm
+    from .errors import (UndefinedValueError, AsyncCompletion)
+    from .function import PypvFunction
+    from .compress import PypvCompress
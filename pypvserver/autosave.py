@@ -0,0 +1,476 @@
+# vi: ts=4 sw=4
+'''
+:mod:`pypvserver.autosave` - Autosave and restore
+=================================================
+
+.. module:: pypvserver.autosave
+   :synopsis: Save PV values to a compact, memory-mapped snapshot file and
+              restore them when the server is restarted
+'''
+
+from __future__ import print_function
+
+import mmap
+import os
+import struct
+import threading
+import logging
+from collections import OrderedDict
+
+import numpy as np
+from pcaspy import cas
+
+from .pv import (PypvRecord, enum_types, string_types)
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'PYPVSAV1'
+VERSION = 1
+
+# Maximum length of a PV name, in bytes
+NAME_SIZE = 128
+
+# magic, version, number of entries
+HEADER = struct.Struct('<8sII')
+# name, dtype, element count, (padding), offset of slot A, offset of slot B,
+# active slot
+ENTRY = struct.Struct('<%ds8sI4xQQB7x' % NAME_SIZE)
+ACTIVE_OFFSET = ENTRY.size - 8
+
+# Maximum length of an EPICS string
+STRING_SIZE = 40
+
+
+def _align(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+class _Entry(object):
+    '''Location of a single PV's value in the snapshot file'''
+
+    __slots__ = ('name', 'dtype', 'count', 'offsets', 'active', 'index')
+
+    def __init__(self, name, dtype, count, offsets=(0, 0), active=0,
+                 index=0):
+        self.name = name
+        self.dtype = np.dtype(dtype)
+        self.count = count
+        self.offsets = offsets
+        self.active = active
+        self.index = index
+
+    @property
+    def nbytes(self):
+        return self.dtype.itemsize * self.count
+
+
+class Autosave(object):
+    '''Periodically save the values of selected PVs to a snapshot file
+
+    The snapshot file holds a table of scalar values followed by contiguous
+    blocks for waveforms. Each value has two slots: an update is written to
+    the inactive slot, flushed, and only then is the slot made active, so a
+    crash mid-save leaves the previous value intact. Only PVs whose values
+    changed since the last save (dirty PVs) are rewritten; when the set of
+    PVs changes, a new file is written and atomically renamed into place.
+    PV names are limited to `NAME_SIZE` bytes.
+
+    On startup, the existing snapshot is memory-mapped. When `server` is
+    given, PVs are restored as they are added to it -- before they can be
+    found by a client search. Otherwise, values are restored when the PV is
+    registered with :meth:`add`.
+
+    Parameters
+    ----------
+    filename : str
+        The snapshot file
+    period : float, optional
+        Seconds between saves (the saving thread is started by :meth:`start`)
+    server : PypvServer, optional
+        Restore PVs as they are added to this server
+    '''
+
+    def __init__(self, filename, period=10.0, server=None):
+        self._filename = str(filename)
+        self._period = float(period)
+        self._pvs = OrderedDict()
+        self._saved = {}
+        self._restored = set()
+        self._entries = None
+        self._layout_changed = True
+        # Names of PVs left out of the layout, having no value yet
+        self._skipped = []
+        self._mmap = None
+        self._lock = threading.RLock()
+        self._thread = None
+        self._running = False
+
+        self._snapshot = {}
+        self._snapshot_map = None
+        self._load()
+
+        if server is not None:
+            server.autosave = self
+
+    @property
+    def filename(self):
+        '''The snapshot filename'''
+        return self._filename
+
+    @property
+    def pvs(self):
+        '''PVs being saved, keyed on name'''
+        return dict(self._pvs)
+
+    def _load(self):
+        '''Memory-map an existing snapshot and index its entries'''
+        try:
+            f = open(self._filename, 'rb')
+        except (IOError, OSError):
+            return
+
+        with f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error):
+                logger.warning('Empty or unreadable autosave file %s',
+                               self._filename)
+                return
+
+        try:
+            entries = self._read_entries(mm)
+        except ValueError as ex:
+            logger.warning('Ignoring autosave file %s: %s', self._filename,
+                           ex)
+            mm.close()
+            return
+
+        self._snapshot_map = mm
+        self._snapshot = dict((entry.name, entry) for entry in entries)
+        logger.debug('Loaded %d autosave entries from %s', len(entries),
+                     self._filename)
+
+    @staticmethod
+    def _read_entries(mm):
+        if len(mm) < HEADER.size:
+            raise ValueError('File too short')
+
+        magic, version, count = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC:
+            raise ValueError('Not an autosave file')
+        elif version != VERSION:
+            raise ValueError('Unsupported version %d' % version)
+
+        entries = []
+        for index in range(count):
+            offset = HEADER.size + index * ENTRY.size
+            (name, dtype, num, offset_a, offset_b,
+             active) = ENTRY.unpack_from(mm, offset)
+
+            entry = _Entry(name.rstrip(b'\0').decode('utf-8'),
+                           dtype.rstrip(b'\0').decode('ascii'), num,
+                           offsets=(offset_a, offset_b), active=active & 1,
+                           index=index)
+
+            if max(entry.offsets) + entry.nbytes > len(mm):
+                raise ValueError('Truncated entry %s' % entry.name)
+
+            entries.append(entry)
+
+        return entries
+
+    def _pv_names(self, pv, fields=None):
+        '''(name, pv) pairs for a PV, or the selected fields of a record'''
+        if fields is None or not isinstance(pv, PypvRecord):
+            return [(pv.name, pv)]
+
+        return [(pv[field].name, pv[field]) for field in fields]
+
+    def add(self, pv, fields=None):
+        '''Save and restore a PV, or the given fields of a record
+
+        Parameters
+        ----------
+        pv : PyPV or PypvRecord
+            The PV to save
+        fields : sequence, optional
+            For records, the fields to save (defaults to the record value)
+
+        Raises
+        ------
+        ValueError
+            If a PV name is longer than `NAME_SIZE` bytes
+        '''
+        names = self._pv_names(pv, fields)
+        for name, field_pv in names:
+            if len(name.encode('utf-8')) > NAME_SIZE:
+                raise ValueError('PV name too long to autosave (over %d '
+                                 'bytes): %s' % (NAME_SIZE, name))
+
+        with self._lock:
+            for name, field_pv in names:
+                if name in self._pvs:
+                    continue
+
+                self._pvs[name] = field_pv
+                self._layout_changed = True
+                if name not in self._restored:
+                    self.restore(field_pv)
+
+    def remove(self, pv):
+        '''Stop saving a PV (or all saved fields of a record)'''
+        with self._lock:
+            names = [name for name, saved_pv in self._pvs.items()
+                     if saved_pv is pv or
+                     (isinstance(pv, PypvRecord) and
+                      saved_pv in pv.fields.values())]
+            for name in names:
+                del self._pvs[name]
+                self._saved.pop(name, None)
+                self._layout_changed = True
+
+    def _read_value(self, entry):
+        offset = entry.offsets[entry.active]
+        value = np.frombuffer(self._snapshot_map, dtype=entry.dtype,
+                              count=entry.count, offset=offset)
+        return value.copy()
+
+    def restore(self, pv):
+        '''Restore a PV (and any record fields) from the snapshot
+
+        Returns
+        -------
+        restored : list
+            Names of the PVs which were restored
+        '''
+        pvs = [pv]
+        if isinstance(pv, PypvRecord):
+            pvs.extend(field_pv for field_pv in pv.fields.values()
+                       if field_pv is not pv)
+
+        restored = []
+        for pv in pvs:
+            entry = self._snapshot.get(pv.name, None)
+            if entry is None:
+                continue
+
+            try:
+                self._restore_value(pv, entry)
+            except Exception as ex:
+                logger.warning('Failed to restore %s: %s', pv.name, ex,
+                               exc_info=ex)
+            else:
+                self._restored.add(pv.name)
+                restored.append(pv.name)
+
+        return restored
+
+    def _restore_value(self, pv, entry):
+        if (entry.dtype, entry.count) != self._pv_layout(pv):
+            raise ValueError('Type or size of PV changed since saved')
+
+        value = self._read_value(entry)
+        if pv.count > 0:
+            pv.value = value
+        elif entry.dtype.kind == 'S':
+            pv.value = value[0].decode('utf-8')
+        else:
+            pv.value = value[0].item()
+
+        logger.debug('Restored %s = %r', pv.name, pv.value)
+
+    @staticmethod
+    def _pv_layout(pv):
+        '''(dtype, count) used to save a PV's value'''
+        if pv.count > 0:
+            return pv.value.dtype.newbyteorder('<'), pv.count
+        elif pv._ca_type in enum_types:
+            return np.dtype('<i8'), 1
+        elif pv._ca_type in string_types:
+            return np.dtype('S%d' % STRING_SIZE), 1
+        elif pv._ca_type in (cas.aitEnumFloat64, cas.aitEnumFloat32):
+            return np.dtype('<f8'), 1
+        else:
+            return np.dtype('<i8'), 1
+
+    def _encode(self, pv, entry):
+        '''The PV value, as bytes for the snapshot file'''
+        value = pv.value
+        if pv.count > 0:
+            value = np.asarray(value, dtype=entry.dtype)
+        elif entry.dtype.kind == 'S':
+            value = str(value).encode('utf-8')[:STRING_SIZE]
+            value = np.array([value], dtype=entry.dtype)
+        elif pv._enums and not isinstance(value, (int, np.integer)):
+            value = np.array([pv._enums.index(value)], dtype=entry.dtype)
+        else:
+            value = np.array([value], dtype=entry.dtype)
+
+        return value.tobytes()
+
+    def _make_entries(self):
+        '''Lay out the registered PVs: scalars first, then waveforms
+
+        PVs without a value are left out, until they get one (see
+        `_skipped_set`).
+        '''
+        entries = [_Entry(name, *self._pv_layout(pv))
+                   for name, pv in self._pvs.items()
+                   if pv.value is not None]
+        self._skipped = [name for name, pv in self._pvs.items()
+                         if pv.value is None]
+        entries.sort(key=lambda entry: entry.count > 1)
+
+        offset = _align(HEADER.size + len(entries) * ENTRY.size)
+        for index, entry in enumerate(entries):
+            offset_a = offset
+            offset_b = _align(offset_a + entry.nbytes)
+            offset = _align(offset_b + entry.nbytes)
+            entry.offsets = (offset_a, offset_b)
+            entry.index = index
+
+        return entries, offset
+
+    def save(self):
+        '''Save all dirty PVs
+
+        Returns
+        -------
+        count : int
+            Number of values written
+        '''
+        with self._lock:
+            if (self._layout_changed or self._mmap is None or
+                    self._skipped_set()):
+                return self._save_all(*self._make_entries())
+
+            return self._save_dirty()
+
+    def _skipped_set(self):
+        '''Has a PV left out of the layout been given a value since?'''
+        return any(self._pvs[name].value is not None
+                   for name in self._skipped if name in self._pvs)
+
+    def _save_all(self, entries, size):
+        '''Write a complete snapshot to a new file, then rename it into
+        place'''
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+        tmp_filename = '%s.tmp' % self._filename
+        buf = bytearray(size)
+        HEADER.pack_into(buf, 0, MAGIC, VERSION, len(entries))
+
+        saved = {}
+        for entry in entries:
+            pv = self._pvs[entry.name]
+            data = self._encode(pv, entry)
+            saved[entry.name] = data
+            offset = entry.offsets[0]
+            buf[offset:offset + len(data)] = data
+
+            ENTRY.pack_into(buf, HEADER.size + entry.index * ENTRY.size,
+                            entry.name.encode('utf-8'),
+                            entry.dtype.str.encode('ascii'), entry.count,
+                            entry.offsets[0], entry.offsets[1], 0)
+
+        with open(tmp_filename, 'wb') as f:
+            f.write(buf)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if hasattr(os, 'replace'):
+            os.replace(tmp_filename, self._filename)
+        else:
+            os.rename(tmp_filename, self._filename)
+
+        with open(self._filename, 'r+b') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0)
+
+        self._entries = entries
+        self._layout_changed = False
+        self._saved = saved
+        logger.debug('Wrote autosave file %s (%d PVs)', self._filename,
+                     len(entries))
+        return len(entries)
+
+    def _save_dirty(self):
+        '''Update dirty PVs in place, via the inactive slot of each
+
+        A PV is dirty when its encoded value differs from the one last saved.
+        '''
+        mm = self._mmap
+        dirty = []
+        for entry in self._entries:
+            data = self._encode(self._pvs[entry.name], entry)
+            if self._saved.get(entry.name) == data:
+                continue
+
+            offset = entry.offsets[1 - entry.active]
+            mm[offset:offset + len(data)] = data
+            dirty.append((entry, data))
+
+        if not dirty:
+            return 0
+
+        mm.flush()
+
+        for entry, data in dirty:
+            entry.active = 1 - entry.active
+            offset = HEADER.size + entry.index * ENTRY.size + ACTIVE_OFFSET
+            mm[offset:offset + 1] = struct.pack('B', entry.active)
+            self._saved[entry.name] = data
+
+        mm.flush()
+        return len(dirty)
+
+    def _save_loop(self):
+        while self._running:
+            self._stop_event.wait(self._period)
+            if not self._running:
+                break
+
+            try:
+                self.save()
+            except Exception as ex:
+                logger.error('Autosave to %s failed: %s', self._filename, ex,
+                             exc_info=ex)
+
+    def start(self):
+        '''Start saving periodically in a background thread'''
+        if self._thread is not None:
+            return
+
+        self._running = True
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._save_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, wait=True, save=True):
+        '''Stop the saving thread, optionally saving one last time'''
+        if self._thread is not None:
+            self._running = False
+            self._stop_event.set()
+            if wait:
+                self._thread.join()
+            self._thread = None
+
+        if save:
+            self.save()
+
+    def close(self):
+        '''Stop saving and release the memory-mapped files'''
+        self.stop()
+
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+
+            if self._snapshot_map is not None:
+                self._snapshot = {}
+                self._snapshot_map.close()
+                self._snapshot_map = None
@@ -0,0 +1,198 @@
+# vi: ts=4 sw=4
+'''
+:mod:`pypvserver.compress` - Compress records
+=============================================
+
+.. module:: pypvserver.compress
+   :synopsis: Records reducing a high-rate source PV to N-to-1 statistics or
+              a circular buffer, like the EPICS compress record
+'''
+
+from __future__ import print_function
+
+import threading
+import logging
+
+import numpy as np
+
+from .pv import PypvRecord
+from .errors import ReadOnlyError
+
+
+logger = logging.getLogger(__name__)
+
+
+class PypvCompress(PypvRecord):
+    '''A compress record: reduces the updates of a source PV
+
+    With an N-to-1 algorithm, every `n` source values produce one output
+    value; with 'circular', every source value is an output value. Outputs
+    are kept in a ring of `size` elements, published (oldest first) as the
+    VAL waveform.
+
+    The mean, minimum and maximum are accumulated as each source value
+    arrives, so producing an output does not re-scan the values. The median
+    keeps the `n` values of the current group in a preallocated buffer.
+
+    ====== ==============================================================
+    Field  Description
+    ====== ==============================================================
+    ALG    The algorithm
+    N      Number of source values per output
+    NSAM   Number of elements of VAL
+    NUSE   Number of elements of VAL in use
+    RES    A put resets the record
+    ====== ==============================================================
+
+    Keyword arguments are passed to the base class, PypvRecord
+
+    Parameters
+    ----------
+    name : str
+        The record name (not including the server prefix)
+    source : PyPV, optional
+        The PV to follow. Values can also be given with `process_value`.
+    algorithm : {'mean', 'min', 'max', 'median', 'circular'}, optional
+        The reduction
+    n : int, optional
+        Number of source values per output (N-to-1 algorithms)
+    size : int, optional
+        Number of output values kept
+    '''
+
+    _rtype = 'compress'
+    algorithms = ('mean', 'min', 'max', 'median', 'circular')
+
+    def __init__(self, name, source=None, algorithm='mean', n=10, size=1,
+                 **kwargs):
+        if algorithm not in self.algorithms:
+            raise ValueError('Unknown algorithm %r (one of %s)' %
+                             (algorithm, ', '.join(self.algorithms)))
+
+        n = int(n)
+        size = int(size)
+        if n <= 0 or size <= 0:
+            raise ValueError('n and size must be positive')
+
+        self._algorithm = algorithm
+        self._n = n if algorithm != 'circular' else 1
+        self._size = size
+        self._lock = threading.RLock()
+        self._outputs = np.zeros(size, dtype=np.float64)
+        self._group = (np.zeros(self._n, dtype=np.float64)
+                       if algorithm == 'median' else None)
+        self._source = None
+
+        PypvRecord.__init__(self, name, np.zeros(size, dtype=np.float64),
+                            rtype=self._rtype, **kwargs)
+
+        self.add_field('ALG', algorithm)
+        self.add_field('N', self._n)
+        self.add_field('NSAM', size)
+        self.add_field('NUSE', 0)
+        self.add_field('RES', 0, written_cb=lambda **kwargs: self.reset())
+
+        self.reset()
+        if source is not None:
+            self.attach(source)
+
+    @property
+    def algorithm(self):
+        '''The reduction algorithm'''
+        return self._algorithm
+
+    @property
+    def source(self):
+        '''The PV followed, if any'''
+        return self._source
+
+    def attach(self, source):
+        '''Follow the updates of `source` (a PyPV)'''
+        if self._source is not None:
+            raise ValueError('Already attached to %s' % self._source.name)
+
+        self._source = source
+        source.subscribe(self._source_updated)
+
+    def detach(self):
+        '''Stop following the source PV'''
+        if self._source is not None:
+            self._source.clear_sub(self._source_updated)
+            self._source = None
+
+    def reset(self):
+        '''Discard the outputs and the partial group'''
+        with self._lock:
+            self._start_group()
+            self._next = 0
+            self._used = 0
+            self.update_fields({'VAL': np.zeros(self._size), 'NUSE': 0})
+
+    def _start_group(self):
+        self._in_group = 0
+        self._sum = 0.0
+        self._min = np.inf
+        self._max = -np.inf
+
+    def _source_updated(self, value=None, **kwargs):
+        '''[PV callback] The source PV was updated'''
+        try:
+            self.process_value(value)
+        except (TypeError, ValueError) as ex:
+            logger.debug('%s: source value ignored (%s)', self.name, ex)
+
+    def process_value(self, value):
+        '''Add a source value
+
+        Returns
+        -------
+        output : float or None
+            The output value, if this value completed a group
+        '''
+        value = float(value)
+        with self._lock:
+            algorithm = self._algorithm
+            if algorithm == 'mean':
+                self._sum += value
+            elif algorithm == 'min':
+                self._min = min(self._min, value)
+            elif algorithm == 'max':
+                self._max = max(self._max, value)
+            elif algorithm == 'median':
+                self._group[self._in_group] = value
+
+            self._in_group += 1
+            if self._in_group < self._n:
+                return None
+
+            if algorithm == 'mean':
+                output = self._sum / self._n
+            elif algorithm == 'min':
+                output = self._min
+            elif algorithm == 'max':
+                output = self._max
+            elif algorithm == 'median':
+                output = float(np.median(self._group))
+            else:
+                output = value
+
+            self._start_group()
+            self._outputs[self._next] = output
+            self._next = (self._next + 1) % self._size
+            self._used = min(self._used + 1, self._size)
+            values = np.zeros(self._size)
+            if self._used < self._size:
+                values[:self._used] = self._outputs[:self._used]
+            else:
+                values[:] = np.roll(self._outputs, -self._next)
+
+            # Posted under the lock, so that outputs reach clients in order;
+            # VAL is posted for every output, even if unchanged
+            self.update_fields({'VAL': values, 'NUSE': self._used},
+                               force=('VAL', ))
+        return output
+
+    def written_to(self, timestamp=None, value=None, status=None,
+                   severity=None):
+        '''[CAS callback] The output is read-only'''
+        raise ReadOnlyError('Compress record outputs cannot be written')
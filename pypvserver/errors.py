@@ -15,6 +15,10 @@ __all__ = ['PypvError',
            'UndefinedValueError',
            'AsyncCompletion',
            'AsyncRunning',
+           'AsyncCancelled',
+           'QueueFullError',
+           'RequestIdError',
+           'ReadOnlyError',
            ]
 
 
@@ -40,3 +44,19 @@ class AsyncCompletion(PypvError):
 
 class AsyncRunning(PypvError):
     ret = cas.S_casApp_postponeAsyncIO
+
+
+class AsyncCancelled(PypvError):
+    ret = cas.S_casApp_canceledAsyncIO
+
+
+class QueueFullError(PypvError):
+    ret = cas.S_casApp_noMemory
+
+
+class RequestIdError(PypvError):
+    ret = cas.S_casApp_outOfBounds
+
+
+class ReadOnlyError(PypvError):
+    ret = cas.S_casApp_noSupport
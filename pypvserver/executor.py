@@ -0,0 +1,711 @@
+# vi: ts=4 sw=4
+'''
+:mod:`pypvserver.executor` - Function executors
+===============================================
+
+.. module:: pypvserver.executor
+   :synopsis: Bounded worker pools used to run :class:`PypvFunction` calls
+'''
+
+from __future__ import print_function
+
+import collections
+import heapq
+import importlib
+import itertools
+import multiprocessing
+import threading
+import logging
+import sys
+
+from concurrent.futures import (Future, CancelledError)
+
+from .errors import QueueFullError
+from . import stats
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+
+logger = logging.getLogger(__name__)
+
+# Functions which can be run by a ProcessPool, keyed on (module, qualname)
+_registry = {}
+# pyepics sets up libca on first use, which is not safe from several
+# threads at once
+_ca_init_lock = threading.Lock()
+
+
+class WorkerPool(object):
+    '''A bounded pool of worker threads
+
+    Worker threads are started as needed, up to `max_workers`, and then
+    reused. Calls which cannot start immediately wait in a queue of at most
+    `max_queue` entries.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        Maximum number of worker threads
+    max_queue : int, optional
+        Maximum number of calls waiting for a worker (0 for no limit)
+    block : bool, optional
+        When the queue is full, block the caller of `submit` until there is
+        room (backpressure). Otherwise, :class:`QueueFullError` is raised
+        (rejection). Callers which must never block (such as the channel
+        access server thread) use `submit_nowait`.
+    ca_context : bool, optional
+        Attach each worker to the pyepics channel access context, as
+        `epics.ca.CAThread` does
+    name : str, optional
+        Name prefix for the worker threads
+    max_abandoned : int, optional
+        Maximum number of workers abandoned by `cancel` to replace
+        (defaults to `max_workers`). Beyond this, the pool is degraded: each
+        abandoned worker takes up a worker slot until its call returns.
+    '''
+
+    def __init__(self, max_workers=4, max_queue=0, block=False,
+                 ca_context=True, name='pypvserver-worker',
+                 max_abandoned=None):
+        if max_workers < 1:
+            raise ValueError('max_workers must be at least 1')
+
+        self.max_workers = int(max_workers)
+        self.max_queue = int(max_queue)
+        self.block = bool(block)
+        self.name = str(name)
+        if max_abandoned is None:
+            max_abandoned = max_workers
+        self.max_abandoned = int(max_abandoned)
+
+        self._ca_context = bool(ca_context)
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._workers = []
+        self._idle = 0
+        self._busy = 0
+        self._listeners = []
+        self._shutdown = False
+        # Worker thread to the future it is running
+        self._running = {}
+        self._abandoned = set()
+
+    @property
+    def queued(self):
+        '''Number of calls waiting for a worker'''
+        return len(self._queue)
+
+    @property
+    def busy(self):
+        '''Number of workers currently running a call'''
+        return self._busy
+
+    @property
+    def workers(self):
+        '''Number of worker threads started'''
+        return len(self._workers)
+
+    @property
+    def abandoned(self):
+        '''Number of abandoned workers whose calls have not yet returned'''
+        return len(self._abandoned)
+
+    @property
+    def degraded(self):
+        '''Abandoned workers are no longer being replaced'''
+        return len(self._abandoned) >= self.max_abandoned
+
+    def _can_start_worker(self):
+        '''A worker may be started (with the lock held)'''
+        excess = max(0, len(self._abandoned) - self.max_abandoned)
+        return len(self._workers) + excess < self.max_workers
+
+    def add_listener(self, callback):
+        '''Call `callback(pool)` whenever the queue depth or the number of
+        busy workers changes'''
+        if callback not in self._listeners:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        '''Remove a listener added with `add_listener`'''
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def _notify(self):
+        for callback in list(self._listeners):
+            try:
+                callback(self)
+            except Exception as ex:
+                logger.error('Pool listener %s failed: %s', callback, ex,
+                             exc_info=ex)
+
+    def submit(self, fcn, *args, **kwargs):
+        '''Schedule `fcn(*args, **kwargs)` to run on a worker
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+
+        Raises
+        ------
+        QueueFullError
+            If the queue is full and the pool is not set to block
+        '''
+        return self._enqueue(fcn, args, kwargs, self.block)
+
+    def submit_nowait(self, fcn, *args, **kwargs):
+        '''Like `submit`, but never blocks: when the queue is full, the call
+        is rejected whether or not the pool is set to block
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+
+        Raises
+        ------
+        QueueFullError
+            If the queue is full
+        '''
+        return self._enqueue(fcn, args, kwargs, False)
+
+    def _enqueue(self, fcn, args, kwargs, block):
+        future = Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError('Pool has been shut down')
+
+            while self.max_queue and len(self._queue) >= self.max_queue:
+                if not block:
+                    raise QueueFullError('Queue full ({} calls waiting)'
+                                         ''.format(len(self._queue)))
+                self._cond.wait()
+
+            self._queue.append((future, fcn, args, kwargs))
+            if len(self._queue) > self._idle and self._can_start_worker():
+                self._start_worker()
+
+            self._cond.notify_all()
+
+        self._notify()
+        return future
+
+    def _start_worker(self):
+        thread = threading.Thread(target=self._worker_loop,
+                                  name='%s-%d' % (self.name,
+                                                  len(self._workers)))
+        thread.daemon = True
+        self._workers.append(thread)
+        thread.start()
+
+    def _init_worker(self):
+        '''Called in each worker thread as it starts'''
+        if not self._ca_context:
+            return
+
+        try:
+            import epics
+        except ImportError:
+            return
+
+        with _ca_init_lock:
+            epics.ca.use_initial_context()
+
+    def _exit_worker(self):
+        '''Called in each worker thread before it exits'''
+        pass
+
+    def _worker_loop(self):
+        self._init_worker()
+        thread = threading.current_thread()
+
+        while True:
+            with self._cond:
+                while not self._queue and not self._shutdown:
+                    self._idle += 1
+                    self._cond.wait()
+                    self._idle -= 1
+
+                if not self._queue:
+                    self._workers.remove(thread)
+                    break
+
+                future, fcn, args, kwargs = self._queue.popleft()
+                self._busy += 1
+                self._running[thread] = future
+                # wake any callers blocked on a full queue
+                self._cond.notify_all()
+
+            self._notify()
+            self._run(future, fcn, args, kwargs)
+
+            with self._cond:
+                if thread in self._abandoned:
+                    # Abandoned while its call was hung; let it go, freeing
+                    # its slot if it was not replaced
+                    self._abandoned.remove(thread)
+                    if (self._queue and self._idle < len(self._queue) and
+                            self._can_start_worker()):
+                        self._start_worker()
+                    return
+
+                del self._running[thread]
+                self._busy -= 1
+
+            self._notify()
+
+        self._exit_worker()
+
+    def _call(self, fcn, args, kwargs):
+        '''Run a single call, in a worker thread'''
+        return fcn(*args, **kwargs)
+
+    def _run(self, future, fcn, args, kwargs):
+        if not future.set_running_or_notify_cancel():
+            return
+
+        future.started = stats.clock()
+        try:
+            result = self._call(fcn, args, kwargs)
+        except BaseException as ex:
+            self._set_result(future, exception=ex)
+        else:
+            self._set_result(future, result)
+
+    def _set_result(self, future, result=None, exception=None):
+        if future.done():
+            # Cancelled while running
+            return
+
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        except Exception:
+            # Lost a race with cancel()
+            pass
+
+    def cancel(self, future):
+        '''Cancel a call made with `submit`
+
+        A queued call is removed from the queue. A running call cannot be
+        interrupted in a thread: its worker is abandoned, left to finish in
+        the background, and a new worker is started in its place (up to
+        `max_abandoned` of them, see `degraded`). The future then raises
+        CancelledError.
+
+        Returns
+        -------
+        bool
+            False if the call had already completed
+        '''
+        with self._cond:
+            for item in self._queue:
+                if item[0] is future:
+                    self._queue.remove(item)
+                    self._cond.notify_all()
+                    break
+            else:
+                item = None
+
+            if item is None:
+                threads = [thread for thread, running in self._running.items()
+                           if running is future]
+                if not threads:
+                    return future.cancel()
+
+                self._interrupt(threads[0])
+
+        if item is not None:
+            future.cancel()
+        else:
+            self._set_result(future, exception=CancelledError())
+
+        self._notify()
+        return True
+
+    def _interrupt(self, thread):
+        '''Free a worker thread from its running call (with the lock held)'''
+        del self._running[thread]
+        self._busy -= 1
+        self._abandoned.add(thread)
+        self._workers.remove(thread)
+        if len(self._abandoned) == self.max_abandoned:
+            logger.warning('%s: %d workers abandoned, no longer replacing '
+                           'them', self.name, len(self._abandoned))
+
+        if self._queue and self._can_start_worker():
+            self._start_worker()
+
+    def shutdown(self, wait=True):
+        '''Stop the workers once the queued calls have completed'''
+        with self._cond:
+            self._shutdown = True
+            workers = list(self._workers)
+            self._cond.notify_all()
+
+        if wait:
+            for thread in workers:
+                thread.join()
+
+    def __repr__(self):
+        return ('{0}(max_workers={1.max_workers}, max_queue={1.max_queue}, '
+                'busy={1.busy}, queued={1.queued}, '
+                'abandoned={1.abandoned})'
+                ''.format(self.__class__.__name__, self))
+
+
+class DeadlineScheduler(object):
+    '''Runs callbacks after a delay, from a single shared thread
+
+    Used for call timeouts, so that a timer thread is not needed per call.
+    The thread is started on first use.
+    '''
+
+    def __init__(self, name='pypvserver-deadlines'):
+        self.name = name
+        self._heap = []
+        self._cond = threading.Condition()
+        self._counter = itertools.count()
+        self._thread = None
+
+    def call_later(self, delay, callback):
+        '''Call `callback()` after `delay` seconds
+
+        Returns
+        -------
+        entry
+            To be passed to `cancel`
+        '''
+        entry = [stats.clock() + delay, next(self._counter), callback]
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+
+            self._cond.notify()
+
+        return entry
+
+    def cancel(self, entry):
+        '''Cancel a callback scheduled with `call_later`'''
+        # Cancelled entries are dropped when they come due
+        entry[2] = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+
+                deadline, _, callback = self._heap[0]
+                delay = deadline - stats.clock()
+                if delay > 0 and callback is not None:
+                    self._cond.wait(delay)
+                    continue
+
+                heapq.heappop(self._heap)
+
+            if callback is None:
+                continue
+
+            try:
+                callback()
+            except Exception as ex:
+                logger.error('Scheduled callback %s failed: %s', callback, ex,
+                             exc_info=ex)
+
+
+scheduler = DeadlineScheduler()
+
+
+class EventLoopThread(object):
+    '''An asyncio event loop, run forever in a background thread
+
+    Parameters
+    ----------
+    name : str, optional
+        Name of the thread
+    '''
+
+    def __init__(self, name='pypvserver-asyncio'):
+        import asyncio
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        import asyncio
+
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def stop(self, wait=True):
+        '''Stop the event loop; pending coroutines are abandoned'''
+        if self.loop.is_closed():
+            return
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if wait:
+            self._thread.join()
+
+
+def function_key(fcn):
+    '''The key a function is registered under: (module, qualified name)'''
+    return (fcn.__module__, getattr(fcn, '__qualname__', fcn.__name__))
+
+
+def register_function(fcn):
+    '''Register a function so that it can be run by a :class:`ProcessPool`
+
+    Worker processes find the function by importing its module, which is
+    expected to register it again (e.g., by way of the
+    :class:`PypvFunction` decorator). With the 'fork' start method the
+    registry is simply inherited.
+    '''
+    key = function_key(fcn)
+    _registry[key] = fcn
+    return key
+
+
+def map_function(key, kwargs_list):
+    '''Call the registered function `key` once for each set of keyword
+    arguments, returning the list of results'''
+    fcn = _lookup_function(key)
+    return [fcn(**kwargs) for kwargs in kwargs_list]
+
+
+def _lookup_function(key):
+    try:
+        return _registry[key]
+    except KeyError:
+        pass
+
+    module, qualname = key
+    importlib.import_module(module)
+    try:
+        return _registry[key]
+    except KeyError:
+        raise KeyError('Function {}.{} not registered'.format(module,
+                                                             qualname))
+
+
+register_function(map_function)
+
+
+def _shared_memory(name=None, size=0):
+    '''Create (or attach to, given a name) an untracked shared memory block
+
+    The parent process unlinks each block once its result has been copied
+    out, so the resource tracker of the worker must not also claim it.
+    '''
+    create = name is None
+    try:
+        return shared_memory.SharedMemory(name=name, create=create,
+                                          size=size, track=False)
+    except TypeError:
+        # Python < 3.13
+        shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+
+    if create:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def _pack_result(result, shm_threshold):
+    '''Pack a result to be sent to the parent process
+
+    Large arrays are placed in shared memory, and only their description is
+    sent through the pipe.
+    '''
+    np = sys.modules.get('numpy', None)
+    if (shared_memory is None or np is None or shm_threshold is None or
+            not isinstance(result, np.ndarray) or result.dtype.hasobject or
+            result.nbytes < shm_threshold):
+        return ('value', result)
+
+    shm = _shared_memory(size=max(result.nbytes, 1))
+    try:
+        view = np.ndarray(result.shape, dtype=result.dtype, buffer=shm.buf)
+        view[...] = result
+        del view
+    finally:
+        shm.close()
+
+    return ('shm', (shm.name, result.shape, result.dtype.str))
+
+
+def _unpack_result(kind, result):
+    '''Unpack a result received from a worker process'''
+    if kind == 'value':
+        return result
+    elif kind == 'error':
+        raise result
+
+    import numpy as np
+
+    name, shape, dtype = result
+    shm = _shared_memory(name=name)
+    try:
+        view = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        result = view.copy()
+        del view
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return result
+
+
+def _process_worker(conn, shm_threshold):
+    '''Main loop of a ProcessPool worker process'''
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+
+        if request is None:
+            break
+
+        key, args, kwargs = request
+        try:
+            result = _pack_result(_lookup_function(key)(*args, **kwargs),
+                                  shm_threshold)
+        except Exception as ex:
+            result = ('error', ex)
+
+        try:
+            conn.send(result)
+        except Exception as ex:
+            # The result (or exception) could not be pickled
+            conn.send(('error', RuntimeError('{}: {}'.format(
+                ex.__class__.__name__, ex))))
+
+    conn.close()
+
+
+class ProcessPool(WorkerPool):
+    '''A bounded pool of worker processes
+
+    Each worker thread of the pool owns a child process, and hands its calls
+    to it through a pipe. This keeps CPU-bound functions from holding the
+    GIL of the server process.
+
+    Only registered functions may be submitted (see
+    :func:`register_function`), and their arguments and results must be
+    picklable. Numpy array results of at least `shm_threshold` bytes are
+    returned through shared memory rather than the pipe, where
+    `multiprocessing.shared_memory` is available (Python 3.8+).
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        Maximum number of worker processes
+    max_queue : int, optional
+        Maximum number of calls waiting for a worker (0 for no limit)
+    block : bool, optional
+        When the queue is full, block the caller of `submit` until there is
+        room. Otherwise, :class:`QueueFullError` is raised.
+    shm_threshold : int, optional
+        Minimum array size, in bytes, to return through shared memory (None
+        to always use the pipe)
+    start_method : str, optional
+        The multiprocessing start method (defaults to that of the platform)
+    name : str, optional
+        Name prefix for the worker threads
+    '''
+
+    def __init__(self, max_workers=4, max_queue=0, block=False,
+                 shm_threshold=65536, start_method=None,
+                 name='pypvserver-process'):
+        super(ProcessPool, self).__init__(max_workers=max_workers,
+                                          max_queue=max_queue, block=block,
+                                          ca_context=False, name=name)
+        self.shm_threshold = shm_threshold
+        if start_method is None:
+            self._mp = multiprocessing
+        else:
+            self._mp = multiprocessing.get_context(start_method)
+        self._local = threading.local()
+        self._processes = {}
+
+    def _interrupt(self, thread):
+        # Terminating the process fails the call in the worker thread, which
+        # then starts a new process for its next call
+        proc = self._processes.get(thread, None)
+        if proc is not None:
+            proc.terminate()
+
+    def _enqueue(self, fcn, args, kwargs, block):
+        # Workers are sent the key of the registered function
+        key = function_key(fcn)
+        if _registry.get(key, None) is not fcn:
+            raise ValueError('Function {}.{} not registered'.format(*key))
+
+        return super(ProcessPool, self)._enqueue(key, args, kwargs, block)
+
+    def _start_process(self):
+        parent_conn, child_conn = self._mp.Pipe()
+        proc = self._mp.Process(target=_process_worker,
+                                args=(child_conn, self.shm_threshold),
+                                name=threading.current_thread().name)
+        proc.daemon = True
+        proc.start()
+        child_conn.close()
+
+        self._local.conn = parent_conn
+        self._local.process = proc
+        with self._cond:
+            self._processes[threading.current_thread()] = proc
+
+    def _stop_process(self):
+        conn = getattr(self._local, 'conn', None)
+        proc = getattr(self._local, 'process', None)
+        if conn is None:
+            return
+
+        self._local.conn = self._local.process = None
+        with self._cond:
+            self._processes.pop(threading.current_thread(), None)
+
+        try:
+            conn.send(None)
+        except (IOError, OSError):
+            pass
+
+        conn.close()
+        proc.join(1.0)
+        if proc.is_alive():
+            proc.terminate()
+
+    def _exit_worker(self):
+        self._stop_process()
+
+    def _call(self, key, args, kwargs):
+        if getattr(self._local, 'conn', None) is None:
+            self._start_process()
+
+        conn = self._local.conn
+        try:
+            conn.send((key, args, kwargs))
+            kind, result = conn.recv()
+        except (EOFError, IOError, OSError) as ex:
+            # Start a fresh process for the next call
+            self._stop_process()
+            raise RuntimeError('Worker process failed: {}'.format(ex))
+
+        return _unpack_result(kind, result)
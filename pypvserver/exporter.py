@@ -0,0 +1,310 @@
+# vi: ts=4 sw=4
+'''
+:mod:`pypvserver.exporter` - Metrics exporter
+=============================================
+
+.. module:: pypvserver.exporter
+   :synopsis: Serve internal server counters and histograms in the
+              Prometheus text format, over HTTP or a Unix domain socket
+'''
+
+from __future__ import print_function
+
+import numbers
+import os
+import socket
+import stat
+import threading
+import logging
+
+try:
+    from http.server import (HTTPServer, BaseHTTPRequestHandler)
+except ImportError:
+    from BaseHTTPServer import (HTTPServer, BaseHTTPRequestHandler)
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from . import stats
+
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (key, _escape(value))
+                             for key, value in sorted(labels.items()))
+
+
+def _format_value(value):
+    if isinstance(value, numbers.Integral):
+        return '%d' % value
+    elif value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _MetricWriter(object):
+    '''Accumulates lines of Prometheus text exposition format'''
+
+    def __init__(self):
+        self.lines = []
+        self._declared = set()
+
+    def declare(self, name, type_, help_):
+        if name in self._declared:
+            return
+
+        self._declared.add(name)
+        self.lines.append('# HELP %s %s' % (name, help_))
+        self.lines.append('# TYPE %s %s' % (name, type_))
+
+    def sample(self, name, value, labels=None):
+        self.lines.append('%s%s %s' % (name, _labels(labels),
+                                       _format_value(value)))
+
+    def metric(self, name, type_, help_, value, labels=None):
+        self.declare(name, type_, help_)
+        self.sample(name, value, labels)
+
+    def histogram(self, name, help_, hist, labels=None):
+        self.declare(name, 'histogram', help_)
+
+        labels = dict(labels or {})
+        buckets, count, total = hist.snapshot()
+
+        cumulative = 0
+        for bound, num in zip(hist.bounds, buckets):
+            cumulative += num
+            labels['le'] = _format_value(bound)
+            self.sample(name + '_bucket', cumulative, labels)
+
+        labels['le'] = '+Inf'
+        self.sample(name + '_bucket', count, labels)
+        del labels['le']
+        self.sample(name + '_sum', total, labels)
+        self.sample(name + '_count', count, labels)
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def memory_usage():
+    '''Resident and peak resident memory of this process, in bytes
+
+    Either may be None if not available on this platform.
+    '''
+    rss = None
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+    max_rss = None
+    if resource is not None:
+        # kilobytes on Linux
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    return rss, max_rss
+
+
+def format_metrics(server=None, counters=None):
+    '''Format the current server statistics as Prometheus text
+
+    Parameters
+    ----------
+    server : PypvServer, optional
+        The server to report (its counters, and e.g., the number of PVs)
+    counters : ServerCounters, optional
+        Counters to report, defaulting to those of `server`
+
+    Returns
+    -------
+    text : str
+    '''
+    if counters is None:
+        if server is None:
+            raise ValueError('Either server or counters must be specified')
+        counters = server.counters
+
+    out = _MetricWriter()
+
+    out.declare('pypvserver_searches_total', 'counter',
+                'Name searches received, by result')
+    out.sample('pypvserver_searches_total', counters.search_hits,
+               dict(result='hit'))
+    out.sample('pypvserver_searches_total', counters.search_misses,
+               dict(result='miss'))
+
+    out.metric('pypvserver_events_posted_total', 'counter',
+               'Monitor events posted to clients', counters.events)
+    out.metric('pypvserver_writes_total', 'counter',
+               'Channel access writes', counters.writes)
+    out.metric('pypvserver_scan_overruns_total', 'counter',
+               'Scans which took longer than their period',
+               counters.scan_overruns)
+    out.metric('pypvserver_async_pending', 'gauge',
+               'Asynchronous writes in progress', counters.async_pending)
+
+    if server is not None:
+        out.metric('pypvserver_pvs', 'gauge', 'PVs (and records) served',
+                   len(server._pvs), dict(prefix=server.prefix))
+
+    out.histogram('pypvserver_process_loop_seconds',
+                  'Process-loop iteration time, including the wait for '
+                  'events', counters.loop_period)
+    out.histogram('pypvserver_scan_jitter_seconds',
+                  'Deviation of periodic scans from their period',
+                  counters.scan_jitter)
+
+    timer = stats.timer
+    if timer is not None:
+        for (name, kind), hist in sorted(list(timer.histograms.items())):
+            out.histogram('pypvserver_callback_seconds',
+                          'Callback execution time, by PV and callback type',
+                          hist, dict(pv=name, kind=kind))
+
+        out.declare('pypvserver_slow_callbacks_total', 'counter',
+                    'Callbacks which exceeded the time budget')
+        for (name, kind), count in sorted(list(timer.slow_counts.items())):
+            out.sample('pypvserver_slow_callbacks_total', count,
+                       dict(pv=name, kind=kind))
+
+    rss, max_rss = memory_usage()
+    if rss is not None:
+        out.metric('process_resident_memory_bytes', 'gauge',
+                   'Resident memory size in bytes', rss)
+    if max_rss is not None:
+        out.metric('process_max_resident_memory_bytes', 'gauge',
+                   'Peak resident memory size in bytes', max_rss)
+
+    return out.text()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        try:
+            body = format_metrics(self.server.pypv_server).encode('utf-8')
+        except Exception as ex:
+            logger.error('Failed to format metrics: %s', ex, exc_info=ex)
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix domain socket clients have no (host, port)
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, fmt, *args):
+        logger.debug('%s %s', self.address_string(), fmt % args)
+
+
+class _UnixHTTPServer(HTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # Skip the (host, port) handling in HTTPServer.server_bind
+        self.socket.bind(self.server_address)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+class MetricsExporter(object):
+    '''Serves server statistics in the Prometheus text format
+
+    Metrics are only formatted when scraped; the server hot paths pay only
+    for counter increments. Callback latency histograms are included when
+    timing is enabled (see :func:`pypvserver.stats.enable_timing`).
+
+    Parameters
+    ----------
+    server : PypvServer
+        The server to report
+    host : str, optional
+        Address to listen on
+    port : int, optional
+        TCP port to listen on (0 picks a free port)
+    path : str, optional
+        Listen on this Unix domain socket instead of a TCP port. A stale
+        socket left at the path is replaced.
+    start : bool, optional
+        Start serving now
+
+    Raises
+    ------
+    ValueError
+        If `path` exists and is not a socket
+    '''
+
+    def __init__(self, server, host='127.0.0.1', port=9099, path=None,
+                 start=True):
+        self._server = server
+        self._path = path
+        self._thread = None
+
+        if path is not None:
+            try:
+                mode = os.stat(path).st_mode
+            except OSError:
+                pass
+            else:
+                if not stat.S_ISSOCK(mode):
+                    raise ValueError('%s exists and is not a socket' % path)
+                os.unlink(path)
+            self._httpd = _UnixHTTPServer(path, _MetricsHandler)
+        else:
+            self._httpd = HTTPServer((host, int(port)), _MetricsHandler)
+
+        self._httpd.pypv_server = server
+
+        if start:
+            self.start()
+
+    @property
+    def address(self):
+        '''The (host, port) or Unix socket path being served'''
+        return self._httpd.server_address
+
+    def start(self):
+        '''Start serving in a background thread'''
+        if self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''Stop serving and close the socket'''
+        if self._thread is not None:
+            self._httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+
+        self._httpd.server_close()
+        if self._path is not None and os.path.exists(self._path):
+            os.unlink(self._path)
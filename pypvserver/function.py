@@ -12,23 +12,202 @@ from __future__ import print_function
 import functools
 import inspect
 import logging
-import time
+import numbers
+import threading
+import warnings
 from collections import OrderedDict
+from concurrent import futures
+from concurrent.futures import Future
 
-import epics
+from .pv import (PyPV, PypvRecord)
+from .errors import (AsyncCompletion, AsyncCancelled, QueueFullError,
+                     RequestIdError)
+from .executor import (WorkerPool, ProcessPool, register_function,
+                       function_key, map_function, scheduler)
+from .server import PypvServer
+from . import stats
 
-from .pv import PyPV
-from .errors import AsyncCompletion
-from . import PypvServer
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
 
+def _is_coroutine_function(fcn):
+    '''Is `fcn` a coroutine (`async def`) function?'''
+    iscoroutinefunction = getattr(inspect, 'iscoroutinefunction', None)
+    if iscoroutinefunction is None:
+        # Python < 3.5
+        return False
+    return iscoroutinefunction(fcn)
+
+
+def _is_async_generator_function(fcn):
+    '''Is `fcn` an asynchronous generator (`async def` with `yield`)?'''
+    isasyncgenfunction = getattr(inspect, 'isasyncgenfunction', None)
+    if isasyncgenfunction is None:
+        # Python < 3.6
+        return False
+    return isasyncgenfunction(fcn)
+
+
+def _getargspec(fcn):
+    '''(args, varargs, varkw, defaults, kwonlyargs, kwonlydefaults) of a
+    function'''
+    getfullargspec = getattr(inspect, 'getfullargspec', None)
+    if getfullargspec is None:
+        # Python 2
+        args, var_args, var_kws, defaults = inspect.getargspec(fcn)
+        return args, var_args, var_kws, defaults, [], {}
+
+    spec = getfullargspec(fcn)
+    return (spec.args, spec.varargs, spec.varkw, spec.defaults,
+            spec.kwonlyargs, spec.kwonlydefaults or {})
+
+
+def _complete(future, result=None, exception=None):
+    '''Set the result of a future, unless it was already completed (e.g.,
+    by an abort)'''
+    if future.done():
+        return
+
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except Exception:
+        # Lost a race with another completion
+        pass
+
+
+def _abort_calls(calls):
+    '''Abort each of a list of calls'''
+    for call in calls:
+        call.abort()
+
+
+def _gather(calls):
+    '''A future for the results of all of `calls`, in order'''
+    result = Future()
+    result.set_running_or_notify_cancel()
+    if not calls:
+        result.set_result([])
+        return result
+
+    lock = threading.Lock()
+    remaining = [len(calls)]
+
+    def call_done(call):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+
+        try:
+            result.set_result([call.result() for call in calls])
+        except BaseException as ex:
+            result.set_exception(ex)
+
+    for call in calls:
+        call.add_done_callback(call_done)
+
+    return result
+
+
+def _hashable(value):
+    '''A hashable stand-in for a parameter value, for use in cache keys'''
+    if isinstance(value, np.ndarray):
+        return (value.dtype.str, value.shape, value.tobytes())
+    elif isinstance(value, (list, tuple)):
+        return tuple(_hashable(item) for item in value)
+
+    return value
+
+
+def _cache_key(kwargs):
+    '''Cache key for a set of function keyword arguments'''
+    return tuple(sorted((key, _hashable(value))
+                        for key, value in kwargs.items()))
+
+
+class _ResultCache(object):
+    '''Least-recently-used cache of function results, with optional expiry
+
+    Parameters
+    ----------
+    size : int
+        Maximum number of results to keep
+    ttl : float, optional
+        Results older than this (in seconds) are not used
+    '''
+
+    def __init__(self, size, ttl=None):
+        self.size = int(size)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''Look up a result
+
+        Returns
+        -------
+        hit : bool
+        value
+            The cached result, or None
+        '''
+        with self._lock:
+            try:
+                stamp, value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return False, None
+
+            if self.ttl is not None and stats.clock() - stamp > self.ttl:
+                self.misses += 1
+                return False, None
+
+            # Move to the most-recently-used end
+            self._entries[key] = (stamp, value)
+            self.hits += 1
+            return True, value
+
+    def put(self, key, value):
+        '''Store a result, evicting the least-recently-used if full'''
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (stats.clock(), value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        '''Remove all results'''
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
 class PypvFunction(object):
     '''Channel Access Server function decorator
 
     RPC-like functionality via channel access for Python functions
 
+    Coroutine (`async def`) functions are run on the server's asyncio event
+    loop (see :attr:`PypvServer.event_loop`) rather than on the executor.
+
+    Generator and asynchronous generator functions post each value they
+    yield to the return value PV as a progress update; the Proc put
+    completes when the generator is exhausted.
+
+    With `coalesce`, identical calls (same function and parameter values)
+    made while one is already running are coalesced: the function runs
+    once, and every waiting put-completion or future is satisfied with its
+    result.
+
     Parameters
     ----------
     prefix : str, optional
@@ -36,9 +215,15 @@ class PypvFunction(object):
     server : PypvServer, optional
         The channel access server to use (defaults to the currently running one,
         or the next instantiated one if not specified)
-    async : bool, optional
+    async_ : bool, optional
         Function should be called asynchronously, in its own thread (do not set
-        to False when doing large calculations or any blocking in the function)
+        to False when doing large calculations or any blocking in the function).
+        Formerly `async`, which is a reserved word as of Python 3.7; that name
+        is still accepted as a keyword argument, but deprecated. Coroutine
+        functions, and functions run in worker processes, always complete
+        asynchronously: they cannot be used with `async_=False` (or
+        `use_process=False`), as channel access puts would then block the
+        server until they complete.
     failed_cb : callable, optional
         When an exception is raised inside the function, `failed_cb` will be
         called.
@@ -50,39 +235,127 @@ class PypvFunction(object):
     retval_pv : str, optional
         Return value PV name
     status_pv : str, optional
-        Status PV name
+        Status PV name. The status record also has QDEP, BUSY and ABND
+        fields, reporting the executor queue depth, number of busy workers
+        and number of abandoned workers (see `WorkerPool.cancel`).
     return_value : , optional
         Default value for the return value
     return_kwargs : , optional
         Keyword arguments are passed to the return value PyPV initializer. You
         can then specify `count`, `type_`, etc. here
+    executor : WorkerPool or str, optional
+        Executor for asynchronous calls. May be shared between several
+        PypvFunction instances. If 'server', the attached server's executor
+        is used (see :attr:`PypvServer.executor`). If 'process', functions
+        run in a :class:`ProcessPool` of worker processes, for CPU-bound
+        functions; they must then be defined at module level, and take and
+        return picklable values. By default, a pool of threads is created
+        for this instance from the settings below.
+    max_workers : int, optional
+        Number of workers in the default executor
+    max_queue : int, optional
+        Number of calls which can wait for a worker in the default executor
+        (0 for no limit)
+    block : bool, optional
+        When the default executor queue is full, block the caller until
+        there is room. Otherwise, the call is rejected. Puts over channel
+        access are always rejected when the queue is full, as blocking
+        there would stall the whole server.
+    cache_size : int, optional
+        Keep up to this many results per function, keyed on the parameter
+        values. A call with cached parameters is answered immediately,
+        without running the function. Hit and miss counts are reported by
+        the CacheHits and CacheMisses PVs. (0 to disable)
+    cache_ttl : float, optional
+        Cached results older than this (in seconds) are not used
+    max_requests : int, optional
+        Enable request-ID calls, with up to this many requests in progress
+        per function. Writing a request ID to the Call PV snapshots the
+        parameters and starts a call, completing the put immediately, so
+        that several calls can run in parallel. The result is kept under
+        that ID (for the last `max_requests` requests) and can be read by
+        writing the ID to ReqId, then reading ReqVal and ReqSts, or from
+        Python with `get_result`. (0 to disable)
+    batch_size : int, optional
+        Enable batch calls of up to this many points. Each numeric
+        parameter gets a Batch:<param> waveform of inputs, alongside
+        Batch:N (the number of points), Batch:Proc and the Batch:Val
+        waveform of results. A put to Batch:Proc calls the function for
+        every point, completing once all are done. (0 to disable)
+    vectorized : bool, optional
+        The function accepts arrays for its numeric parameters and returns
+        an array of results, so a batch is a single call. Otherwise, the
+        points of a batch are split across the executor workers.
+    timeout : float, optional
+        Abort calls which take longer than this, in seconds (see `abort`).
+        Calls may also be aborted by writing to the Abort PV. Synchronous
+        calls of plain functions (with `async_=False`) run in the calling
+        thread, which cannot be interrupted: the timeout does not apply to
+        them.
+    stats_pvs : bool, optional
+        Report the execution statistics of each function with the
+        CallCount, ErrorCount, InFlight, LastTime, MeanTime, P99Time and
+        QueueWait PVs (times in seconds). The statistics are kept either
+        way, and are available from Python as the `stats` attribute of the
+        decorated function.
+    stats_period : float, optional
+        The counts are posted as calls start and finish; the times, which
+        are more costly to derive, are posted on a scan of this period (in
+        seconds)
+    coalesce : bool, optional
+        Coalesce identical calls made while one is running (see above). Only
+        suitable for functions without side effects.
     '''
     _to_attach = []
 
     def __init__(self, prefix='', server=None,
-                 async=True, failed_cb=None,
+                 async_=True, failed_cb=None,
                  process_pv='Proc', use_process=True,
                  retval_pv='Val',
                  status_pv='Sts',
                  return_value=0.0,
+                 executor=None, max_workers=4, max_queue=0, block=False,
+                 cache_size=0, cache_ttl=None, max_requests=0,
+                 batch_size=0, vectorized=False, timeout=None,
+                 stats_pvs=False, stats_period=1.0, coalesce=False,
                  **return_kwargs
                  ):
 
+        if 'async' in return_kwargs:
+            warnings.warn('The async parameter is deprecated; use async_',
+                          DeprecationWarning, stacklevel=2)
+            async_ = return_kwargs.pop('async')
+
         if server is None and PypvServer.default_instance is not None:
             server = PypvServer.default_instance
 
         self._prefix = str(prefix)
         self._server = server
-        self._async = bool(async)
+        self._async = bool(async_)
         self._functions = {}
         self._failed_cb = failed_cb
-        self._async_threads = {}
         self._process_pv = str(process_pv)
         self._status_pv = str(status_pv)
         self._use_process = bool(use_process)
         self._retval_pv = str(retval_pv)
         self._default_retval = return_value
         self._return_kwargs = return_kwargs
+        self._executor = executor
+        self._pool = None
+        self._pool_kw = dict(max_workers=max_workers, max_queue=max_queue,
+                             block=block)
+        self._cache_size = int(cache_size)
+        self._cache_ttl = cache_ttl
+        self._max_requests = int(max_requests)
+        self._batch_size = int(batch_size)
+        self._vectorized = bool(vectorized)
+        self._timeout = float(timeout) if timeout is not None else None
+        self._stats_pvs = bool(stats_pvs)
+        self._stats_period = float(stats_period)
+        self._coalesce = bool(coalesce)
+        self._flight_lock = threading.RLock()
+        # Running calls, keyed on the parameter values, for coalescing
+        self._flights = {}
 
         if not self._use_process:
             self._async = False
@@ -128,8 +401,14 @@ class PypvFunction(object):
 
         pv_kw = {}
         if self._use_process:
+            if self._coalesce:
+                postponed_cb = functools.partial(self._put_postponed, name)
+            else:
+                postponed_cb = None
+
             proc_pv = PyPV(''.join((fcn_prefix, self._process_pv)), 0,
-                           written_cb=info['wrapped'])
+                           written_cb=info['wrapped'],
+                           postponed_cb=postponed_cb)
         else:
             pv_kw['written_cb'] = info['wrapped']
             proc_pv = None
@@ -138,8 +417,70 @@ class PypvFunction(object):
                          self._default_retval,
                          **self._return_kwargs)
 
-        status_pv = PyPV(''.join((fcn_prefix, self._status_pv)),
-                         'status')
+        status_pv = PypvRecord(''.join((fcn_prefix, self._status_pv)),
+                               'status')
+        status_pv.add_field('QDEP', 0)
+        status_pv.add_field('BUSY', 0)
+        status_pv.add_field('ABND', 0)
+
+        abort_pv = PyPV(''.join((fcn_prefix, 'Abort')), 0,
+                        written_cb=functools.partial(self._abort_written,
+                                                     name))
+
+        if info['cache'] is not None:
+            cache_pvs = [PyPV(''.join((fcn_prefix, 'CacheHits')), 0),
+                         PyPV(''.join((fcn_prefix, 'CacheMisses')), 0)]
+        else:
+            cache_pvs = []
+
+        stats_pvs = OrderedDict()
+        if self._stats_pvs:
+            for key, suffix in (('call_count', 'CallCount'),
+                                ('error_count', 'ErrorCount'),
+                                ('in_flight', 'InFlight')):
+                stats_pvs[key] = PyPV(''.join((fcn_prefix, suffix)), 0)
+
+            for key, suffix in (('last_time', 'LastTime'),
+                                ('mean_time', 'MeanTime'),
+                                ('p99_time', 'P99Time'),
+                                ('queue_wait', 'QueueWait')):
+                stats_pvs[key] = PyPV(
+                    ''.join((fcn_prefix, suffix)), 0.0,
+                    scan=self._stats_period,
+                    scan_cb=functools.partial(self._scan_stats_pv, name,
+                                              key))
+
+        if self._max_requests > 0:
+            request_pvs = [
+                PyPV(''.join((fcn_prefix, 'Call')), 0,
+                     written_cb=functools.partial(self._call_written, name)),
+                PyPV(''.join((fcn_prefix, 'ReqId')), 0,
+                     written_cb=functools.partial(self._req_id_written,
+                                                  name)),
+                PyPV(''.join((fcn_prefix, 'ReqVal')), self._default_retval,
+                     **self._return_kwargs),
+                PyPV(''.join((fcn_prefix, 'ReqSts')), 'Unknown'),
+            ]
+        else:
+            request_pvs = []
+
+        batch_pvs = OrderedDict()
+        if self._batch_size > 0:
+            batch_prefix = ''.join((fcn_prefix, 'Batch:'))
+            for param in info['batch_params']:
+                default = defaults[params.index(param)]
+                batch_pvs['batch:%s' % param] = PyPV(
+                    batch_prefix + param,
+                    np.full(self._batch_size, default, dtype=np.float64))
+
+            batch_pvs['batch_count'] = PyPV(batch_prefix + 'N',
+                                            self._batch_size)
+            batch_pvs['batch_process'] = PyPV(
+                batch_prefix + 'Proc', 0,
+                written_cb=functools.partial(self._batch_written, name))
+            batch_pvs['batch_retval'] = PyPV(
+                batch_prefix + 'Val',
+                np.zeros(self._batch_size, dtype=np.float64))
 
         param_pvs = [PyPV(''.join((fcn_prefix, param)),
                           default,
@@ -148,7 +489,9 @@ class PypvFunction(object):
 
         added = []
         try:
-            for pv in param_pvs + [proc_pv, retval_pv, status_pv]:
+            for pv in (param_pvs + [proc_pv, retval_pv, status_pv, abort_pv] +
+                       cache_pvs + list(stats_pvs.values()) + request_pvs +
+                       list(batch_pvs.values())):
                 if pv is not None:
                     server.add_pv(pv)
                     added.append(pv)
@@ -170,6 +513,14 @@ class PypvFunction(object):
         pv_dict['retval'] = retval_pv
         pv_dict['process'] = proc_pv
         pv_dict['status'] = status_pv
+        pv_dict['abort'] = abort_pv
+        if cache_pvs:
+            pv_dict['cache_hits'], pv_dict['cache_misses'] = cache_pvs
+        pv_dict.update(stats_pvs)
+        if request_pvs:
+            (pv_dict['call'], pv_dict['req_id'], pv_dict['req_val'],
+             pv_dict['req_status']) = request_pvs
+        pv_dict.update(batch_pvs)
 
         info['param_dict'] = pv_dict
 
@@ -200,39 +551,781 @@ class PypvFunction(object):
             logger.error(msg, exc_info=ex)
 
     def _run_function(self, name, **kwargs):
-        '''Run the function in this thread, with the kwargs passed'''
-        info = self._functions[name]
-        fcn = info['function']
+        '''Run the function in this thread, with the kwargs passed
 
+        Coroutine functions run on the server event loop, and in process
+        mode functions run in a worker process; this thread then waits for
+        the result, for at most `timeout`. Other functions run in this
+        thread, without a timeout. Only called from Python for those modes,
+        never from the channel access server thread (see `async_`).
+        '''
+        info = self._functions[name]
         kwargs = self.get_kwargs(name, **kwargs)
 
+        if (info['coroutine'] or info['async_generator'] or
+                self._executor == 'process'):
+            call = self._start_call(name, kwargs)
+            try:
+                error = call.exception(self._timeout)
+            except futures.TimeoutError:
+                call.abort()
+                error = futures.TimeoutError('Timed out after %g s' %
+                                             self._timeout)
+            except futures.CancelledError as ex:
+                error = ex
+
+            ret = call.result() if error is None else None
+            return self._function_done(name, kwargs, ret, error)
+
+        info['stats'].started()
+        self._update_stats_counts(name)
+
+        t0 = stats.clock()
+        error = None
         try:
-            ret = fcn(**kwargs)
+            ret = self._call_function(name, kwargs)
         except Exception as ex:
-            self._failed(name, '%s: %s (%s)' % (ex.__class__.__name__, ex, name),
-                         ex, kwargs)
+            error = ex
+            ret = None
+
+        info['stats'].finished(stats.clock() - t0, failed=error is not None)
+        self._update_stats_counts(name)
+        return self._function_done(name, kwargs, ret, error)
+
+    def _call_function(self, name, kwargs):
+        '''Call a (plain or generator) function in this thread'''
+        info = self._functions[name]
+        fcn = info['function']
+
+        timer = stats.timer
+        token = (timer.start(name, 'function')
+                 if timer is not None else None)
+        try:
+            if not info['generator']:
+                return fcn(**kwargs)
+
             ret = None
+            for ret in fcn(**kwargs):
+                self._post_progress(name, ret)
+            return ret
+        finally:
+            if token is not None:
+                timer.stop(token)
+
+    def _post_progress(self, name, value):
+        '''Post a value yielded by a generator function to the return value
+        PV'''
+        if value is not None:
+            self._functions[name]['retval_pv'].value = value
+
+    def _drive_async_generator(self, name, agen, call):
+        '''Iterate an asynchronous generator on the server event loop,
+        posting each value as it is yielded
+
+        Each `__anext__` is scheduled from the completion callback of the
+        previous one. `call` completes with the last value yielded.
+        '''
+        import asyncio
+
+        loop = self._server.event_loop
+        last = [None]
+        current = [None]
+
+        def step(task=None):
+            if call.done():
+                # Aborted
+                return
+
+            if task is not None:
+                try:
+                    value = task.result()
+                except StopAsyncIteration:
+                    _complete(call, last[0])
+                    return
+                except BaseException as ex:
+                    _complete(call, exception=ex)
+                    return
+
+                last[0] = value
+                try:
+                    self._post_progress(name, value)
+                except Exception as ex:
+                    _complete(call, exception=ex)
+                    return
+
+            task = current[0] = asyncio.ensure_future(agen.__anext__(),
+                                                      loop=loop)
+            task.add_done_callback(step)
+
+        def cancel():
+            if current[0] is not None:
+                current[0].cancel()
+
+        def abort():
+            _complete(call, exception=futures.CancelledError())
+            loop.call_soon_threadsafe(cancel)
+
+        call.abort = abort
+        call.set_running_or_notify_cancel()
+        loop.call_soon_threadsafe(step)
+
+    def _start_call(self, name, kwargs):
+        '''Start a call with the gathered kwargs, where the function is to
+        run: the server event loop for coroutine functions, otherwise the
+        executor
+
+        Returns
+        -------
+        call : concurrent.futures.Future
+            Completes with the function's return value or exception
+        '''
+        info = self._functions[name]
+        fcn = info['function']
+
+        if info['coroutine'] or info['async_generator']:
+            if self._server is None:
+                raise RuntimeError('Server not yet attached')
+
+        submitted = stats.clock()
+        if info['async_generator']:
+            call = Future()
+            self._drive_async_generator(name, fcn(**kwargs), call)
+        elif info['coroutine']:
+            import asyncio
+            call = asyncio.run_coroutine_threadsafe(fcn(**kwargs),
+                                                    self._server.event_loop)
+            # Cancels the task on the event loop
+            call.abort = call.cancel
+        else:
+            executor = self.executor
+            submit = self._submit_fcn(executor)
+            if self._executor == 'process':
+                call = submit(fcn, **kwargs)
+            else:
+                call = submit(self._call_function, name, kwargs)
+
+            call.abort = functools.partial(executor.cancel, call)
 
+        self._record_stats(name, call, submitted)
+        return call
+
+    def _submit_fcn(self, executor):
+        '''The executor submit method to use from this thread: one which
+        never blocks on the channel access server thread'''
+        server = self._server
+        if server is not None and server.in_server_thread():
+            return executor.submit_nowait
+        return executor.submit
+
+    def _record_stats(self, name, call, submitted):
+        '''Count a call in the function statistics, recording its execution
+        and queue wait times when it completes'''
+        info = self._functions[name]
+        info['stats'].started()
+        self._update_stats_counts(name)
+
+        def call_done(call):
+            # Executor calls are stamped when a worker picks them up; those
+            # on the event loop start right away
+            started = getattr(call, 'started', submitted)
+            failed = call.cancelled() or call.exception() is not None
+            info['stats'].finished(stats.clock() - started,
+                                   started - submitted, failed)
+            self._update_stats_counts(name)
+
+        call.add_done_callback(call_done)
+
+    def _update_stats_counts(self, name):
+        '''Post the function call counts to the stats PVs, if enabled'''
+        info = self._functions[name]
+        pv_dict = info.get('param_dict', {})
+        if 'call_count' not in pv_dict:
+            return
+
+        fcn_stats = info['stats']
         try:
-            if ret is not None:
+            for key, value in (('call_count', fcn_stats.calls),
+                               ('error_count', fcn_stats.errors),
+                               ('in_flight', fcn_stats.in_flight)):
+                if pv_dict[key].value != value:
+                    pv_dict[key].value = value
+        except Exception as ex:
+            logger.debug('Failed to update stats PVs (%s)', name,
+                         exc_info=ex)
+
+    def _scan_stats_pv(self, name, key):
+        '''[Scan callback] Post one of the times of the function statistics
+        to its stats PV'''
+        info = self._functions[name]
+        pv = info.get('param_dict', {}).get(key, None)
+        if pv is None:
+            # Not yet added to the server
+            return
+
+        fcn_stats = info['stats']
+        if key == 'last_time':
+            value = fcn_stats.exec_time.last
+        elif key == 'mean_time':
+            value = fcn_stats.exec_time.mean
+        elif key == 'p99_time':
+            value = fcn_stats.exec_time.percentile(99)
+        else:
+            value = fcn_stats.queue_wait.mean
+
+        if pv.value != value:
+            pv.value = value
+
+    def _function_done(self, name, kwargs, ret, error=None):
+        '''Report a failure or post the return value of a completed call'''
+        info = self._functions[name]
+        if error is not None:
+            self._failed(name, '%s: %s (%s)' % (error.__class__.__name__,
+                                                 error, name),
+                         error, kwargs)
+            return None
+
+        if ret is not None and info['cache'] is not None:
+            info['cache'].put(_cache_key(kwargs), ret)
+
+        try:
+            if ret is not None and not info['streaming']:
                 info['retval_pv'].value = ret
         except Exception as ex:
             self._failed(name, 'Retval: %s %s (%s)' % (ex.__class__.__name__, ex, name),
                          ex, kwargs)
 
-        if self._async and name in self._async_threads:
-            del self._async_threads[name]
+        return ret
+
+    def _cached(self, name, kwargs):
+        '''Look up the result of a call in the cache
+
+        On a hit, the cached result is posted to the return value PV.
+
+        Returns
+        -------
+        hit : bool
+        ret
+            The cached result, or None
+        '''
+        info = self._functions[name]
+        cache = info['cache']
+        if cache is None:
+            return False, None
+
+        hit, ret = cache.get(_cache_key(kwargs))
+
+        pv_dict = info.get('param_dict', {})
+        if 'cache_hits' in pv_dict:
+            pv_dict['cache_hits'].value = cache.hits
+            pv_dict['cache_misses'].value = cache.misses
+
+        if hit:
+            try:
+                info['retval_pv'].value = ret
+            except Exception as ex:
+                self._failed(name, 'Retval: %s %s (%s)' % (ex.__class__.__name__, ex, name),
+                             ex, kwargs)
+
+        return hit, ret
+
+    def clear_cache(self, name=None):
+        '''Clear the cached results of one function, or of all of them'''
+        names = [name] if name is not None else list(self._functions.keys())
+        for name in names:
+            cache = self._functions[name]['cache']
+            if cache is not None:
+                cache.clear()
+
+    @property
+    def executor(self):
+        '''The executor used for asynchronous calls'''
+        if self._pool is not None:
+            return self._pool
+
+        executor = self._executor
+        if executor == 'server':
+            if self._server is None:
+                raise RuntimeError('Server not yet attached')
+
+            # Not cached: the server pool is replaced when it is restarted
+            executor = self._server.executor
+            executor.add_listener(self._executor_changed)
+            return executor
+        elif executor is None:
+            name = self._prefix.rstrip(':') or 'pypvserver-function'
+            executor = WorkerPool(name=name, **self._pool_kw)
+        elif executor == 'process':
+            name = self._prefix.rstrip(':') or 'pypvserver-process'
+            executor = ProcessPool(name=name, **self._pool_kw)
+
+        executor.add_listener(self._executor_changed)
+        self._pool = executor
+        return executor
+
+    def _executor_changed(self, pool):
+        '''Report executor queue depth, busy and abandoned workers on the
+        status PVs'''
+        queued, busy = pool.queued, pool.busy
+        abandoned = getattr(pool, 'abandoned', 0)
+        for info in list(self._functions.values()):
+            status_pv = info.get('status_pv', None)
+            if status_pv is None or status_pv.server is None:
+                continue
+
+            if status_pv['QDEP'].value != queued:
+                status_pv['QDEP'].value = queued
+            if status_pv['BUSY'].value != busy:
+                status_pv['BUSY'].value = busy
+            if status_pv['ABND'].value != abandoned:
+                status_pv['ABND'].value = abandoned
+
+    def _submit(self, name, **kwargs):
+        '''Queue a function call on the executor
+
+        If an identical call (same function and parameters) is already in
+        flight, its future is returned instead of running the function again.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            Completes with the return value once it has been posted, or None
+            if the function failed (see `failed_cb`)
+
+        Raises
+        ------
+        QueueFullError
+            If the executor queue is full
+        '''
+        kwargs = self.get_kwargs(name, **kwargs)
+        hit, ret = self._cached(name, kwargs)
+        if hit:
+            future = Future()
+            future.set_running_or_notify_cancel()
+            future.set_result(ret)
+            return future
+
+        return self._submit_call(name, kwargs)
+
+    def _submit_call(self, name, kwargs):
+        '''Queue a call with the gathered kwargs, which have already been
+        looked up in the cache (see `_submit`)'''
+        key = (name, _cache_key(kwargs)) if self._coalesce else None
+        with self._flight_lock:
+            if key in self._flights:
+                return self._flights[key]
+
+            call = self._start_call(name, kwargs)
+
+            future = self._track_call(call)
+            call.add_done_callback(functools.partial(self._call_done, name,
+                                                     kwargs, future))
+
+            self._functions[name]['in_flight'].add(future)
+            if key is not None:
+                self._flights[key] = future
+
+        future.add_done_callback(functools.partial(self._flight_done, name,
+                                                   key))
+        return future
+
+    def _track_call(self, call):
+        '''A future for the outcome of `call`, which may be aborted, and which
+        times out after `timeout`'''
+        future = Future()
+        future.set_running_or_notify_cancel()
+        future.call = call
+        future.aborted = None
+
+        if self._timeout is not None:
+            reason = futures.TimeoutError('Timed out after %g s' %
+                                          self._timeout)
+            entry = scheduler.call_later(
+                self._timeout,
+                functools.partial(self._abort_future, future, reason))
+            future.add_done_callback(lambda future: scheduler.cancel(entry))
+
+        return future
+
+    def _abort_future(self, future, reason=None):
+        '''Abort the call behind a future from `_track_call`'''
+        if future.done():
+            return
+
+        if reason is None:
+            reason = futures.CancelledError('Aborted')
+
+        future.aborted = reason
+        future.call.abort()
 
+    def _call_error(self, future, call):
+        '''The error a completed call failed with, or None'''
+        if future.aborted is not None:
+            return future.aborted
+        elif call.cancelled():
+            return futures.CancelledError()
+        return call.exception()
+
+    def _call_done(self, name, kwargs, future, call):
+        error = self._call_error(future, call)
+        ret = call.result() if error is None else None
+        future.set_result(self._function_done(name, kwargs, ret, error))
+
+    def abort(self, name):
+        '''Abort all calls of a function which are in progress
+
+        Queued calls are dropped, threads running a call are abandoned (and
+        replaced), worker processes are terminated and coroutines are
+        cancelled. Pending puts complete with S_casApp_canceledAsyncIO.
+        '''
+        info = self._functions[name]
+        with self._flight_lock:
+            in_flight = list(info['in_flight'])
+
+        if info['batch_pending'] is not None:
+            in_flight.append(info['batch_pending'])
+
+        for future in in_flight:
+            self._abort_future(future)
+
+    def _abort_written(self, name, **kwargs):
+        '''[CAS callback] The Abort PV was written to'''
+        self.abort(name)
+
+    def _flight_done(self, name, key, future):
+        with self._flight_lock:
+            self._functions[name]['in_flight'].discard(future)
+            if key is not None and self._flights.get(key, None) is future:
+                del self._flights[key]
+
+    def _put_postponed(self, name, **kwargs):
+        '''[CAS callback] A put to the Process PV was postponed while another
+        is pending
+
+        If its parameters match the pending call, the put joins it: when the
+        server retries it, it is answered by that call's result instead of
+        running the function again.
+
+        Returns
+        -------
+        retried : callable or None
+            Called when the server retries the put (see `PyPV`)
+        '''
+        info = self._functions[name]
+        key = (name, _cache_key(self.get_kwargs(name)))
+        with self._flight_lock:
+            future = self._flights.get(key, None)
+            if future is None or future is not info['pending']:
+                return None
+
+        return functools.partial(self._join_completed, key, future)
+
+    def _join_completed(self, key, future):
+        '''A postponed put which joined `future` is retried: it is satisfied
+        if that call completed, and the parameters are unchanged'''
+        if not future.done() or future.aborted is not None:
+            return False
+
+        name = key[0]
+        return (name, _cache_key(self.get_kwargs(name))) == key
+
+    def _run_async(self, name, kwargs):
+        '''Run a function asynchronously with the gathered kwargs (a cache
+        miss), completing the Process PV write when done
+
+        Raises
+        ------
+        QueueFullError
+            If the executor queue is full
+        '''
+        info = self._functions[name]
+        future = self._submit_call(name, kwargs)
+        if info['pending'] is future and info['process_pv'].hasAsyncWrite():
+            # Joined the call the pending put is waiting on: this put will
+            # be postponed, then retried when that call completes
+            return future
+
+        info['pending'] = future
+        future.add_done_callback(functools.partial(self._async_finished,
+                                                   name))
+        return future
+
+    def _async_finished(self, name, future):
+        info = self._functions[name]
+        if info['pending'] is not future:
+            # A later call is still running
+            return
+
+        info['pending'] = None
+        if future.aborted is not None:
+            info['process_pv'].async_done(AsyncCancelled.ret)
+        else:
             info['process_pv'].async_done()
 
-        return ret
+    def request(self, name, req_id, **overrides):
+        '''Start a call identified by `req_id`
 
-    def _run_async(self, name, **kwargs):
-        '''Run a function asynchronously, in a separate thread'''
-        thread = epics.ca.CAThread(target=self._run_function,
-                                   args=(name, ), kwargs=kwargs)
-        self._async_threads[name] = thread
-        thread.start()
+        Parameters are taken from the PVs now, updated with `overrides`.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+
+        Raises
+        ------
+        RequestIdError
+            If a request with the same ID is still in progress
+        QueueFullError
+            If `max_requests` requests are already in progress
+        '''
+        if self._max_requests <= 0:
+            raise RuntimeError('Request-ID calls not enabled')
+
+        requests = self._functions[name]['requests']
+        with self._flight_lock:
+            # Checked and registered together, so concurrent requests cannot
+            # both pass the checks
+            in_progress = [id_ for id_, future in requests.items()
+                           if not future.done()]
+            if req_id in in_progress:
+                raise RequestIdError('Request {} in progress'.format(req_id))
+            elif len(in_progress) >= self._max_requests:
+                raise QueueFullError('{} requests in progress'
+                                     ''.format(len(in_progress)))
+
+            future = self._submit(name, **overrides)
+            requests.pop(req_id, None)
+            requests[req_id] = future
+
+            # Drop the oldest completed results
+            for id_ in list(requests.keys()):
+                if len(requests) <= self._max_requests:
+                    break
+                elif requests[id_].done():
+                    del requests[id_]
+
+        future.add_done_callback(functools.partial(self._request_done, name,
+                                                   req_id))
+        return future
+
+    def get_result(self, name, req_id, timeout=None):
+        '''Wait for the result of the call identified by `req_id`
+
+        Raises
+        ------
+        KeyError
+            If the request is unknown (or its result has been dropped)
+        concurrent.futures.TimeoutError
+        '''
+        return self._functions[name]['requests'][req_id].result(timeout)
+
+    def _request_status(self, name, req_id):
+        future = self._functions[name]['requests'].get(req_id, None)
+        if future is None:
+            return 'Unknown', None
+        elif not future.done():
+            return 'Pending', None
+        elif future.cancelled() or future.exception() is not None:
+            return 'Failed', None
+
+        ret = future.result()
+        if ret is None:
+            # Errors are reported through the status PV and failed_cb
+            return 'Failed', None
+        return 'Done', ret
+
+    def _update_request_pvs(self, name, req_id):
+        '''Show a request on the ReqVal and ReqSts PVs'''
+        pv_dict = self._functions[name]['param_dict']
+        status, ret = self._request_status(name, req_id)
+        if ret is not None:
+            pv_dict['req_val'].value = ret
+        pv_dict['req_status'].value = status
+
+    def _request_done(self, name, req_id, future):
+        pv_dict = self._functions[name].get('param_dict', {})
+        if 'req_id' in pv_dict and pv_dict['req_id'].value == req_id:
+            self._update_request_pvs(name, req_id)
+
+    def _call_written(self, name, value=None, **kwargs):
+        '''[CAS callback] A request ID was written to the Call PV'''
+        self.request(name, int(value))
+
+    def _req_id_written(self, name, value=None, **kwargs):
+        '''[CAS callback] A request ID was written to the ReqId PV'''
+        pv_dict = self._functions[name]['param_dict']
+        pv_dict['req_id'].value = int(value)
+        self._update_request_pvs(name, int(value))
+
+    def batch(self, name, count=None, **overrides):
+        '''Call the function for each point of a batch
+
+        Inputs for the numeric parameters come from the Batch:<param>
+        waveforms, unless given as arrays in `overrides`; other parameters
+        are the same for every point.
+
+        Parameters
+        ----------
+        count : int, optional
+            Number of points (defaults to the length of the input arrays
+            given, or else the Batch:N PV)
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            Completes with the array of results, once they have been posted
+            to Batch:Val, or None if the batch failed (see `failed_cb`)
+        '''
+        if self._batch_size <= 0:
+            raise RuntimeError('Batch calls not enabled')
+
+        info = self._functions[name]
+        pv_dict = info.get('param_dict', {})
+
+        arrays = {}
+        given = []
+        for param in info['batch_params']:
+            if param in overrides:
+                arrays[param] = np.asarray(overrides.pop(param)).reshape(-1)
+                given.append(len(arrays[param]))
+            else:
+                arrays[param] = pv_dict['batch:%s' % param].value
+
+        if count is None:
+            if given:
+                count = min(given)
+            elif 'batch_count' in pv_dict:
+                count = pv_dict['batch_count'].value
+            else:
+                raise ValueError('Batch size not specified')
+
+        count = int(count)
+        if not 0 < count <= self._batch_size:
+            raise ValueError('Batch size must be between 1 and {}'
+                             ''.format(self._batch_size))
+
+        kwargs = self.get_kwargs(name, **overrides)
+        for param, array in arrays.items():
+            if len(array) < count:
+                raise ValueError('Too few inputs for {}'.format(param))
+            kwargs[param] = array[:count]
+
+        if self._vectorized:
+            call = self._start_call(name, kwargs)
+        else:
+            call = self._map_batch(name, count, kwargs)
+
+        future = self._track_call(call)
+        call.add_done_callback(functools.partial(self._batch_done, name,
+                                                 count, kwargs, future))
+        return future
+
+    def _map_batch(self, name, count, kwargs):
+        '''Split the points of a batch across the executor workers'''
+        info = self._functions[name]
+        batch_params = info['batch_params']
+        casts = dict((param, type(info['defaults'][i]))
+                     for i, param in enumerate(info['parameters'])
+                     if param in batch_params)
+
+        points = []
+        for i in range(count):
+            point = dict(kwargs)
+            for param in batch_params:
+                point[param] = casts[param](kwargs[param][i])
+            points.append(point)
+
+        if info['coroutine'] or info['async_generator']:
+            calls = [self._start_call(name, point) for point in points]
+            call = _gather(calls)
+            call.abort = functools.partial(_abort_calls, calls)
+            return call
+
+        executor = self.executor
+        chunk_size = -(-count // executor.max_workers)
+        chunks = [points[i:i + chunk_size]
+                  for i in range(0, count, chunk_size)]
+
+        submitted = stats.clock()
+        submit = self._submit_fcn(executor)
+        if self._executor == 'process':
+            key = function_key(info['function'])
+            calls = [submit(map_function, key, chunk) for chunk in chunks]
+        else:
+            calls = [submit(self._call_chunk, name, chunk)
+                     for chunk in chunks]
+
+        for chunk_call in calls:
+            chunk_call.abort = functools.partial(executor.cancel, chunk_call)
+            self._record_stats(name, chunk_call, submitted)
+
+        call = Future()
+        call.set_running_or_notify_cancel()
+        call.abort = functools.partial(_abort_calls, calls)
+
+        def gathered(results):
+            try:
+                call.set_result([ret for chunk in results.result()
+                                 for ret in chunk])
+            except BaseException as ex:
+                call.set_exception(ex)
+
+        _gather(calls).add_done_callback(gathered)
+        return call
+
+    def _call_chunk(self, name, points):
+        '''Call a (plain) function for each of a list of points'''
+        return [self._call_function(name, point) for point in points]
+
+    def _batch_done(self, name, count, kwargs, future, call):
+        info = self._functions[name]
+        try:
+            error = self._call_error(future, call)
+            if error is not None:
+                raise error
+
+            results = np.asarray(call.result(), dtype=np.float64).reshape(-1)
+            if len(results) != count:
+                raise ValueError('Expected {} results, got {}'
+                                 ''.format(count, len(results)))
+        except BaseException as ex:
+            self._failed(name, 'Batch: %s: %s (%s)' % (ex.__class__.__name__,
+                                                        ex, name),
+                         ex, kwargs)
+            future.set_result(None)
+            return
+
+        pv_dict = info.get('param_dict', {})
+        if 'batch_retval' in pv_dict:
+            value = np.zeros(self._batch_size, dtype=np.float64)
+            value[:count] = results
+            pv_dict['batch_retval'].value = value
+
+        future.set_result(results)
+
+    def _batch_written(self, name, **kwargs):
+        '''[CAS callback] Batch:Proc was written to'''
+        info = self._functions[name]
+        batch_pv = info['param_dict']['batch_process']
+        if info['batch_pending'] is not None and batch_pv.hasAsyncWrite():
+            # Postponed until the running batch completes, then retried
+            raise AsyncCompletion()
+
+        future = self.batch(name)
+        info['batch_pending'] = future
+        future.add_done_callback(functools.partial(self._batch_finished,
+                                                   name))
+        raise AsyncCompletion()
+
+    def _batch_finished(self, name, future):
+        info = self._functions[name]
+        if info['batch_pending'] is not future:
+            return
+
+        info['batch_pending'] = None
+        if future.aborted is not None:
+            info['param_dict']['batch_process'].async_done(AsyncCancelled.ret)
+        else:
+            info['param_dict']['batch_process'].async_done()
 
     def get_kwargs(self, name, **override):
         '''Get the keyword arguments to be passed to the function.
@@ -277,14 +1370,25 @@ class PypvFunction(object):
         @functools.wraps(fcn)
         def wrapped_sync(**cas_kw):
             # Block until async request finishes
-            while name in self._async_threads:
-                time.sleep(0.05)
+            future = self._functions[name]['pending']
+            if future is not None:
+                futures.wait([future])
+
+            hit, ret = self._cached(name, self.get_kwargs(name))
+            if hit:
+                return ret
 
             return self._run_function(name)
 
         @functools.wraps(fcn)
         def wrapped_async(**cas_kw):
-            self._run_async(name)
+            kwargs = self.get_kwargs(name)
+            hit, ret = self._cached(name, kwargs)
+            if hit:
+                # Answer the put immediately
+                return
+
+            self._run_async(name, kwargs)
             raise AsyncCompletion()
 
         if self._async:
@@ -292,11 +1396,26 @@ class PypvFunction(object):
         else:
             wrapped = wrapped_sync
 
-        spec = inspect.getargspec(fcn)
-        args, var_args, var_kws, defaults = spec
-        if (args and len(args) != len(defaults)) or var_args:
+        (args, var_args, var_kws, defaults, kwonly_args,
+         kwonly_defaults) = _getargspec(fcn)
+        defaults = list(defaults or [])
+        if (len(args) != len(defaults) or var_args or
+                set(kwonly_args) - set(kwonly_defaults)):
             raise ValueError('All arguments must have defaults')
 
+        args = list(args) + list(kwonly_args)
+        defaults += [kwonly_defaults[arg] for arg in kwonly_args]
+
+        if self._executor == 'process' and inspect.isgeneratorfunction(fcn):
+            raise ValueError('Generator functions cannot run in worker '
+                             'processes')
+        elif not self._async and (self._executor == 'process' or
+                                  _is_coroutine_function(fcn) or
+                                  _is_async_generator_function(fcn)):
+            raise ValueError('Coroutine functions, and functions run in '
+                             'worker processes, require async_=True and '
+                             'use_process=True')
+
         name = fcn.__name__
         if name in self._functions:
             raise ValueError('Function already registered')
@@ -312,6 +1431,28 @@ class PypvFunction(object):
         info['defaults'] = [default for param, default in parameters]
         info['function'] = fcn
         info['wrapped'] = wrapped
+        info['pending'] = None
+        info['batch_pending'] = None
+        info['batch_params'] = [
+            param for param, default in parameters
+            if isinstance(default, numbers.Real) and
+            not isinstance(default, bool)]
+        info['requests'] = OrderedDict()
+        # Calls in progress, which may be aborted
+        info['in_flight'] = set()
+        info['coroutine'] = _is_coroutine_function(fcn)
+        info['generator'] = inspect.isgeneratorfunction(fcn)
+        info['async_generator'] = _is_async_generator_function(fcn)
+        # Generator results are posted as they are yielded
+        info['streaming'] = info['generator'] or info['async_generator']
+        info['stats'] = stats.FunctionStats()
+        if self._cache_size > 0:
+            info['cache'] = _ResultCache(self._cache_size, self._cache_ttl)
+        else:
+            info['cache'] = None
+        if self._executor == 'process':
+            register_function(fcn)
+
         self._add_fcn(name)
 
         wrapped_sync.wrapper = self
@@ -323,6 +1464,23 @@ class PypvFunction(object):
         def get_pv(pv):
             return self.get_pv_instance(name, pv)
 
+        def submit(**overrides):
+            '''Call the function on its executor, with parameters from the
+            PVs and `overrides`
+
+            Returns
+            -------
+            future : concurrent.futures.Future
+            '''
+            return self._submit(name, **overrides)
+
         wrapped_sync.get_pvnames = get_pvnames
         wrapped_sync.get_pv = get_pv
+        wrapped_sync.submit = submit
+        wrapped_sync.clear_cache = functools.partial(self.clear_cache, name)
+        wrapped_sync.request = functools.partial(self.request, name)
+        wrapped_sync.get_result = functools.partial(self.get_result, name)
+        wrapped_sync.batch = functools.partial(self.batch, name)
+        wrapped_sync.abort = functools.partial(self.abort, name)
+        wrapped_sync.stats = info['stats']
         return wrapped_sync
@@ -0,0 +1,189 @@
+# vi: ts=4 sw=4
+'''
+:mod:`pypvserver.history` - PV value history
+============================================
+
+.. module:: pypvserver.history
+   :synopsis: Fixed-size ring buffers of recent PV values, and waveform PVs
+              publishing them
+'''
+
+from __future__ import print_function
+
+import threading
+import logging
+
+import numpy as np
+
+from .pv import PyPV
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between the POSIX and EPICS (1990-01-01) epochs
+EPICS_EPOCH = 631152000
+
+
+def epics_to_posix(timestamp):
+    '''An EPICS timestamp (cas.epicsTimeStamp), in POSIX seconds'''
+    return (timestamp.secPastEpoch + EPICS_EPOCH) + timestamp.nsec * 1e-9
+
+
+class History(object):
+    '''A ring buffer of (timestamp, value, severity) entries
+
+    Once `capacity` entries have been recorded, each new entry replaces the
+    oldest. The queries return entries oldest first, as a tuple of arrays
+    `(timestamps, values, severities)`, with POSIX timestamps.
+
+    Parameters
+    ----------
+    capacity : int
+        Maximum number of entries kept
+    dtype : np.dtype, optional
+        Value type
+    '''
+
+    def __init__(self, capacity, dtype=np.float64):
+        capacity = int(capacity)
+        if capacity <= 0:
+            raise ValueError('History capacity must be positive')
+
+        self.capacity = capacity
+        self._time = np.zeros(capacity, dtype=np.float64)
+        self._value = np.zeros(capacity, dtype=dtype)
+        self._severity = np.zeros(capacity, dtype=np.int16)
+        self._next = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, value, severity=0):
+        '''Record an entry'''
+        with self._lock:
+            i = self._next
+            self._time[i] = timestamp
+            self._value[i] = value
+            self._severity[i] = severity
+            self._next = (i + 1) % self.capacity
+            if self._count < self.capacity:
+                self._count += 1
+
+    def clear(self):
+        '''Remove all entries'''
+        with self._lock:
+            self._next = 0
+            self._count = 0
+
+    def _ordered(self, n=None):
+        '''The last `n` entries (all by default), oldest first'''
+        with self._lock:
+            count = self._count
+            if n is None or n > count:
+                n = count
+
+            start = (self._next - n) % self.capacity
+            if start + n <= self.capacity:
+                idx = slice(start, start + n)
+                return (self._time[idx].copy(), self._value[idx].copy(),
+                        self._severity[idx].copy())
+
+            idx = np.arange(start, start + n) % self.capacity
+            return (self._time[idx], self._value[idx], self._severity[idx])
+
+    def last(self, n=None):
+        '''The last `n` entries (all of them by default)'''
+        if n is not None and n <= 0:
+            return self._ordered(0)
+
+        return self._ordered(n)
+
+    def range(self, start=None, stop=None):
+        '''Entries with `start <= timestamp < stop` (either may be None)'''
+        times, values, severities = self._ordered()
+        lo = (np.searchsorted(times, start, side='left')
+              if start is not None else 0)
+        hi = (np.searchsorted(times, stop, side='left')
+              if stop is not None else len(times))
+        return times[lo:hi], values[lo:hi], severities[lo:hi]
+
+    def decimate(self, n, start=None, stop=None):
+        '''At most `n` entries summarizing a range (see `range`)
+
+        The entries are split into `n` consecutive bins, each giving the
+        time of its last entry, the mean value and the highest severity.
+        '''
+        times, values, severities = self.range(start, stop)
+        count = len(times)
+        n = int(n)
+        if n <= 0:
+            return times[:0], values[:0], severities[:0]
+        elif count <= n:
+            return times, values, severities
+
+        edges = np.linspace(0, count, n + 1).astype(np.intp)
+        starts, sizes = edges[:-1], np.diff(edges)
+        means = np.add.reduceat(values.astype(np.float64), starts) / sizes
+        return (times[edges[1:] - 1], means,
+                np.maximum.reduceat(severities, starts))
+
+
+class HistoryWaveform(PyPV):
+    '''A waveform PV publishing one column of a :class:`History`
+
+    The value is refreshed from the history whenever it is read, with the
+    most recent `count` entries, oldest first, zero-padded.
+
+    Parameters
+    ----------
+    name : str
+        The PV name
+    history : History
+        The history to publish
+    column : {'time', 'value', 'severity', 'count'}
+        What to publish; 'count' is a scalar with the number of entries in
+        the waveforms
+    size : int
+        Number of elements
+    '''
+
+    _columns = ('time', 'value', 'severity')
+
+    def __init__(self, name, history, column, size, **kwargs):
+        self._source = history
+        self._column = column
+        self._size = int(size)
+        if column == 'count':
+            value = 0
+        elif column in self._columns:
+            dtype = (np.float64 if column != 'severity' else np.int16)
+            value = np.zeros(self._size, dtype=dtype)
+        else:
+            raise ValueError('Unknown history column: %s' % column)
+
+        PyPV.__init__(self, name, value, **kwargs)
+
+    @property
+    def source(self):
+        '''The published history'''
+        return self._source
+
+    def refresh(self):
+        '''Update the value from the history (without posting it)'''
+        history = self._source
+        if self._column == 'count':
+            self._value = min(len(history), self._size)
+            return
+
+        entries = history.last(self._size)
+        column = entries[self._columns.index(self._column)]
+        value = np.zeros(self._size, dtype=self._value.dtype)
+        value[:len(column)] = column
+        self._value = value
+
+    def getValue(self, gdd):
+        '''Internal pcaspy function; do not use'''
+        self.refresh()
+        return PyPV.getValue(self, gdd)
@@ -0,0 +1,483 @@
+# vi: ts=4 sw=4
+'''
+:mod:`pypvserver.loader` - PV database loader
+=============================================
+
+.. module:: pypvserver.loader
+   :synopsis: Build many records at once from a declarative database (EPICS
+              .db-like, JSON or YAML), with macro substitution
+'''
+
+from __future__ import print_function
+
+import gc
+import json
+import os
+import re
+import logging
+
+import numpy as np
+
+from .pv import (PypvRecord, Limits)
+
+
+logger = logging.getLogger(__name__)
+
+_MACRO_RE = re.compile(r'\$(?:\(([^)=]+)(?:=([^)]*))?\)|'
+                       r'\{([^}=]+)(?:=([^}]*))?\})')
+
+_DB_TOKEN_RE = re.compile(r'''
+    (?P<space>\s+|\#[^\n]*) |
+    "(?P<string>(?:[^"\\]|\\.)*)" |
+    (?P<punct>[(){},]) |
+    (?P<word>[^\s(){},"\#]+)
+    ''', re.VERBOSE)
+
+_FTVL_TYPES = {'CHAR': np.int8,
+               'UCHAR': np.uint8,
+               'SHORT': np.int16,
+               'USHORT': np.uint16,
+               'LONG': np.int32,
+               'ULONG': np.uint32,
+               'FLOAT': np.float32,
+               'DOUBLE': np.float64,
+               }
+
+# record type -> kind of PV
+_RECORD_KINDS = {'ai': float,
+                 'ao': float,
+                 'calc': float,
+                 'calcout': float,
+                 'longin': int,
+                 'longout': int,
+                 'stringin': str,
+                 'stringout': str,
+                 'bi': 'binary',
+                 'bo': 'binary',
+                 'mbbi': 'multibit',
+                 'mbbo': 'multibit',
+                 'waveform': 'array',
+                 'aai': 'array',
+                 'aao': 'array',
+                 }
+
+_MBB_STATES = ('ZR', 'ON', 'TW', 'TH', 'FR', 'FV', 'SX', 'SV',
+               'EI', 'NI', 'TE', 'EL', 'TV', 'TT', 'FT', 'FF')
+
+# Fields which map onto PyPV settings rather than record fields
+_METADATA_FIELDS = set(['VAL', 'DESC', 'EGU', 'PREC', 'DRVH', 'DRVL',
+                        'HOPR', 'LOPR', 'HIHI', 'HIGH', 'LOW', 'LOLO',
+                        'SCAN', 'NELM', 'FTVL', 'ZNAM', 'ONAM', 'ZSV', 'OSV'] +
+                       ['%sST' % state for state in _MBB_STATES] +
+                       ['%sSV' % state for state in _MBB_STATES])
+
+# Fields only meaningful to an IOC, which are not served
+_IGNORED_FIELDS = set(['DTYP', 'INP', 'OUT', 'FLNK', 'PINI', 'PHAS', 'EVNT',
+                       'PRIO', 'TSE', 'TSEL', 'SDIS', 'DISV', 'DISS', 'ASG',
+                       'HHSV', 'HSV', 'LSV', 'LLSV', 'HYST', 'ADEL', 'MDEL',
+                       'CALC', 'INPA', 'INPB', 'INPC', 'INPD', 'OOPT', 'DOPT',
+                       'OCAL', 'SIML', 'SIOL', 'SIMS', 'UDF'])
+
+
+def substitute(text, macros):
+    '''Substitute $(NAME), ${NAME} and $(NAME=default) macros in text
+
+    Raises
+    ------
+    ValueError
+        If a macro without a default is not defined
+    '''
+    def replace(match):
+        if match.group(1) is not None:
+            name, default = match.group(1), match.group(2)
+        else:
+            name, default = match.group(3), match.group(4)
+
+        try:
+            return str(macros[name])
+        except KeyError:
+            if default is None:
+                raise ValueError('Undefined macro: %s' % name)
+            return default
+
+    return _MACRO_RE.sub(replace, text)
+
+
+def _tokenize_db(text):
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        match = _DB_TOKEN_RE.match(text, pos)
+        if match is None:
+            line = text.count('\n', 0, pos) + 1
+            raise ValueError('Unexpected character on line %d: %r'
+                             '' % (line, text[pos]))
+
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == 'space':
+            continue
+        elif kind == 'string':
+            value = re.sub(r'\\(.)', r'\1', match.group('string'))
+        else:
+            value = match.group(kind)
+
+        tokens.append((kind, value))
+
+    return tokens
+
+
+def parse_db(text):
+    '''Parse EPICS database text (after macro substitution)
+
+    Only record definitions are supported; `field` entries are collected and
+    `info` and `alias` entries are ignored.
+
+    Returns
+    -------
+    records : list
+        List of dictionaries with keys `type`, `name` and `fields`
+    '''
+    tokens = _tokenize_db(text)
+    records = []
+    idx = [0]
+
+    def next_token(expected=None):
+        try:
+            kind, value = tokens[idx[0]]
+        except IndexError:
+            raise ValueError('Unexpected end of database')
+
+        idx[0] += 1
+        if expected is not None and value != expected:
+            raise ValueError('Expected %r, got %r' % (expected, value))
+        return kind, value
+
+    def arguments():
+        next_token('(')
+        args = []
+        while True:
+            kind, value = next_token()
+            if kind != 'punct':
+                args.append(value)
+                kind, value = next_token()
+
+            if value == ')':
+                return args
+            elif value != ',':
+                raise ValueError('Expected "," or ")", got %r' % value)
+
+    while idx[0] < len(tokens):
+        kind, statement = next_token()
+        if statement not in ('record', 'grecord'):
+            raise ValueError('Unsupported database statement: %r' % statement)
+
+        args = arguments()
+        if len(args) != 2:
+            raise ValueError('record() takes a type and a name: %s' % args)
+
+        rtype, name = args
+        fields = {}
+        records.append(dict(type=rtype, name=name, fields=fields))
+
+        if idx[0] >= len(tokens) or tokens[idx[0]][1] != '{':
+            continue
+
+        next_token('{')
+        while True:
+            kind, item = next_token()
+            if item == '}':
+                break
+
+            args = arguments()
+            if item == 'field':
+                if len(args) != 2:
+                    raise ValueError('field() takes a name and a value: %s'
+                                     '' % args)
+                fields[args[0].upper()] = args[1]
+            elif item not in ('info', 'alias'):
+                raise ValueError('Unsupported record item: %r' % item)
+
+    return records
+
+
+def _parse_value(value):
+    '''Convert a database field string to an int or float, if possible'''
+    if not isinstance(value, str):
+        return value
+
+    for type_ in (int, float):
+        try:
+            return type_(value)
+        except ValueError:
+            pass
+
+    return value
+
+
+def _parse_scan(scan):
+    '''Convert a SCAN field ("1 second", "Passive", ...) to a period'''
+    if isinstance(scan, (int, float)):
+        return float(scan)
+
+    parts = str(scan).split()
+    if len(parts) == 2 and parts[1] in ('second', 'seconds'):
+        return float(parts[0])
+
+    return 0.0
+
+
+class _RecordType(object):
+    '''Type information shared by all records of the same type and layout
+
+    These are computed once per distinct type, rather than once per record.
+    '''
+
+    def __init__(self, rtype, fields):
+        try:
+            kind = _RECORD_KINDS[rtype]
+        except KeyError:
+            raise ValueError('Unsupported record type: %s' % rtype)
+
+        self.rtype = rtype
+        self.kind = kind
+        self.enums = None
+        self.minor_states = []
+        self.major_states = []
+
+        if kind == 'array':
+            ftvl = fields.get('FTVL', 'DOUBLE')
+            try:
+                self.dtype = np.dtype(_FTVL_TYPES[ftvl])
+            except KeyError:
+                raise ValueError('Unsupported FTVL: %s' % ftvl)
+            self.count = int(fields.get('NELM', 1))
+        elif kind in ('binary', 'multibit'):
+            if kind == 'binary':
+                states = (('ZNAM', 'ZSV', '0'), ('ONAM', 'OSV', '1'))
+            else:
+                states = [('%sST' % state, '%sSV' % state, None)
+                          for state in _MBB_STATES]
+
+            self.enums = []
+            for name_field, severity_field, default in states:
+                name = fields.get(name_field, default)
+                if name is None:
+                    continue
+
+                self.enums.append(name)
+                severity = fields.get(severity_field, 'NO_ALARM')
+                if severity == 'MINOR':
+                    self.minor_states.append(name)
+                elif severity == 'MAJOR':
+                    self.major_states.append(name)
+
+            if not self.enums:
+                self.enums = ['%d' % i for i in range(len(_MBB_STATES))]
+
+    @staticmethod
+    def key(rtype, fields):
+        '''Records with the same key share a _RecordType'''
+        kind = _RECORD_KINDS.get(rtype, None)
+        if kind == 'array':
+            return (rtype, fields.get('FTVL'), fields.get('NELM'))
+        elif kind == 'binary':
+            return (rtype, ) + tuple(fields.get(field) for field in
+                                     ('ZNAM', 'ONAM', 'ZSV', 'OSV'))
+        elif kind == 'multibit':
+            return (rtype, ) + tuple(fields.get('%s%s' % (state, suffix))
+                                     for state in _MBB_STATES
+                                     for suffix in ('ST', 'SV'))
+        return (rtype, )
+
+    def value(self, val):
+        '''Initial value for the record, given its VAL field (or None)'''
+        kind = self.kind
+        if kind == 'array':
+            value = np.zeros(self.count, dtype=self.dtype)
+            if val is not None:
+                if isinstance(val, str):
+                    val = json.loads(val)
+                val = np.asarray(val, dtype=self.dtype).flatten()
+                value[:val.size] = val[:self.count]
+            return value
+        elif self.enums is not None:
+            return list(self.enums)
+        elif val is None:
+            return kind()
+
+        return kind(val)
+
+    def enum_index(self, val):
+        '''Index of the initial enum state, given its VAL field'''
+        if val is None:
+            return 0
+        elif val in self.enums:
+            return self.enums.index(val)
+        return int(val)
+
+
+def _build_record(record, types):
+    '''Build one record, given the record types seen so far'''
+    rtype = record['type']
+    name = record['name']
+    fields = dict((key.upper(), value) for key, value in
+                  record.get('fields', {}).items())
+
+    key = _RecordType.key(rtype, fields)
+    try:
+        info = types[key]
+    except KeyError:
+        info = types[key] = _RecordType(rtype, fields)
+
+    val = fields.get('VAL', None)
+    limits = Limits(lolim=fields.get('DRVL', fields.get('LOPR', 0.0)),
+                    hilim=fields.get('DRVH', fields.get('HOPR', 0.0)),
+                    hihi=fields.get('HIHI', 0.0),
+                    lolo=fields.get('LOLO', 0.0),
+                    high=fields.get('HIGH', 0.0),
+                    low=fields.get('LOW', 0.0))
+
+    pv = PypvRecord(name, info.value(val), rtype=rtype,
+                    desc=fields.get('DESC', ''),
+                    precision=int(fields.get('PREC', 1)),
+                    units=fields.get('EGU', ''),
+                    limits=limits,
+                    scan=_parse_scan(fields.get('SCAN', 0.0)),
+                    minor_states=info.minor_states,
+                    major_states=info.major_states)
+
+    if info.enums is not None:
+        pv.value = info.enum_index(val)
+
+    for field, value in fields.items():
+        if field not in _METADATA_FIELDS and field not in _IGNORED_FIELDS:
+            # Created on first use
+            pv.defer_field(field, _parse_value(value))
+
+    return pv
+
+
+def build_records(records, server=None):
+    '''Build records from parsed database entries
+
+    Only the record PVs are created up front: the PVs of the other fields
+    (RTYP, DESC, ...) are created when first used (see
+    `PypvRecord.defer_field`).
+
+    Parameters
+    ----------
+    records : sequence
+        Dictionaries with keys `type`, `name` and (optionally) `fields`
+    server : PypvServer, optional
+        Add all of the records to this server, at once
+
+    Returns
+    -------
+    records : list of PypvRecord
+    '''
+    types = {}
+
+    # The cyclic garbage collector would otherwise repeatedly scan all of
+    # the records built so far
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        built = [_build_record(record, types) for record in records]
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    logger.debug('Built %d records (%d distinct types)', len(built),
+                 len(types))
+
+    if server is not None:
+        server.add_pvs(built)
+
+    return built
+
+
+def _parse_structured(data):
+    '''Records from a loaded JSON/YAML document'''
+    if isinstance(data, dict):
+        data = data.get('records', [])
+
+    records = []
+    for record in data:
+        if 'type' not in record or 'name' not in record:
+            raise ValueError('Records require a type and a name: %s' % record)
+        records.append(record)
+
+    return records
+
+
+def parse(text, format='db', macros=None):
+    '''Parse a database in the given format, after macro substitution
+
+    Parameters
+    ----------
+    text : str
+        The database
+    format : {'db', 'json', 'yaml'}, optional
+        The database format
+    macros : dict, optional
+        Macros to substitute
+
+    Returns
+    -------
+    records : list
+        List of dictionaries with keys `type`, `name` and `fields`
+    '''
+    text = substitute(text, macros or {})
+
+    if format == 'db':
+        return parse_db(text)
+    elif format == 'json':
+        return _parse_structured(json.loads(text))
+    elif format == 'yaml':
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError('PyYAML is required to load YAML databases')
+
+        return _parse_structured(yaml.safe_load(text))
+
+    raise ValueError('Unknown database format: %s' % format)
+
+
+_FORMATS = {'.db': 'db',
+            '.template': 'db',
+            '.vdb': 'db',
+            '.json': 'json',
+            '.yaml': 'yaml',
+            '.yml': 'yaml',
+            }
+
+
+def load_database(filename, server=None, macros=None, format=None):
+    '''Load a database file, building all of its records
+
+    Parameters
+    ----------
+    filename : str
+        The database filename
+    server : PypvServer, optional
+        Add all of the records to this server, at once
+    macros : dict, optional
+        Macros to substitute, e.g. {'P': 'PREFIX:'}
+    format : {'db', 'json', 'yaml'}, optional
+        The database format (defaults to guessing from the file extension)
+
+    Returns
+    -------
+    records : list of PypvRecord
+    '''
+    if format is None:
+        ext = os.path.splitext(filename)[1].lower()
+        format = _FORMATS.get(ext, 'db')
+
+    with open(filename) as f:
+        text = f.read()
+
+    return build_records(parse(text, format=format, macros=macros),
+                         server=server)
@@ -0,0 +1,162 @@
+# vi: ts=4 sw=4
+'''
+:mod:`pypvserver.monitor` - Server self-monitoring
+==================================================
+
+.. module:: pypvserver.monitor
+   :synopsis: PVs publishing the health and load of the channel access server
+'''
+
+from __future__ import print_function
+
+import threading
+import logging
+
+from .pv import PyPV
+from . import stats
+
+
+logger = logging.getLogger(__name__)
+
+
+class ServerMonitor(object):
+    '''Publishes server health PVs under `<server prefix><prefix>`
+
+    Counters are maintained incrementally by the server and its PVs (see
+    :class:`pypvserver.stats.ServerCounters`); every `period` seconds they
+    are turned into rates and posted.
+
+    ========================= ===========================================
+    PV                        Description
+    ========================= ===========================================
+    PVCount                   Number of PVs (and records) on the server
+    SearchHitRate             Searches answered "exists here", per second
+    SearchMissRate            Searches for other servers' PVs, per second
+    EventRate                 Monitor events posted, per second
+    WriteRate                 Channel access writes, per second
+    LoopPeriod                Mean process-loop iteration time,
+                              including the wait for events (about
+                              0.1 s when idle)
+    ScanOverruns              Scans which took longer than their period
+    AsyncPending              Asynchronous writes in progress
+    ========================= ===========================================
+
+    Parameters
+    ----------
+    server : PypvServer
+        The server to monitor and add the PVs to
+    prefix : str, optional
+        Prefix for the monitoring PVs, after the server prefix
+    period : float, optional
+        Update period, in seconds
+    start : bool, optional
+        Start updating now
+    '''
+
+    def __init__(self, server, prefix='SERVER:', period=1.0, start=True):
+        self._server = server
+        self._prefix = str(prefix)
+        self._period = float(period)
+        self._thread = None
+        self._running = False
+        self._last = None
+
+        def add(name, value, **kwargs):
+            return PyPV(''.join((self._prefix, name)), value, server=server,
+                        **kwargs)
+
+        self.pv_count = add('PVCount', 0)
+        self.search_hit_rate = add('SearchHitRate', 0.0, units='1/s')
+        self.search_miss_rate = add('SearchMissRate', 0.0, units='1/s')
+        self.event_rate = add('EventRate', 0.0, units='1/s')
+        self.write_rate = add('WriteRate', 0.0, units='1/s')
+        self.loop_period = add('LoopPeriod', 0.0, units='s', precision=6)
+        self.scan_overruns = add('ScanOverruns', 0)
+        self.async_pending = add('AsyncPending', 0)
+
+        if start:
+            self.start()
+
+    @property
+    def pvs(self):
+        '''All monitoring PVs'''
+        return [self.pv_count, self.search_hit_rate, self.search_miss_rate,
+                self.event_rate, self.write_rate, self.loop_period,
+                self.scan_overruns, self.async_pending]
+
+    def _snapshot(self):
+        counters = self._server.counters
+        period = counters.loop_period
+        snap = counters.snapshot()
+        snap['time'] = stats.clock()
+        snap['loop_count'] = period.count
+        snap['loop_total'] = period.total
+        return snap
+
+    def update(self):
+        '''Recalculate rates and update the PVs'''
+        snap = self._snapshot()
+        last, self._last = self._last, snap
+
+        self.pv_count.value = len(self._server._pvs)
+        self.scan_overruns.value = snap['scan_overruns']
+        self.async_pending.value = snap['async_pending']
+
+        if last is None:
+            return
+
+        dt = snap['time'] - last['time']
+        if dt <= 0.0:
+            return
+
+        def rate(key):
+            return (snap[key] - last[key]) / dt
+
+        self.search_hit_rate.value = rate('search_hits')
+        self.search_miss_rate.value = rate('search_misses')
+        self.event_rate.value = rate('events')
+        self.write_rate.value = rate('writes')
+
+        loops = snap['loop_count'] - last['loop_count']
+        if loops > 0:
+            self.loop_period.value = ((snap['loop_total'] -
+                                       last['loop_total']) / loops)
+
+    def _update_loop(self):
+        while self._running:
+            try:
+                self.update()
+            except Exception as ex:
+                logger.error('Server monitor update failed: %s', ex,
+                             exc_info=ex)
+
+            self._stop_event.wait(self._period)
+
+    def start(self):
+        '''Start periodically updating the PVs'''
+        if self._thread is not None:
+            return
+
+        self._running = True
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._update_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, wait=True):
+        '''Stop updating the PVs'''
+        if self._thread is None:
+            return
+
+        self._running = False
+        self._stop_event.set()
+        if wait:
+            self._thread.join()
+        self._thread = None
+
+    def remove(self):
+        '''Stop updating and remove the PVs from the server'''
+        self.stop()
+        for pv in self.pvs:
+            if pv.server is not None:
+                self._server.remove_pv(pv)
@@ -9,10 +9,16 @@
 
 from __future__ import print_function
 
+import functools
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+
 from .pv import PypvRecord
-from .errors import AsyncCompletion
-# from ophyd.positioner import (Positioner, )
-# from ophyd.pseudopos import (PseudoPositioner, )
+from .errors import (AsyncCompletion, AsyncCancelled)
+from .executor import scheduler
+from . import stats
 
 
 STATUS_BITS = {'direction': 0,         # last raw direction; (0:Negative, 1:Positive)
@@ -33,6 +39,61 @@ STATUS_BITS = {'direction': 0,         # last raw direction; (0:Negative, 1:Posi
                }
 
 
+class MoveStatus(Future):
+    '''Completion of a motor move
+
+    A :class:`concurrent.futures.Future` which completes with the final
+    position when the move is done, is stopped or is replaced by another
+    move. Channel access put completion is driven by the same object, so
+    Python callers can wait on it or attach callbacks instead of polling
+    DMOV.
+
+    Parameters
+    ----------
+    motor : PypvMotor
+        The motor being moved
+    target : float
+        The requested position
+    start : float, optional
+        The position at the start of the move
+
+    Attributes
+    ----------
+    motor : PypvMotor
+    target : float
+    start : float
+    stopped : bool
+        The move was stopped before reaching the target
+    '''
+
+    def __init__(self, motor, target, start=None):
+        Future.__init__(self)
+        self.motor = motor
+        self.target = target
+        self.start = start
+        self.stopped = False
+        self.set_running_or_notify_cancel()
+
+    def wait(self, timeout=None):
+        '''Wait for the move to complete
+
+        Returns
+        -------
+        position : float
+            The final position
+        '''
+        return self.result(timeout)
+
+    def _finish(self, position):
+        if not self.done():
+            self.set_result(position)
+
+    def __repr__(self):
+        return ('{0}({1.motor.name!r}, target={1.target!r}, '
+                'done={2})'.format(self.__class__.__name__, self,
+                                   self.done()))
+
+
 class PypvMotor(PypvRecord):
     '''A fake EPICS motor record, made available to EPICS by the built-in
     channel access server.
@@ -47,6 +108,40 @@ class PypvMotor(PypvRecord):
         The ophyd :class:`Positioner` to expose to EPICS
     tweak_value : float
         The default tweak value
+    rbv_rate : float, optional
+        Maximum rate at which readbacks are posted to RBV, in updates per
+        second (0 for no limit). The latest readback is posted once the
+        interval has passed.
+    rbv_deadband : float, optional
+        Readbacks within this distance of the last posted RBV are not
+        posted
+    trajectory_size : int, optional
+        Enable fly-scan trajectories of up to this many points (see
+        `run_trajectory`)
+    capture_chunk : int, optional
+        During a trajectory, post the capture buffer every this many
+        points (0 to post it only at the end)
+
+    The final position is always posted to RBV when a move completes,
+    regardless of `rbv_rate` and `rbv_deadband`.
+
+    Every move (a put to VAL, a TWF or TWR tweak, or a SET calibration) is
+    tracked by a :class:`MoveStatus`, which also completes the put of the
+    field written to. While SET is 1, a put to VAL redefines the current
+    position instead of moving.
+
+    With a `trajectory_size`, the record gets these fields:
+
+    ====== ==============================================================
+    Field  Description
+    ====== ==============================================================
+    TTIM   Time of each point, in seconds from the start
+    TPOS   Position of each point
+    TNPT   Number of points to run
+    TGO    A put starts the trajectory, completing when it is done
+    TCAP   Actual position captured at the time of each point
+    TCNT   Number of points captured
+    ====== ==============================================================
     '''
 
     _rtype = 'motor'
@@ -63,13 +158,32 @@ class PypvMotor(PypvRecord):
     _fld_high_lim = 'HLS'
     _fld_calib_set = 'SET'
     _fld_limit_viol = 'LVIO'
+    _fld_traj_time = 'TTIM'
+    _fld_traj_pos = 'TPOS'
+    _fld_traj_npts = 'TNPT'
+    _fld_traj_go = 'TGO'
+    _fld_traj_capture = 'TCAP'
+    _fld_traj_count = 'TCNT'
 
     def __init__(self, name, positioner, tweak_value=1.0, timeout=10.0,
-                 desc=None, **kwargs):
+                 desc=None, rbv_rate=0.0, rbv_deadband=0.0,
+                 trajectory_size=0, capture_chunk=0, **kwargs):
 
         self._pos = positioner
         self._status = 0
+        self.move_status = None
         self._timeout = timeout
+        self._rbv_interval = 1.0 / rbv_rate if rbv_rate > 0.0 else 0.0
+        self._rbv_deadband = abs(float(rbv_deadband))
+        self._rbv_lock = threading.Lock()
+        self._rbv_pending = None
+        self._rbv_posted = None
+        self._rbv_time = None
+        self._rbv_flush = None
+        self._traj_size = int(trajectory_size)
+        self._traj_chunk = int(capture_chunk)
+        self._traj_lock = threading.RLock()
+        self._trajectory = None
 
         if desc is None:
             desc = positioner.name
@@ -93,12 +207,28 @@ class PypvMotor(PypvRecord):
         self.add_field(self._fld_calib_set, 0)
         self.add_field(self._fld_limit_viol, 0)
 
+        if self._traj_size > 0:
+            size = self._traj_size
+            self.add_field(self._fld_traj_time, np.zeros(size))
+            self.add_field(self._fld_traj_pos, np.zeros(size))
+            self.add_field(self._fld_traj_npts, 0)
+            self.add_field(self._fld_traj_go, 0,
+                           written_cb=self._trajectory_written)
+            self.add_field(self._fld_traj_capture, np.zeros(size))
+            self.add_field(self._fld_traj_count, 0)
+
         # self._pos.subscribe(self._move_started, event_type=self._pos.SUB_START,
         #                     run=False)
         # self._pos.subscribe(self._move_done, event_type=self._pos.SUB_DONE,
         #                     run=False)
-        self._pos.subscribe(self._readback_updated,
-                            event_type=self._pos.SUB_READBACK)
+        attach_record = getattr(self._pos, 'attach_record', None)
+        if attach_record is not None:
+            # Readbacks are pushed in batches (see SimMotorFarm)
+            attach_record(self)
+            self._readback_updated(value=self._pos.position)
+        else:
+            self._pos.subscribe(self._readback_updated,
+                                event_type=self._pos.SUB_READBACK)
 
         self._update_status(moving=0)
 
@@ -110,14 +240,88 @@ class PypvMotor(PypvRecord):
         if status or severity:
             return
 
-        if self._check_limits(value):
-            self._move_started()
-            st = self._pos.move(value, wait=False, timeout=self._timeout,
-                                moved_cb=self._move_done,
-                                )
+        if self[self._fld_calib_set].value:
+            self.set_position(value)
+            return
 
-            self.move_status = st
-            raise AsyncCompletion()
+        try:
+            st = self.move(value)
+        except ValueError:
+            return
+
+        st.add_done_callback(lambda st: self.async_done())
+        raise AsyncCompletion()
+
+    def move(self, position, moved_cb=None, wait=False, timeout=None):
+        '''Start moving the positioner to `position`
+
+        Parameters
+        ----------
+        position : float
+            The target position
+        moved_cb : callable, optional
+            Called (with `obj`, this motor) when the move completes
+        wait : bool, optional
+            Block until the move completes
+        timeout : float, optional
+            With `wait`, the maximum time to wait
+
+        Returns
+        -------
+        status : MoveStatus
+
+        Raises
+        ------
+        ValueError
+            If the position is outside of the limits
+        '''
+        if not self._check_limits(position):
+            raise ValueError('%s: position %s outside of limits %s'
+                             '' % (self.name, position, self._pos.limits))
+
+        st = MoveStatus(self, position, self._pos.position)
+        previous, self.move_status = self.move_status, st
+        if previous is not None:
+            # Replaced by this move
+            previous._finish(self._pos.position)
+
+        if moved_cb is not None:
+            st.add_done_callback(lambda st: moved_cb(obj=self))
+
+        self._move_started()
+        self._pos.move(position, wait=False, timeout=self._timeout,
+                       moved_cb=functools.partial(self._move_done, st))
+
+        if wait:
+            st.wait(timeout)
+
+        return st
+
+    def set_position(self, position):
+        '''Redefine the current position, without moving (SET
+        calibration)
+
+        Returns
+        -------
+        status : MoveStatus
+            Already complete
+
+        Raises
+        ------
+        ValueError
+            If the positioner does not support it
+        '''
+        set_position = getattr(self._pos, 'set_position', None)
+        if set_position is None:
+            raise ValueError('%s: positioner cannot set its position' %
+                             self.name)
+
+        st = MoveStatus(self, position, self._pos.position)
+        set_position(position)
+        self.value = position
+        self._motion_stopped()
+        st._finish(self._pos.position)
+        return st
 
     def _check_limits(self, pos):
         '''Check the position against the limits
@@ -149,53 +353,316 @@ class PypvMotor(PypvRecord):
         '''Performs a tweak of positioner by `amount`.
 
         The standard motor record behavior is to add the tweak value (.TWV)
-        onto the user-request value (.VAL) and move there.
+        onto the user-request value (.VAL) and move there. A tweak past a
+        limit does not move the motor or change .VAL.
+
+        Returns
+        -------
+        status : MoveStatus
+            The move, which has already failed with ValueError if the
+            position is outside of the limits
         '''
-        # pos = self._pos.position + amount
         pos = self.value + amount
+        try:
+            st = self.move(pos)
+        except ValueError as ex:
+            st = MoveStatus(self, pos, self._pos.position)
+            st.set_exception(ex)
+            return st
+
         self.value = pos
+        return st
 
-        if self._check_limits(pos):
-            self._pos.move(pos, wait=False, timeout=self._timeout)
-        # TODO: does this not use put completion?
+    def _tweak_written(self, field, direction):
+        '''Tweak, completing the put to `field` when the move is done'''
+        tweak_val = self[self._fld_tweak_val].value
+        st = self.tweak(direction * tweak_val)
+        if st.done():
+            return
+
+        field = self[field]
+        st.add_done_callback(lambda st: field.async_done())
+        raise AsyncCompletion()
 
     def tweak_reverse(self, **kwargs):
         '''[CAS callback] CA client requested to tweak reverse'''
-        tweak_val = self[self._fld_tweak_val].value
-        return self.tweak(-tweak_val)
+        return self._tweak_written(self._fld_tweak_rev, -1)
 
     def tweak_forward(self, **kwargs):
         '''[CAS callback] CA client requested to tweak forward'''
-        tweak_val = self[self._fld_tweak_val].value
-        return self.tweak(tweak_val)
+        return self._tweak_written(self._fld_tweak_fwd, 1)
 
     def _readback_updated(self, value=None, **kwargs):
         '''[Pos callback] Positioner readback value has been updated'''
-        self[self._fld_readback] = value
+        if not (self._rbv_interval or self._rbv_deadband):
+            self[self._fld_readback] = value
+            return
+
+        with self._rbv_lock:
+            self._rbv_pending = value
+            posted = self._rbv_posted
+            if (posted is not None and
+                    abs(value - posted) < self._rbv_deadband):
+                return
+
+            now = stats.clock()
+            if self._rbv_time is not None and self._rbv_interval:
+                wait = self._rbv_time + self._rbv_interval - now
+                if wait > 0.0:
+                    if self._rbv_flush is None:
+                        self._rbv_flush = scheduler.call_later(
+                            wait, self._flush_readback)
+                    return
+
+            self._post_readback(value, now)
+
+    def _readback_batch(self, value, timestamp):
+        '''[Pos callback] A readback pushed along with the others of a batch,
+        which share `timestamp`'''
+        if self._rbv_interval or self._rbv_deadband:
+            self._readback_updated(value=value)
+        else:
+            self.update_fields({self._fld_readback: value}, timestamp)
+
+    def _post_readback(self, value, now=None, post=True):
+        '''Post a readback to RBV (call with the readback lock held)
+
+        With `post` False, only the bookkeeping is done, as the caller is
+        to update RBV itself.
+        '''
+        if self._rbv_flush is not None:
+            scheduler.cancel(self._rbv_flush)
+            self._rbv_flush = None
+
+        self._rbv_pending = None
+        self._rbv_posted = value
+        self._rbv_time = now if now is not None else stats.clock()
+        if post:
+            self[self._fld_readback] = value
+
+    def _flush_readback(self):
+        '''[Scheduler callback] Post the readback held back by `rbv_rate`'''
+        with self._rbv_lock:
+            self._rbv_flush = None
+            value = self._rbv_pending
+            if value is not None and (self._rbv_posted is None or
+                                      abs(value - self._rbv_posted) >=
+                                      self._rbv_deadband):
+                self._post_readback(value)
 
     def _move_started(self, **kwargs):
         '''[Pos callback] Positioner motion has started'''
         self._update_status(moving=1)
 
-    def _move_done(self, **kwargs):
+    def _move_done(self, st=None, **kwargs):
         '''[Pos callback] Positioner motion has completed'''
-        self._update_status(moving=0)
-        self.async_done()
-        try:
-            self.value = self.move_status.target
-        except AttributeError:
-            pass
-        else:
+        self._motion_stopped()
+        if st is None:
+            return
+
+        if self.move_status is st:
             self.move_status = None
+            self.value = st.target
+
+        st._finish(self._pos.position)
+
+    def _motion_stopped(self, fields=None):
+        '''Update the status once the motion has ended'''
+        # The exact end point is posted along with DMOV, whatever the
+        # throttling
+        fields = dict(fields) if fields else {}
+        with self._rbv_lock:
+            position = self._pos.position
+            if (self._rbv_flush is not None or
+                    self[self._fld_readback].value != position):
+                self._post_readback(position, post=False)
+                fields[self._fld_readback] = position
+
+        self._update_status(fields=fields, moving=0)
 
     def stop(self):
-        '''Stop the positioner'''
+        '''Stop the positioner (and any trajectory)'''
+        with self._traj_lock:
+            traj = self._trajectory
+            if traj is not None and traj['entry'] is not None:
+                scheduler.cancel(traj['entry'])
+                traj['entry'] = None
+
+        st = self.move_status
+        if st is not None:
+            st.stopped = True
+
         self._pos.stop()
+        if traj is not None:
+            self._trajectory_done(traj)
+
+    def run_trajectory(self, times=None, positions=None):
+        '''Run a fly-scan trajectory
+
+        The positioner is moved through the points without any interaction,
+        reaching each position at its time. The actual position at each of
+        those times is recorded in the capture buffer (TCAP). Where the
+        positioner has a `velocity` attribute, it is set for each segment
+        and restored at the end.
+
+        Parameters
+        ----------
+        times : sequence, optional
+            Time of each point, in seconds from the start. Defaults to the
+            first TNPT points of TTIM.
+        positions : sequence, optional
+            Position of each point, defaulting to TPOS. If given, the
+            trajectory fields are updated.
+
+        Returns
+        -------
+        status : concurrent.futures.Future
+            Completes with the array of captured positions (the points
+            reached, if stopped)
+
+        Raises
+        ------
+        ValueError
+            If the trajectory is invalid or outside of the limits
+        RuntimeError
+            If a trajectory is already running
+        '''
+        size = self._traj_size
+        if size <= 0:
+            raise ValueError('Trajectories not enabled (trajectory_size)')
+
+        if times is None and positions is None:
+            npts = int(self[self._fld_traj_npts].value)
+            times = self[self._fld_traj_time].value[:npts]
+            positions = self[self._fld_traj_pos].value[:npts]
+        else:
+            times = np.asarray(times, dtype=np.float64).reshape(-1)
+            positions = np.asarray(positions, dtype=np.float64).reshape(-1)
+            npts = len(times)
+
+        if npts <= 0 or npts > size or len(positions) != npts:
+            raise ValueError('Trajectory needs 1 to {} times and positions '
+                             '(got {}, {})'.format(size, len(times),
+                                                   len(positions)))
+        elif np.any(np.diff(times) < 0.0) or times[0] < 0.0:
+            raise ValueError('Trajectory times must increase from 0')
+        elif not (self._check_limits(positions.min()) and
+                  self._check_limits(positions.max())):
+            self[self._fld_limit_viol] = 1
+            raise ValueError('Trajectory outside of limits %s' %
+                             (self._pos.limits, ))
+
+        self[self._fld_limit_viol] = 0
+        status = Future()
+        status.set_running_or_notify_cancel()
+
+        with self._traj_lock:
+            if self._trajectory is not None:
+                raise RuntimeError('Trajectory already running')
+
+            self._trajectory = traj = dict(
+                times=np.array(times), positions=np.array(positions),
+                capture=np.zeros(size), count=0, entry=None, status=status,
+                velocity=getattr(self._pos, 'velocity', None),
+                start=stats.clock())
+
+        self._update_status(fields={self._fld_traj_time: _padded(times,
+                                                                 size),
+                                    self._fld_traj_pos: _padded(positions,
+                                                                size),
+                                    self._fld_traj_npts: npts,
+                                    self._fld_traj_count: 0},
+                            moving=1)
+        self._trajectory_segment(traj)
+        return status
+
+    def _trajectory_segment(self, traj):
+        '''Start the move to the next point, and schedule its capture'''
+        i = traj['count']
+        times, positions = traj['times'], traj['positions']
+        target = positions[i]
+        duration = times[i] - (times[i - 1] if i > 0 else 0.0)
+
+        if traj['velocity'] is not None and duration > 0.0:
+            distance = abs(target - self._pos.position)
+            if distance > 0.0:
+                self._pos.velocity = distance / duration
+
+        self._pos.move(target, wait=False, timeout=self._timeout)
+
+        with self._traj_lock:
+            if self._trajectory is not traj:
+                # Stopped
+                return
+
+            delay = traj['start'] + times[i] - stats.clock()
+            traj['entry'] = scheduler.call_later(
+                max(delay, 0.0), functools.partial(self._trajectory_capture,
+                                                   traj))
+
+    def _trajectory_capture(self, traj):
+        '''[Scheduler callback] Record the position at a trajectory point'''
+        with self._traj_lock:
+            if self._trajectory is not traj:
+                return
+
+            traj['entry'] = None
+            traj['capture'][traj['count']] = self._pos.position
+            traj['count'] += 1
+            count = traj['count']
+
+        if count >= len(traj['times']):
+            self._trajectory_done(traj)
+            return
+
+        if self._traj_chunk > 0 and count % self._traj_chunk == 0:
+            # (a copy, as the buffer continues to be filled)
+            capture = traj['capture'].copy()
+            self.update_fields({self._fld_traj_capture: capture,
+                                self._fld_traj_count: count})
+
+        self._trajectory_segment(traj)
+
+    def _trajectory_done(self, traj):
+        '''Publish the capture buffer and complete the trajectory'''
+        with self._traj_lock:
+            if self._trajectory is not traj:
+                return
+
+            self._trajectory = None
+
+        if traj['velocity'] is not None:
+            self._pos.velocity = traj['velocity']
+
+        count = traj['count']
+        self._motion_stopped(fields={
+            self._fld_traj_capture: traj['capture'].copy(),
+            self._fld_traj_count: count})
+        traj['status'].set_result(traj['capture'][:count].copy())
 
-    def _update_status(self, **kwargs):
-        '''Update the motor status field (MSTA)'''
-        old_status = self._status
+    def _trajectory_written(self, value=None, **kwargs):
+        '''[CAS callback] CA client requested the trajectory be run'''
+        if not value:
+            return
+
+        try:
+            status = self.run_trajectory()
+        except (ValueError, RuntimeError):
+            return
 
+        go = self[self._fld_traj_go]
+        status.add_done_callback(lambda status: go.async_done())
+        raise AsyncCompletion()
+
+    def _update_status(self, fields=None, **kwargs):
+        '''Update the motor status field (MSTA) and the fields derived from
+        it, as one atomic record update
+
+        Parameters
+        ----------
+        fields : dict, optional
+            Other field values to include in the update
+        '''
         for arg, value in kwargs.items():
             bit = STATUS_BITS[arg]
             if value:
@@ -203,19 +670,388 @@ class PypvMotor(PypvRecord):
             else:
                 self._status &= ~(1 << bit)
 
-        field = self[self._fld_status]
-        if old_status != self._status:
-            field.value = self._status
+        values = dict(fields) if fields else {}
+        values[self._fld_status] = self._status
 
         moving = kwargs.get('moving', None)
         if moving is not None:
-            self[self._fld_moving] = moving
-            self[self._fld_done_move] = not moving
+            values[self._fld_moving] = moving
+            values[self._fld_done_move] = not moving
 
         plus_ls = kwargs.get('plus_ls', None)
         if plus_ls is not None:
-            self[self._fld_high_lim] = plus_ls
+            values[self._fld_high_lim] = plus_ls
 
         minus_ls = kwargs.get('minus_ls', None)
         if minus_ls is not None:
-            self[self._fld_low_lim] = minus_ls
+            values[self._fld_low_lim] = minus_ls
+
+        return self.update_fields(values)
+
+
+def _padded(values, size):
+    '''A copy of `values`, zero-padded to `size`'''
+    padded = np.zeros(size)
+    padded[:len(values)] = values
+    return padded
+
+
+class PypvPseudoMotor(PypvRecord):
+    '''One pseudo axis of a :class:`PseudoMotorGroup`
+
+    A put to the record (or .VAL) moves the real motors of the group so that
+    this axis reaches the position, keeping the other pseudo axes at their
+    targets. The put completes once all of the real motors are done.
+
+    Keyword arguments are passed to the base class, PypvRecord
+
+    Parameters
+    ----------
+    name : str
+        The record name (not including the server prefix)
+    group : PseudoMotorGroup
+        The group this axis belongs to
+    index : int
+        The index of the axis in the group
+    position : float
+        The initial position
+    egu : str, optional
+        Engineering units
+    '''
+
+    _rtype = 'motor'
+    _fld_readback = PypvMotor._fld_readback
+    _fld_egu = PypvMotor._fld_egu
+    _fld_moving = PypvMotor._fld_moving
+    _fld_done_move = PypvMotor._fld_done_move
+    _fld_stop = PypvMotor._fld_stop
+    _fld_limit_viol = PypvMotor._fld_limit_viol
+
+    def __init__(self, name, group, index, position, egu='', **kwargs):
+        self._group = group
+        self._index = index
+
+        PypvRecord.__init__(self, name, float(position), rtype=self._rtype,
+                            **kwargs)
+
+        self.add_field(self._fld_readback, float(position),
+                       precision=self._precision)
+        self.add_field(self._fld_egu, str(egu))
+        self.add_field(self._fld_moving, False)
+        self.add_field(self._fld_done_move, True)
+        self.add_field(self._fld_stop, 0,
+                       written_cb=lambda **kwargs: self.stop())
+        self.add_field(self._fld_limit_viol, 0)
+
+    @property
+    def group(self):
+        '''The pseudo motor group'''
+        return self._group
+
+    def written_to(self, timestamp=None, value=None, status=None,
+                   severity=None):
+        '''[CAS callback] CA client requested a move of this pseudo axis'''
+        if status or severity:
+            return
+
+        target = self._group.target.copy()
+        target[self._index] = value
+        self._group._move_written(self, target)
+
+    def move(self, position, wait=False, timeout=None):
+        '''Move this pseudo axis (see :meth:`PseudoMotorGroup.move`)'''
+        target = self._group.target.copy()
+        target[self._index] = position
+        return self._group.move(target, wait=wait, timeout=timeout)
+
+    def stop(self):
+        '''Stop all of the real motors of the group'''
+        self._group.stop()
+
+
+class PseudoMotorGroup(object):
+    '''Pseudo motors mapped onto a set of real motors
+
+    The `forward` transform takes the positions of all real motors and
+    returns the positions of all pseudo axes; `inverse` does the reverse.
+    Both are called with numpy arrays, with the axes along the first
+    dimension, and should be vectorized: a 2D array of (axes, points)
+    gives the positions of many points in a single call.
+
+    Each pseudo axis gets a :class:`PypvPseudoMotor` record. The group
+    record holds the targets of all pseudo axes as a waveform; a put to it
+    makes a coordinated move of every axis, with a single put completion
+    once all of the real motors are done. The group record also has RBV,
+    MOVN, DMOV, STOP and LVIO fields.
+
+    Parameters
+    ----------
+    name : str
+        The group record name (not including the server prefix)
+    real_motors : sequence of PypvMotor
+        The real motors
+    pseudo_names : sequence of str
+        Record names of the pseudo axes
+    forward : callable
+        forward(real_positions) -> pseudo_positions
+    inverse : callable
+        inverse(pseudo_positions) -> real_positions
+    egu : str, optional
+        Engineering units of the pseudo axes
+    server : PypvServer, optional
+        Add all of the records to this server
+
+    Attributes
+    ----------
+    axes : list of PypvPseudoMotor
+        The pseudo axis records
+    record : PypvRecord
+        The group record
+    '''
+
+    def __init__(self, name, real_motors, pseudo_names, forward, inverse,
+                 egu='', server=None):
+        self._reals = list(real_motors)
+        self._forward = forward
+        self._inverse = inverse
+        self._lock = threading.RLock()
+        self._moving = set()
+        self._waiting = []
+        # Identifies the latest group move; callbacks of earlier ones are
+        # ignored
+        self._move_token = None
+        # Why the latest group move failed, if it did
+        self._move_error = None
+
+        position = self.position
+        if len(position) != len(pseudo_names):
+            raise ValueError('Forward transform gave {} positions for {} '
+                             'pseudo axes'.format(len(position),
+                                                  len(pseudo_names)))
+
+        self._target = position.copy()
+        self.axes = [PypvPseudoMotor(pseudo_name, self, i, position[i],
+                                     egu=egu)
+                     for i, pseudo_name in enumerate(pseudo_names)]
+
+        self.record = PypvRecord(name, position.copy(), rtype='waveform',
+                                 written_cb=self._group_written)
+        self.record.add_field(PypvMotor._fld_readback, position.copy())
+        self.record.add_field(PypvMotor._fld_moving, False)
+        self.record.add_field(PypvMotor._fld_done_move, True)
+        self.record.add_field(PypvMotor._fld_stop, 0,
+                              written_cb=lambda **kwargs: self.stop())
+        self.record.add_field(PypvMotor._fld_limit_viol, 0)
+
+        for motor in self._reals:
+            motor._pos.subscribe(self._readback_updated,
+                                 event_type=motor._pos.SUB_READBACK,
+                                 run=False)
+
+        if server is not None:
+            server.add_pvs(self.axes + [self.record])
+
+    @property
+    def real_motors(self):
+        '''The real motors'''
+        return list(self._reals)
+
+    @property
+    def real_position(self):
+        '''Current positions of the real motors'''
+        return np.array([motor._pos.position for motor in self._reals],
+                        dtype=np.float64)
+
+    @property
+    def position(self):
+        '''Current positions of the pseudo axes'''
+        return self.forward(self.real_position)
+
+    @property
+    def target(self):
+        '''Targets of the pseudo axes'''
+        return self._target
+
+    @property
+    def moving(self):
+        '''The group is moving'''
+        return bool(self._moving)
+
+    def forward(self, real):
+        '''Real positions to pseudo positions (vectorized)'''
+        return np.asarray(self._forward(np.asarray(real, dtype=np.float64)),
+                          dtype=np.float64)
+
+    def inverse(self, pseudo):
+        '''Pseudo positions to real positions (vectorized)'''
+        return np.asarray(self._inverse(np.asarray(pseudo,
+                                                   dtype=np.float64)),
+                          dtype=np.float64)
+
+    def move(self, position, wait=False, timeout=None):
+        '''Move all pseudo axes together
+
+        Parameters
+        ----------
+        position : sequence
+            The target of each pseudo axis
+        wait : bool, optional
+            Block until the move completes
+        timeout : float, optional
+            With `wait`, the maximum time to wait
+
+        Returns
+        -------
+        status : concurrent.futures.Future
+            Completes with the pseudo positions once all of the real motors
+            are done, and has the `target` of the move as an attribute. If
+            a real motor is stopped, has its move replaced by another (e.g.
+            a put to its VAL) or ends away from its target, it fails with a
+            RuntimeError instead, once all of the real motors are done.
+
+        Raises
+        ------
+        ValueError
+            If a real motor would be moved outside of its limits
+        '''
+        target = np.array(position, dtype=np.float64).reshape(-1)
+        if len(target) != len(self.axes):
+            raise ValueError('Expected {} positions, got {}'
+                             ''.format(len(self.axes), len(target)))
+
+        real_target = self.inverse(target)
+        violation = [motor.name for motor, pos in zip(self._reals,
+                                                      real_target)
+                     if not motor._check_limits(pos)]
+
+        lvio = PypvMotor._fld_limit_viol
+        for record in self.axes + [self.record]:
+            record.update_fields({lvio: int(bool(violation))})
+
+        if violation:
+            raise ValueError('Limits violated by: %s' % ', '.join(violation))
+
+        status = Future()
+        status.set_running_or_notify_cancel()
+        status.target = target
+
+        token = object()
+        with self._lock:
+            self._target = target
+            self._waiting.append(status)
+            self._move_token = token
+            self._move_error = None
+            # Every real motor is marked as moving before any is started, so
+            # that one finishing early does not complete the group
+            self._moving = set(range(len(self._reals)))
+
+        for i, axis in enumerate(self.axes):
+            axis.update_fields({'VAL': target[i]})
+
+        self.record.update_fields({'VAL': target})
+        self._update_moving(True)
+
+        for i, (motor, pos) in enumerate(zip(self._reals, real_target)):
+            st = motor.move(pos)
+            st.add_done_callback(functools.partial(self._real_done, token,
+                                                   i))
+
+        if wait:
+            status.result(timeout)
+
+        return status
+
+    def _move_written(self, record, target):
+        '''Start a move requested by a put to `record` (the group record or
+        an axis), completing the put when the move is done'''
+        try:
+            status = self.move(target)
+        except ValueError:
+            return
+
+        def move_done(status):
+            if status.exception() is not None:
+                record.async_done(AsyncCancelled.ret)
+            else:
+                record.async_done()
+
+        status.add_done_callback(move_done)
+        raise AsyncCompletion()
+
+    def _group_written(self, value=None, status=None, severity=None,
+                       **kwargs):
+        '''[CAS callback] CA client requested a coordinated move'''
+        if status or severity:
+            return
+
+        value = np.asarray(value, dtype=np.float64).reshape(-1)
+        if len(value) < len(self.axes):
+            return
+
+        self._move_written(self.record, value[:len(self.axes)])
+
+    def _real_done(self, token, index, st):
+        '''[MoveStatus callback] A real motor completed its part of the
+        move'''
+        error = self._real_move_error(self._reals[index], st)
+        with self._lock:
+            if token is not self._move_token:
+                # Part of a move since superseded: its statuses complete
+                # with the move which replaced it
+                return
+
+            if error is not None and self._move_error is None:
+                self._move_error = error
+
+            self._moving.discard(index)
+            if self._moving:
+                return
+
+            waiting, self._waiting = self._waiting, []
+            error = self._move_error
+
+        self._readback_updated()
+        self._update_moving(False)
+
+        position = self.position
+        for status in waiting:
+            if status.done():
+                continue
+            elif error is not None:
+                status.set_exception(error)
+            else:
+                status.set_result(position)
+
+    @staticmethod
+    def _real_move_error(motor, st):
+        '''Why the move `st` of a real motor did not reach its target, or
+        None'''
+        if st.stopped:
+            return RuntimeError('%s: stopped' % motor.name)
+        elif motor.move_status is not None and motor.move_status is not st:
+            return RuntimeError('%s: move replaced by another' % motor.name)
+
+        # Within the display precision of the motor
+        if abs(st.result() - st.target) > 10 ** -motor._precision:
+            return RuntimeError('%s: ended at %g, away from its target %g'
+                                '' % (motor.name, st.result(), st.target))
+        return None
+
+    def _update_moving(self, moving):
+        for record in self.axes + [self.record]:
+            record.update_fields({PypvMotor._fld_moving: int(moving),
+                                  PypvMotor._fld_done_move: not moving})
+
+    def _readback_updated(self, **kwargs):
+        '''[Pos callback] A real motor readback has been updated'''
+        position = self.position
+        rbv = PypvMotor._fld_readback
+        for axis, value in zip(self.axes, position.tolist()):
+            axis.update_fields({rbv: value})
+
+        self.record.update_fields({rbv: position})
+
+    def stop(self):
+        '''Stop all of the real motors'''
+        for motor in self._reals:
+            motor.stop()
@@ -10,9 +10,9 @@
 
 from __future__ import print_function
 
-import time
 import threading
 import logging
+import warnings
 
 import numpy as np
 import pcaspy
@@ -20,6 +20,8 @@ from pcaspy import cas
 
 from .alarms import (AlarmError, MajorAlarmError, MinorAlarmError, alarms)
 from .utils import record_field
+from .scan import ScanGroup
+from . import stats
 
 from .errors import (AsyncCompletion, AsyncRunning, PypvError, PypvSuccess,
                      UndefinedValueError)
@@ -27,6 +29,47 @@ from .errors import (AsyncCompletion, AsyncRunning, PypvError, PypvSuccess,
 
 logger = logging.getLogger(__name__)
 
+type_map = {list: cas.aitEnumEnum16,
+            tuple: cas.aitEnumEnum16,
+            str: cas.aitEnumString,
+            float: cas.aitEnumFloat64,
+            int: cas.aitEnumInt32,
+            bool: cas.aitEnumEnum16,
+
+            np.int8: cas.aitEnumInt8,
+            np.uint8: cas.aitEnumUint8,
+            np.int16: cas.aitEnumInt16,
+            np.uint16: cas.aitEnumUint16,
+            np.int32: cas.aitEnumInt32,
+            np.uint32: cas.aitEnumUint32,
+            np.float32: cas.aitEnumFloat32,
+            np.float64: cas.aitEnumFloat64,
+            }
+
+string_types = (cas.aitEnumString, cas.aitEnumFixedString,
+                cas.aitEnumUint8)
+enum_types = (cas.aitEnumEnum16, )
+numerical_types = (cas.aitEnumFloat64, cas.aitEnumInt32)
+
+try:
+    _str_classes = (basestring, )  # noqa
+except NameError:
+    _str_classes = (str, bytes)
+
+
+def _context_key(context):
+    '''Identify the client circuit of a write
+
+    The server holds back a circuit's requests while one of them is
+    postponed, so this also identifies the postponed put when it is retried.
+    '''
+    # pcaspy wraps the casCtx passed to write/writeNotify
+    ctx = getattr(context, 'ctx', context)
+    try:
+        return int(ctx)
+    except (TypeError, ValueError):
+        return id(ctx)
+
 
 class Limits(object):
     '''Control and display limits for Epics PVs
@@ -137,11 +180,23 @@ class PyPV(cas.casPV):
     written_cb : callable, optional
         A callback called when the value is written to via channel access. This
         overrides the default `written_to` method.
+    postponed_cb : callable, optional
+        A callback called (with the same arguments as `written_cb`) when a
+        put is postponed because an asynchronous write is pending. The
+        server retries the put once that write completes. The callback may
+        return a callable, which is called without arguments when that put
+        is retried: if it returns True, the put completes without calling
+        `written_cb`.
     scan_cb : callable, optional
         A callback called when the scan event happens -- when the PV should
         have its value updated. This overrides the default `scan` method.
     server : PypvServer, optional
         The channel access server to attach to
+    history : int, optional
+        Keep a history of up to this many values (see `enable_history`)
+    history_waveforms : int, optional
+        With `history`, also publish the most recent this many entries as
+        waveform PVs
 
     Attributes
     ----------
@@ -166,6 +221,9 @@ class PyPV(cas.casPV):
                  server=None,
                  written_cb=None,
                  scan_cb=None,
+                 postponed_cb=None,
+                 history=0,
+                 history_waveforms=0,
                  ):
 
         # TODO: asg
@@ -179,6 +237,9 @@ class PyPV(cas.casPV):
         elif not callable(scan_cb):
             raise ValueError('scan_cb is not callable')
 
+        if postponed_cb is not None and not callable(postponed_cb):
+            raise ValueError('postponed_cb is not callable')
+
         # PV type defaults to type(value)
         if type_ is None:
             type_ = type(value)
@@ -188,15 +249,21 @@ class PyPV(cas.casPV):
         if server is not None:
             name = server._strip_prefix(name)
 
-        from .server import PypvServer
-
         self._name = str(name)
-        self._ca_type = PypvServer.type_map.get(type_, type_)
+        self._ca_type = type_map.get(type_, type_)
         self._precision = precision
         self._units = str(units)
         self._scan_rate = float(scan)
         self.scan = scan_cb
         self._written_cb = written_cb
+        self._postponed_cb = postponed_cb
+        # Context key of a postponed put to the callable from postponed_cb
+        self._postponed = {}
+        self._async_lock = threading.Lock()
+        # Cleared while an asynchronous written_cb is running; created by the
+        # first write, as events are costly to create for every PV
+        self._async_complete = None
+        self._async_pending = False
         self._count = 0
         self._interest = False
         self._mask = cas.DBE_VALUE | cas.DBE_LOG
@@ -218,10 +285,15 @@ class PyPV(cas.casPV):
         self._alarm = AlarmError.severity
         self._severity = AlarmError.severity
         self._updating = False
+        self._history = None
+        self.history_pvs = []
+        self._subscriptions = []
+        # The record this PV is a field of, if any
+        self._record = None
 
-        if count == 0 and self._ca_type in PypvServer.numerical_types:
+        if count == 0 and self._ca_type in numerical_types:
             alarm_fcn = self._check_numerical
-        elif self._ca_type in PypvServer.enum_types:
+        elif self._ca_type in enum_types:
             if type_ is bool:
                 self._enums = ['False', 'True']
                 self._value = self._enums[bool(value)]
@@ -231,23 +303,23 @@ class PyPV(cas.casPV):
 
             self._mask |= cas.DBE_PROPERTY
 
-            dtyp = np.array(self._value).dtype
-            if dtyp.type not in (np.string_, np.str_):
+            if not isinstance(self._value, _str_classes):
                 raise ValueError('Enum list item types should be strings '
                                  '(specify an np.ndarray as the value if you '
                                  'wanted a waveform). '
-                                 'value={} dtype={}'.format(self._value, dtyp))
+                                 'value={} type={}'.format(self._value,
+                                                           type(self._value)))
 
             alarm_fcn = self._check_enum
 
             self.minor_states = list(minor_states)
             self.major_states = list(major_states)
-        elif self._ca_type in PypvServer.string_types:
+        elif self._ca_type in string_types:
             alarm_fcn = self._check_string
         elif count > 0 or (type_ is np.ndarray and isinstance(value,
                                                               np.ndarray)):
             try:
-                self._ca_type = PypvServer.type_map[value.dtype.type]
+                self._ca_type = type_map[value.dtype.type]
             except KeyError:
                 raise ValueError('Unhandled numpy array type %s' % value.dtype)
 
@@ -278,13 +350,14 @@ class PyPV(cas.casPV):
         cas.casPV.__init__(self)
 
         if self._scan_rate > 0.0:
-            self.thread = threading.Thread(target=self._scan_thread)
-            self.thread.daemon = True
-            self.thread.start()
+            ScanGroup.add_pv(self)
 
         if server is not None:
             server.add_pv(self)
 
+        if history > 0:
+            self.enable_history(history, waveforms=history_waveforms)
+
     @property
     def full_pvname(self):
         '''The full PV name, including the server prefix'''
@@ -308,6 +381,63 @@ class PyPV(cas.casPV):
         self._value[idx] = value
         self.value = self._value
 
+    @property
+    def history(self):
+        '''The value history (a :class:`pypvserver.history.History`), or
+        None if not enabled'''
+        return self._history
+
+    def enable_history(self, capacity, waveforms=0):
+        '''Keep a ring buffer of the last `capacity` (timestamp, value,
+        severity) entries, for scalar numeric PVs
+
+        Parameters
+        ----------
+        capacity : int
+            Number of entries to keep
+        waveforms : int, optional
+            Also publish the most recent this many entries as the waveform
+            PVs `<name>:HistTime`, `<name>:HistVal` and `<name>:HistSevr`,
+            with the number of entries in `<name>:HistN`. These are added
+            to the server along with this PV.
+
+        Returns
+        -------
+        history : pypvserver.history.History
+        '''
+        from .history import (History, HistoryWaveform, epics_to_posix)
+
+        if self._count > 0 or self._ca_type not in numerical_types:
+            raise ValueError('History is only kept for scalar numeric PVs')
+        elif self._history is not None:
+            raise ValueError('History already enabled')
+
+        self._history = History(capacity)
+        self._history_time = epics_to_posix
+
+        if waveforms > 0:
+            self.history_pvs = [
+                HistoryWaveform('%s:%s' % (self._name, suffix),
+                                self._history, column, waveforms)
+                for suffix, column in (('HistTime', 'time'),
+                                       ('HistVal', 'value'),
+                                       ('HistSevr', 'severity'),
+                                       ('HistN', 'count'))]
+            if self._server is not None:
+                self._server.add_pvs(self.history_pvs)
+
+        self._record_history()
+        return self._history
+
+    def _record_history(self):
+        '''Add the current value to the history'''
+        try:
+            self._history.append(self._history_time(self._timestamp),
+                                 self._value, self._severity)
+        except (TypeError, ValueError) as ex:
+            logger.debug('%s: value not recorded in history (%s)',
+                         self._name, ex)
+
     def stop(self):
         '''Stop the scan loop'''
         self._updating = False
@@ -319,20 +449,24 @@ class PyPV(cas.casPV):
         '''
         pass
 
-    def _scan_loop(self):
-        if self._scan_rate <= 0.0:
-            return
-
-        self._updating = True
+    @stats.timed('scan')
+    def _scan_once(self):
+        self.scan()
 
-        while self._updating:
-            try:
-                self.scan()
-            except:
-                self._updating = False
-                raise
+    @property
+    def thread(self):
+        '''The thread scanning this PV, or None
 
-            time.sleep(self._scan_rate)
+        Deprecated: the thread is shared by all PVs with the same scan period
+        (see :class:`pypvserver.scan.ScanGroup`).
+        '''
+        warnings.warn('PyPV.thread is deprecated; PVs are scanned by a '
+                      'ScanGroup thread per period', DeprecationWarning,
+                      stacklevel=2)
+        group = ScanGroup.groups().get(self._scan_rate, None)
+        if group is None or not self._updating:
+            return None
+        return group._thread
 
     def touch(self):
         '''Update the timestamp and alarm status (without changing the
@@ -415,24 +549,84 @@ class PyPV(cas.casPV):
             self._value = info['value']
             self._status = info['status']
             self._severity = info['severity']
+            if self._history is not None:
+                self._record_history()
         else:
-            gdd = cas.gdd()
-            gdd.setPrimType(self._ca_type)
+            gdd = self._store_value(value, timestamp)
+
+        self._post_value(gdd)
+
+    def _store_value(self, value, timestamp=None):
+        '''Update the value, timestamp and alarm status without notifying
+        clients
 
-            if timestamp is None:
-                timestamp = cas.epicsTimeStamp()
+        Returns
+        -------
+        gdd : cas.gdd
+            The update, to be passed to `_post_value`
+        '''
+        gdd = cas.gdd()
+        gdd.setPrimType(self._ca_type)
 
-            self._timestamp = timestamp
-            self._value = value
-            self._status, self._severity = self.check_alarm()
+        if timestamp is None:
+            timestamp = cas.epicsTimeStamp()
 
-            self._gdd_set_value(gdd)
+        self._timestamp = timestamp
+        self._value = value
+        self._status, self._severity = self.check_alarm()
+        if self._history is not None:
+            self._record_history()
 
+        self._gdd_set_value(gdd)
+        return gdd
+
+    def _post_value(self, gdd):
+        '''Notify clients of an update stored by `_store_value`'''
         if self._interest:
             # Notify clients of the update
             self.postEvent(self._mask, gdd)
+            self._increment('events')
             # self._mask = cas.DBE_VALUE | cas.DBE_LOG
 
+        for callback in self._subscriptions:
+            try:
+                callback(pv=self, value=self._value,
+                         timestamp=self._timestamp, severity=self._severity)
+            except Exception as ex:
+                logger.error('%s: subscription callback failed: %s',
+                             self._name, ex, exc_info=ex)
+
+    def _increment(self, counter, count=1):
+        '''Count an event in the statistics of the server (if any)'''
+        server = self._server
+        if server is None and self._record is not None:
+            server = self._record._server
+        if server is not None:
+            server.counters.increment(counter, count)
+
+    def subscribe(self, callback):
+        '''Call `callback` on every update of the value
+
+        The callback receives `pv`, `value`, `timestamp` and `severity`
+        keyword arguments, in the thread making the update.
+
+        Returns
+        -------
+        callback
+            For use with `clear_sub`
+        '''
+        if not callable(callback):
+            raise ValueError('callback is not callable')
+
+        # Copied on write, so that updates can iterate without a lock
+        self._subscriptions = self._subscriptions + [callback]
+        return callback
+
+    def clear_sub(self, callback):
+        '''Remove a subscription added by `subscribe`'''
+        self._subscriptions = [cb for cb in self._subscriptions
+                               if cb != callback]
+
     value = property(_get_value, _set_value)
 
     def resize(self, count=None, value=None):
@@ -493,53 +687,138 @@ class PyPV(cas.casPV):
         self._interest = False
         return PypvSuccess.ret
 
-    def process(self, wait=True):
-        '''Cause the written-to callback to be fired'''
+    def process(self, wait=True, timeout=None):
+        '''Cause the written-to callback to be fired
 
+        Parameters
+        ----------
+        wait : bool, optional
+            If the callback completes asynchronously, wait for `async_done`
+        timeout : float, optional
+            Maximum time to wait, in seconds
+        '''
+        owner = self._begin_write()
         try:
             ret = self._written_cb(timestamp=self._timestamp,
                                    value=self._value,
                                    status=self._status,
                                    severity=self._severity)
         except AsyncCompletion:
-            while wait and self.hasAsyncWrite():
-                time.sleep(0.01)
+            if wait:
+                self.wait_async(timeout)
 
             ret = self.value
+        except Exception:
+            if owner:
+                self._end_write()
+            raise
+        else:
+            if owner:
+                self._end_write()
 
         return ret
 
+    @stats.timed('write')
     def write(self, context, value):
         '''The PV was written to over channel access
 
         (internal function, override `written_to` instead)
         '''
+        self._increment('writes')
+        retried = self._postponed.pop(_context_key(context), None)
+        if retried is not None and retried():
+            # Satisfied while it was postponed
+            self.value = value
+            return PypvSuccess.ret
+
         if self._written_cb is not None:
+            owner = self._begin_write()
             try:
                 info = self._gdd_to_dict(value)
                 self._written_cb(**info)
             except AsyncCompletion as ex:
-                if self.hasAsyncWrite():
-                    return AsyncRunning.ret
-                else:
-                    self.startAsyncWrite(context)
+                with self._async_lock:
+                    if self.hasAsyncWrite():
+                        self._postpone(context, info)
+                        return AsyncRunning.ret
+                    elif not self._async_pending:
+                        # async_done was called before the write could be
+                        # marked as asynchronous
+                        return PypvSuccess.ret
+
+                    # pcaspy wraps the casCtx passed to write/writeNotify
+                    self.startAsyncWrite(getattr(context, 'ctx', context))
+                    self._increment('async_pending')
                 return ex.ret
             except PypvError as ex:
+                if owner:
+                    self._end_write()
                 return ex.ret
             except Exception as ex:
+                if owner:
+                    self._end_write()
                 logger.debug('written_cb failed: (%s) %s',
                              ex.__class__.__name__, ex,
                              exc_info=ex)
                 # TODO: no error for rejected values?
                 return PypvSuccess.ret
 
+            if owner:
+                self._end_write()
+
         self.value = value
         return PypvSuccess.ret
 
     def async_done(self, ret=PypvSuccess.ret):
         '''Indicate to the server that the asynchronous write has completed'''
-        if self.hasAsyncWrite():
-            self.endAsyncWrite(ret)
+        with self._async_lock:
+            if self.hasAsyncWrite():
+                self.endAsyncWrite(ret)
+                self._increment('async_pending', -1)
+
+            self._async_pending = False
+            if self._async_complete is not None:
+                self._async_complete.set()
+
+    def _begin_write(self):
+        '''Mark a written_cb as possibly asynchronous
+
+        Returns
+        -------
+        bool
+            False if an asynchronous written_cb is already outstanding, in
+            which case only `async_done` may mark it complete
+        '''
+        with self._async_lock:
+            if self._async_pending:
+                return False
+
+            self._async_pending = True
+            if self._async_complete is None:
+                self._async_complete = threading.Event()
+            else:
+                self._async_complete.clear()
+            return True
+
+    def _end_write(self):
+        '''The written_cb started by `_begin_write` completed synchronously'''
+        with self._async_lock:
+            self._async_pending = False
+            self._async_complete.set()
+
+    def wait_async(self, timeout=None):
+        '''Wait for an asynchronous written_cb to complete
+
+        Returns
+        -------
+        bool
+            False if the timeout expired first
+        '''
+        event = self._async_complete
+        if event is None:
+            # Never written to
+            return True
+        return event.wait(timeout)
 
     def writeNotify(self, context, value):
         '''An asynchronous write attempt was made
@@ -547,11 +826,29 @@ class PyPV(cas.casPV):
         (internal function)
         '''
         if self.hasAsyncWrite():
-            # Another async task currently running
+            # Another async task currently running; the server retries this
+            # put once it completes
+            self._postpone(context, self._gdd_to_dict(value))
             return AsyncRunning.ret
 
         return self.write(context, value)
 
+    def _postpone(self, context, info):
+        '''A put is postponed while an asynchronous write is pending'''
+        key = _context_key(context)
+        self._postponed.pop(key, None)
+        if self._postponed_cb is None:
+            return
+
+        try:
+            retried = self._postponed_cb(**info)
+        except Exception as ex:
+            logger.debug('postponed_cb failed: (%s) %s',
+                         ex.__class__.__name__, ex, exc_info=ex)
+        else:
+            if retried is not None:
+                self._postponed[key] = retried
+
     def _gdd_set_value(self, gdd):
         '''Update a gdd instance with the current value and alarm/severity'''
         if gdd.primitiveType() == cas.aitEnumInvalid:
@@ -568,6 +865,9 @@ class PyPV(cas.casPV):
     #      underlying swigged C++ code needs to be modified.
 
     def _gdd_function(fcn, **kwargs):
+        kind = 'get:%s' % kwargs.get('attr', 'value').lstrip('_')
+
+        @stats.timed(kind)
         def wrapped(self, gdd):
             '''Internal pcaspy function; do not use'''
             try:
@@ -658,39 +958,145 @@ class PypvRecord(PyPV):
     Attributes
     ----------
     fields : dict
-        Field name to PyPV instance
+        Field name to PyPV instance (creating any deferred fields)
     '''
 
+    # Guards the creation of deferred fields
+    _deferred_lock = threading.Lock()
+
     def __init__(self, name, val_field, rtype='', desc='', **kwargs):
         assert '.' not in name, 'Record name cannot have periods'
 
+        # The record is added to the server once its fields exist
+        server = kwargs.pop('server', None)
+        if server is not None:
+            name = server._strip_prefix(name)
+
         PyPV.__init__(self, name, val_field, **kwargs)
 
-        self.fields = {}
+        self._fields = {}
+        # Fields whose PVs are created when first used: field -> (value,
+        # keyword arguments)
+        self._deferred = {}
         self.add_field('VAL', None, pv=self)
-        self.add_field('RTYP', str(rtype))
-        self.add_field('DESC', str(desc))
+        self.defer_field('RTYP', str(rtype))
+        self.defer_field('DESC', str(desc))
+
+        if server is not None:
+            server.add_pv(self)
 
     def field_pvname(self, field):
         return record_field(self.name, field)
 
+    @property
+    def fields(self):
+        if self._deferred:
+            for field in list(self._deferred):
+                self._create_field(field)
+        return self._fields
+
     def __getitem__(self, field):
-        return self.fields[field]
+        try:
+            return self._fields[field]
+        except KeyError:
+            if field not in self._deferred:
+                raise
+
+        return self._create_field(field)
 
     def __setitem__(self, field, value):
-        self.fields[field].value = value
+        self[field].value = value
+
+    def _create_field(self, field):
+        '''Create the PV of a deferred field'''
+        with self._deferred_lock:
+            try:
+                # Created by another thread meanwhile
+                return self._fields[field]
+            except KeyError:
+                value, kwargs = self._deferred.pop(field)
+
+            self.add_field(field, value, **kwargs)
+            return self._fields[field]
+
+    def defer_field(self, field, value, **kwargs):
+        '''Add a field whose PV is created when it is first used
+
+        The field is created when looked up, from Python or by a client
+        search. Takes the same arguments as `add_field`: fields which are
+        rarely used (RTYP, DESC, ...) are cheaper to add this way, when
+        there are many records.
+        '''
+        field = field.upper()
+        if field in self._fields or field in self._deferred:
+            raise ValueError('Field already exists')
+
+        kwargs.pop('server', '')
+        self._deferred[field] = (value, kwargs)
 
     def add_field(self, field, value, pv=None, **kwargs):
         field = field.upper()
-        if field in self.fields:
+        if field in self._fields or field in self._deferred:
             raise ValueError('Field already exists')
 
         if pv is None:
             field_pv = self.field_pvname(field)
             kwargs.pop('server', '')
             pv = PyPV(field_pv, value, **kwargs)
-
-        self.fields[field] = pv
+            pv._record = self
+
+        self._fields[field] = pv
+
+        server = self._server
+        if pv is not self and server is not None and \
+                server.autosave is not None:
+            # Fields added after the record was served are restored here
+            server.autosave.restore(pv)
+
+    def update_fields(self, values, timestamp=None, force=()):
+        '''Update several fields as one atomic change
+
+        All of the fields whose values differ are stored with the same
+        timestamp before clients are notified, so that a client reacting
+        to one of the events reads a consistent record. Fields whose values
+        are unchanged are not posted, unless listed in `force`.
+
+        Parameters
+        ----------
+        values : dict
+            Field name to new value
+        timestamp : cas.epicsTimeStamp, optional
+            Timestamp of the update, defaulting to now
+        force : sequence of str, optional
+            Fields posted even if their values are unchanged
+
+        Returns
+        -------
+        changed : list
+            The names of the fields which were updated
+        '''
+        if timestamp is None:
+            timestamp = cas.epicsTimeStamp()
+
+        changed = []
+        updates = []
+        for field, value in values.items():
+            pv = self[field]
+            if field in force:
+                pass
+            elif pv._count > 0:
+                if np.array_equal(pv._value, value):
+                    continue
+            elif pv._value == value:
+                continue
+
+            changed.append(field)
+            updates.append((pv, pv._store_value(value, timestamp)))
+
+        for pv, gdd in updates:
+            pv._post_value(gdd)
+
+        return changed
 
     def __repr__(self):
         return '{0}({1.name!r}, value={1.value!r}, alarm={1.alarm}, ' \
@@ -0,0 +1,118 @@
+# vi: ts=4 sw=4
+'''
+:mod:`pypvserver.scan` - Periodic scanning
+==========================================
+
+.. module:: pypvserver.scan
+   :synopsis: Periodic scan threads, shared by all PVs with the same period
+'''
+
+from __future__ import print_function
+
+import threading
+import logging
+import time
+
+from . import stats
+
+
+logger = logging.getLogger(__name__)
+
+
+class ScanGroup(object):
+    '''Scans all PVs with the same scan period from a single thread
+
+    Like the periodic scan tasks of an IOC, one thread per distinct period
+    is used rather than one thread per PV.
+
+    Parameters
+    ----------
+    period : float
+        The scan period, in seconds
+    '''
+
+    _groups = {}
+    _lock = threading.Lock()
+
+    def __init__(self, period):
+        self.period = float(period)
+        self._pvs = []
+        self._thread = threading.Thread(target=self._scan_loop)
+        self._thread.daemon = True
+
+    @classmethod
+    def add_pv(cls, pv):
+        '''Start scanning a PV, at its scan period'''
+        period = pv._scan_rate
+        with cls._lock:
+            try:
+                group = cls._groups[period]
+            except KeyError:
+                group = cls._groups[period] = cls(period)
+                group._thread.start()
+
+            pv._updating = True
+            group._pvs.append(pv)
+
+    @classmethod
+    def groups(cls):
+        '''Current scan groups, keyed on period'''
+        with cls._lock:
+            return dict(cls._groups)
+
+    @property
+    def pvs(self):
+        '''PVs scanned by this group'''
+        with self._lock:
+            return list(self._pvs)
+
+    def _remove(self, pv):
+        with self._lock:
+            if pv in self._pvs:
+                self._pvs.remove(pv)
+
+    def _scan_loop(self):
+        period = self.period
+        clock = stats.clock
+        last_start = None
+
+        while True:
+            with self._lock:
+                if not self._pvs:
+                    # Nothing left to scan; a new group will be created if
+                    # a PV is added with this period
+                    del self._groups[period]
+                    return
+
+                pvs = list(self._pvs)
+
+            # A group may scan the PVs of several servers; each counts it
+            counters = set(pv._server.counters for pv in pvs
+                           if pv._server is not None)
+
+            t0 = clock()
+            if last_start is not None:
+                jitter = abs(t0 - last_start - period)
+                for server_counters in counters:
+                    server_counters.scan_jitter.record(jitter)
+            last_start = t0
+
+            for pv in pvs:
+                if not pv._updating:
+                    self._remove(pv)
+                    continue
+
+                try:
+                    pv._scan_once()
+                except Exception as ex:
+                    logger.error('Scan of %s failed; stopping its scan: %s',
+                                 pv.name, ex, exc_info=ex)
+                    pv._updating = False
+                    self._remove(pv)
+
+            elapsed = clock() - t0
+            if elapsed > period:
+                for server_counters in counters:
+                    server_counters.increment('scan_overruns')
+            else:
+                time.sleep(period - elapsed)
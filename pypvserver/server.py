@@ -13,12 +13,13 @@ import threading
 import logging
 import sys
 
-import numpy as np
 from pcaspy import cas
 
 from .utils import split_record_field
 from .errors import PVNotFoundError
 from .pv import PypvRecord
+from . import pv as pv_types
+from . import stats
 
 logger = logging.getLogger(__name__)
 
@@ -64,38 +65,42 @@ class PypvServer(cas.caServer):
         Start the server now
     default : bool, optional
         Use as the default channel access server
+    monitor : bool, optional
+        Publish server health PVs under `<prefix>SERVER:` (see
+        :meth:`start_monitor`)
+
+    Attributes
+    ----------
+    autosave : Autosave
+        If set, PVs are restored from this autosave snapshot as they are
+        added (see :class:`pypvserver.autosave.Autosave`)
+    counters : ServerCounters
+        Statistics of this server (see
+        :class:`pypvserver.stats.ServerCounters`)
     '''
 
-    type_map = {list: cas.aitEnumEnum16,
-                tuple: cas.aitEnumEnum16,
-                str: cas.aitEnumString,
-                float: cas.aitEnumFloat64,
-                int: cas.aitEnumInt32,
-                bool: cas.aitEnumEnum16,
-
-                np.int8: cas.aitEnumInt8,
-                np.uint8: cas.aitEnumUint8,
-                np.int16: cas.aitEnumInt16,
-                np.uint16: cas.aitEnumUint16,
-                np.int32: cas.aitEnumInt32,
-                np.uint32: cas.aitEnumUint32,
-                np.float32: cas.aitEnumFloat32,
-                np.float64: cas.aitEnumFloat64,
-                }
-
-    string_types = (cas.aitEnumString, cas.aitEnumFixedString,
-                    cas.aitEnumUint8)
-    enum_types = (cas.aitEnumEnum16, )
-    numerical_types = (cas.aitEnumFloat64, cas.aitEnumInt32)
+    type_map = pv_types.type_map
+    string_types = pv_types.string_types
+    enum_types = pv_types.enum_types
+    numerical_types = pv_types.numerical_types
     default_instance = None
 
-    def __init__(self, prefix, start=True, default=True):
+    def __init__(self, prefix, start=True, default=True, monitor=False):
         cas.caServer.__init__(self)
 
         self._pvs = {}
         self._thread = None
         self._running = False
         self._prefix = str(prefix)
+        self._monitor = None
+        self._exporter = None
+        self._executor = None
+        self._loop_thread = None
+        self.autosave = None
+        self.counters = stats.ServerCounters()
+
+        if monitor:
+            self.start_monitor()
 
         if start:
             self.start()
@@ -109,8 +114,12 @@ class PypvServer(cas.caServer):
     #  cas.asCaStop()
 
     def _attach_cas_functions(self):
-        from . import PypvFunction
+        function = sys.modules.get('pypvserver.function', None)
+        if function is None:
+            # No functions can be waiting if the module was never imported
+            return
 
+        PypvFunction = function.PypvFunction
         for fcn in list(PypvFunction._to_attach):
             if fcn._server is None:
                 fcn.attach_server(self)
@@ -146,16 +155,50 @@ class PypvServer(cas.caServer):
         return self._pvs[pv]
 
     def add_pv(self, pvi):
-        '''Add a PV instance to the server'''
+        '''Add a PV instance to the server, along with its history waveform
+        PVs (see `PyPV.enable_history`)'''
+        history_pvs = getattr(pvi, 'history_pvs', [])
+        if history_pvs:
+            return self.add_pvs([pvi])
+
         name = self._strip_prefix(pvi.name)
         if name in self._pvs:
             raise ValueError('PV already exists')
 
+        if self.autosave is not None:
+            # Restore before the PV can be found by a client
+            self.autosave.restore(pvi)
+
         self._pvs[name] = pvi
         pvi._server = self
 
+    def add_pvs(self, pvis):
+        '''Add many PV instances to the server at once, along with their
+        history waveform PVs'''
+        pvis = list(pvis)
+        pvis.extend([hist for pvi in pvis
+                     for hist in getattr(pvi, 'history_pvs', [])])
+        names = [self._strip_prefix(pvi.name) for pvi in pvis]
+        if len(set(names)) != len(names):
+            raise ValueError('Duplicate PV names')
+
+        existing = set(names).intersection(self._pvs)
+        if existing:
+            raise ValueError('PVs already exist: %s' %
+                             ', '.join(sorted(existing)[:10]))
+
+        if self.autosave is not None:
+            for pvi in pvis:
+                self.autosave.restore(pvi)
+
+        for pvi in pvis:
+            pvi._server = self
+
+        self._pvs.update(zip(names, pvis))
+
     def remove_pv(self, pvi):
-        '''Remove a PV instance from the server'''
+        '''Remove a PV instance (or a PV by name) from the server, along
+        with its history waveform PVs'''
         if isinstance(pvi, str):
             name = pvi
         else:
@@ -166,9 +209,15 @@ class PypvServer(cas.caServer):
         if name not in self._pvs:
             raise ValueError('PV not in server')
 
-        del self._pvs[name]
+        pvi = self._pvs.pop(name)
         pvi._server = None
 
+        for hist in getattr(pvi, 'history_pvs', []):
+            hist_name = self._strip_prefix(hist.name)
+            if self._pvs.get(hist_name, None) is hist:
+                del self._pvs[hist_name]
+                hist._server = None
+
     def _strip_prefix(self, pvname):
         '''Remove the channel access server prefix from the pv name'''
         if pvname[:len(self._prefix)] == self._prefix:
@@ -189,9 +238,11 @@ class PypvServer(cas.caServer):
 
     def pvExistTest(self, context, addr, pvname):
         if pvname in self:
+            self.counters.increment('search_hits')
             logger.debug('Responded %s exists' % pvname)
             return cas.pverExistsHere
         else:
+            self.counters.increment('search_misses')
             return cas.pverDoesNotExistHere
 
     def pvAttach(self, context, pvname):
@@ -212,9 +263,15 @@ class PypvServer(cas.caServer):
 
     def _process_loop(self, timeout=0.1):
         self._running = True
+        period = self.counters.loop_period
+        clock = stats.clock
 
         while self._running:
+            # Includes waiting up to `timeout` for events: the period is
+            # shorter than that only while requests keep the loop busy
+            t0 = clock()
             cas.process(timeout)
+            period.record(clock() - t0)
 
     def start(self):
         if self._thread is not None:
@@ -228,6 +285,47 @@ class PypvServer(cas.caServer):
     def running(self):
         return self._running
 
+    def in_server_thread(self):
+        '''Is this the thread processing channel access requests?
+
+        Callbacks made from it (e.g., `written_cb`) must not block, as that
+        stalls every client of the server.
+        '''
+        return (self._thread is not None and
+                threading.current_thread() is self._thread)
+
+    @property
+    def monitor(self):
+        '''The :class:`ServerMonitor`, if server health PVs are enabled'''
+        return self._monitor
+
+    def start_monitor(self, prefix='SERVER:', period=1.0):
+        '''Publish server health PVs under `<server prefix><prefix>`
+
+        Parameters
+        ----------
+        prefix : str, optional
+            Prefix for the monitoring PVs, after the server prefix
+        period : float, optional
+            Update period, in seconds
+
+        Returns
+        -------
+        monitor : ServerMonitor
+        '''
+        if self._monitor is not None:
+            raise RuntimeError('Server monitor already running')
+
+        from .monitor import ServerMonitor
+        self._monitor = ServerMonitor(self, prefix=prefix, period=period)
+        return self._monitor
+
+    def stop_monitor(self):
+        '''Stop and remove the server health PVs'''
+        if self._monitor is not None:
+            self._monitor.remove()
+            self._monitor = None
+
     def _pyepics_cleanup(self):
         '''Selectively disconnect pyepics PVs if they exist on this server
 
@@ -246,7 +344,81 @@ class PypvServer(cas.caServer):
             logger.debug('Disconnecting %s', pv)
             pv.disconnect()
 
+    @property
+    def exporter(self):
+        '''The :class:`MetricsExporter`, if metrics are being exported'''
+        return self._exporter
+
+    def start_exporter(self, host='127.0.0.1', port=9099, path=None):
+        '''Serve internal counters and histograms in the Prometheus text
+        format, from a background thread
+
+        Parameters
+        ----------
+        host : str, optional
+            Address to listen on
+        port : int, optional
+            TCP port to listen on (0 picks a free port)
+        path : str, optional
+            Listen on this Unix domain socket instead of a TCP port
+
+        Returns
+        -------
+        exporter : MetricsExporter
+        '''
+        if self._exporter is not None:
+            raise RuntimeError('Metrics exporter already running')
+
+        from .exporter import MetricsExporter
+        self._exporter = MetricsExporter(self, host=host, port=port,
+                                         path=path)
+        return self._exporter
+
+    def stop_exporter(self):
+        '''Stop the metrics exporter'''
+        if self._exporter is not None:
+            self._exporter.stop()
+            self._exporter = None
+
+    @property
+    def executor(self):
+        '''Worker pool shared by functions created with `executor='server'`
+
+        Created on first use; see :class:`pypvserver.executor.WorkerPool`
+        '''
+        if self._executor is None:
+            from .executor import WorkerPool
+            self._executor = WorkerPool(name='pypvserver-%s' %
+                                        self._prefix.rstrip(':'))
+        return self._executor
+
+    @property
+    def event_loop(self):
+        '''asyncio event loop, run in a background thread, on which coroutine
+        functions are scheduled
+
+        Created on first use
+        '''
+        if self._loop_thread is None:
+            from .executor import EventLoopThread
+            self._loop_thread = EventLoopThread(
+                name='pypvserver-asyncio-%s' % self._prefix.rstrip(':'))
+        return self._loop_thread.loop
+
     def stop(self, wait=True, client_cleanup=True):
+        if self._monitor is not None:
+            self._monitor.stop(wait=wait)
+
+        self.stop_exporter()
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+        if self._loop_thread is not None:
+            self._loop_thread.stop(wait=wait)
+            self._loop_thread = None
+
         if self._running:
             self._running = False
 
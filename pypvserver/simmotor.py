@@ -0,0 +1,446 @@
+# vi: ts=4 sw=4
+'''
+:mod:`pypvserver.simmotor` - Simulated motors
+=============================================
+
+.. module:: pypvserver.simmotor
+   :synopsis: A farm of simulated positioners for :class:`PypvMotor`,
+              advanced together with numpy
+'''
+
+from __future__ import print_function
+
+import threading
+import logging
+from concurrent.futures import Future
+
+import numpy as np
+from pcaspy import cas
+
+from . import stats
+
+
+logger = logging.getLogger(__name__)
+
+
+class SimAxis(object):
+    '''One simulated positioner of a :class:`SimMotorFarm`
+
+    Implements the parts of the ophyd positioner interface used by
+    :class:`PypvMotor`. The state itself is kept in the arrays of the farm.
+
+    Parameters
+    ----------
+    farm : SimMotorFarm
+        The farm the axis belongs to
+    index : int
+        The index of the axis in the farm arrays
+    name : str
+        The positioner name
+    '''
+
+    SUB_READBACK = 'readback'
+    SUB_DONE = 'done'
+    _event_types = (SUB_READBACK, SUB_DONE)
+
+    def __init__(self, farm, index, name):
+        self._farm = farm
+        self._index = index
+        self.name = str(name)
+        self._callbacks = dict((event_type, [])
+                               for event_type in self._event_types)
+        self._status = None
+        self._moved_cb = None
+        self._record = None
+
+    @property
+    def farm(self):
+        '''The farm this axis belongs to'''
+        return self._farm
+
+    @property
+    def index(self):
+        '''The index of this axis in the farm arrays'''
+        return self._index
+
+    @property
+    def position(self):
+        '''The current position'''
+        return float(self._farm.position[self._index])
+
+    @property
+    def target(self):
+        '''The position of the current (or last) move'''
+        return float(self._farm.target[self._index])
+
+    @property
+    def moving(self):
+        '''The axis is moving'''
+        return bool(self._farm.moving[self._index])
+
+    @property
+    def velocity(self):
+        '''Speed, in engineering units per second'''
+        return float(self._farm.velocity[self._index])
+
+    @velocity.setter
+    def velocity(self, velocity):
+        self._farm.velocity[self._index] = abs(float(velocity))
+
+    @property
+    def egu(self):
+        '''Engineering units'''
+        return self._farm.egu
+
+    @property
+    def limits(self):
+        '''(low, high) soft limits'''
+        return (float(self._farm.low_limit[self._index]),
+                float(self._farm.high_limit[self._index]))
+
+    def subscribe(self, callback, event_type=None, run=True):
+        '''Subscribe to readback (the default) or move done events
+
+        Callbacks receive `value`, `obj` and `timestamp` keyword arguments.
+        '''
+        if event_type is None:
+            event_type = self.SUB_READBACK
+
+        if event_type not in self._callbacks:
+            raise ValueError('Unknown event type: %s' % event_type)
+
+        self._callbacks[event_type].append(callback)
+        if run and event_type == self.SUB_READBACK:
+            callback(value=self.position, obj=self, timestamp=stats.clock())
+
+        return callback
+
+    def attach_record(self, record):
+        '''Push readbacks straight into `record` (a :class:`PypvMotor`), in
+        the batch of each farm tick, rather than through a subscription'''
+        self._record = record
+
+    def _post_readback(self, value, timestamp, stamp):
+        '''Post a readback to the attached record and the subscribers'''
+        if self._record is not None:
+            self._record._readback_batch(value, stamp)
+        if self._callbacks[self.SUB_READBACK]:
+            self._run_subs(self.SUB_READBACK, value=value,
+                           timestamp=timestamp)
+
+    def clear_sub(self, callback):
+        '''Remove a subscription'''
+        for callbacks in self._callbacks.values():
+            if callback in callbacks:
+                callbacks.remove(callback)
+
+    def _run_subs(self, event_type, **kwargs):
+        for callback in list(self._callbacks[event_type]):
+            try:
+                callback(obj=self, **kwargs)
+            except Exception as ex:
+                logger.error('%s callback of %s failed: %s', event_type,
+                             self.name, ex, exc_info=ex)
+
+    def move(self, position, wait=False, timeout=None, moved_cb=None):
+        '''Start moving to `position`
+
+        Parameters
+        ----------
+        position : float
+            The target position
+        wait : bool, optional
+            Block until the move completes
+        timeout : float, optional
+            With `wait`, the maximum time to wait
+        moved_cb : callable, optional
+            Called (with `obj`) when the move completes or is stopped
+
+        Returns
+        -------
+        status : concurrent.futures.Future
+            Completes with the final position, and has the `target` of the
+            move as an attribute
+
+        Raises
+        ------
+        ValueError
+            If the position is outside of the limits, or the axis has no
+            velocity to get there
+        '''
+        return self._farm._move(self, float(position), wait=wait,
+                                timeout=timeout, moved_cb=moved_cb)
+
+    def stop(self):
+        '''Stop the axis where it is'''
+        self._farm._stop(np.array([self._index]))
+
+    def set_position(self, position):
+        '''Redefine the current position (without moving)'''
+        self._farm._set_position(self, float(position))
+
+    def __repr__(self):
+        return ('{0}({1.name!r}, position={1.position!r}, '
+                'moving={1.moving})'.format(self.__class__.__name__, self))
+
+
+class SimMotorFarm(object):
+    '''Many simulated positioners, advanced together
+
+    The position, target, velocity and limits of every axis are kept in
+    numpy arrays, and each tick moves all of the axes in one vectorized
+    step. Readbacks are then posted only for the axes which changed, as
+    one batch sharing a single timestamp: straight into the records of
+    attached motors (see `create_motors`), and to subscribers of axes which
+    have any. A farm of thousands of mostly idle motors is cheap to run.
+
+    Parameters
+    ----------
+    names : sequence of str, or int
+        Names of the axes, or the number of axes to create (named
+        `<name_format % index>`)
+    velocity : float or sequence, optional
+        Speed of each axis, in engineering units per second
+    limits : (low, high), optional
+        Soft limits of each axis (equal for no limits)
+    egu : str, optional
+        Engineering units
+    period : float, optional
+        Tick period, in seconds
+    position : float or sequence, optional
+        Initial positions
+    name_format : str, optional
+        Axis name format, used when `names` is a count
+    start : bool, optional
+        Start the tick thread now
+
+    Attributes
+    ----------
+    axes : list of SimAxis
+        The positioners
+    position, target, velocity, low_limit, high_limit : np.ndarray
+        Per-axis state
+    moving : np.ndarray
+        Boolean array of the axes currently moving
+    '''
+
+    def __init__(self, names, velocity=1.0, limits=(0.0, 0.0), egu='mm',
+                 period=0.05, position=0.0, name_format='axis%d',
+                 start=True):
+        if isinstance(names, int):
+            names = [name_format % i for i in range(names)]
+
+        count = len(names)
+        low, high = limits
+
+        self.egu = str(egu)
+        self.period = float(period)
+        self.position = np.zeros(count, dtype=np.float64)
+        self.position[:] = position
+        self.target = self.position.copy()
+        self.velocity = np.zeros(count, dtype=np.float64)
+        self.velocity[:] = np.abs(velocity)
+        self.low_limit = np.full(count, low, dtype=np.float64)
+        self.high_limit = np.full(count, high, dtype=np.float64)
+        self.moving = np.zeros(count, dtype=bool)
+        self.axes = [SimAxis(self, i, name) for i, name in enumerate(names)]
+
+        self._lock = threading.RLock()
+        self._last_tick = None
+        self._thread = None
+        self._running = False
+
+        if start:
+            self.start()
+
+    def __len__(self):
+        return len(self.axes)
+
+    def __getitem__(self, idx):
+        return self.axes[idx]
+
+    def __iter__(self):
+        return iter(self.axes)
+
+    def create_motors(self, name_format='%s', server=None, **kwargs):
+        '''Create a :class:`PypvMotor` record for each axis
+
+        Parameters
+        ----------
+        name_format : str, optional
+            Record name format, given the axis name
+        server : PypvServer, optional
+            Add all of the records to this server at once
+
+        Keyword arguments are passed to :class:`PypvMotor`.
+
+        Returns
+        -------
+        motors : list of PypvMotor
+        '''
+        from .motor import PypvMotor
+
+        motors = [PypvMotor(name_format % axis.name, axis, **kwargs)
+                  for axis in self.axes]
+
+        if server is not None:
+            server.add_pvs(motors)
+
+        return motors
+
+    def _move(self, axis, position, wait=False, timeout=None,
+              moved_cb=None):
+        idx = axis.index
+        low, high = self.low_limit[idx], self.high_limit[idx]
+        if low != high and not (low <= position <= high):
+            raise ValueError('%s: position %g outside of limits (%g, %g)'
+                             '' % (axis.name, position, low, high))
+        if self.velocity[idx] <= 0.0 and position != self.position[idx]:
+            raise ValueError('%s: cannot move with zero velocity' %
+                             axis.name)
+
+        status = Future()
+        status.set_running_or_notify_cancel()
+        status.target = position
+
+        with self._lock:
+            # A new move replaces the one in progress, which completes
+            # without its callback
+            previous = axis._status
+            axis._status, axis._moved_cb = status, moved_cb
+            self.target[idx] = position
+            self.moving[idx] = True
+
+        if previous is not None and not previous.done():
+            previous.set_result(axis.position)
+
+        if wait:
+            status.result(timeout)
+
+        return status
+
+    def _stop(self, indices):
+        '''Stop the axes at `indices` where they are'''
+        with self._lock:
+            indices = indices[self.moving[indices]]
+            self.target[indices] = self.position[indices]
+
+    def stop(self):
+        '''Stop all axes'''
+        self._stop(np.arange(len(self.axes)))
+
+    def _set_position(self, axis, position):
+        idx = axis.index
+        with self._lock:
+            self.position[idx] = position
+            self.target[idx] = position
+
+        axis._post_readback(position, stats.clock(), cas.epicsTimeStamp())
+
+    def _finish(self, axis, status, moved_cb):
+        if moved_cb is not None:
+            try:
+                moved_cb(obj=axis)
+            except Exception as ex:
+                logger.error('Move callback of %s failed: %s', axis.name,
+                             ex, exc_info=ex)
+
+        if not status.done():
+            status.set_result(axis.position)
+
+    def tick(self, dt=None):
+        '''Advance all moving axes by `dt` seconds
+
+        Parameters
+        ----------
+        dt : float, optional
+            Time step, defaulting to the time since the last tick
+
+        Returns
+        -------
+        changed : np.ndarray
+            Indices of the axes which moved or completed their moves
+        '''
+        with self._lock:
+            now = stats.clock()
+            if dt is None:
+                dt = (now - self._last_tick if self._last_tick is not None
+                      else self.period)
+            self._last_tick = now
+
+            moving = np.flatnonzero(self.moving)
+            if not len(moving):
+                return moving
+
+            position = self.position[moving]
+            remaining = self.target[moving] - position
+            max_step = self.velocity[moving] * dt
+            step = np.clip(remaining, -max_step, max_step)
+            arrived = np.abs(remaining) <= max_step
+
+            position += step
+            position[arrived] = self.target[moving][arrived]
+            self.position[moving] = position
+
+            done = moving[arrived]
+            self.moving[done] = False
+            finished = []
+            for idx in done:
+                axis = self.axes[idx]
+                finished.append((axis, axis._status, axis._moved_cb))
+                axis._status = axis._moved_cb = None
+
+        # One timestamp for the records updated by this tick
+        stamp = cas.epicsTimeStamp()
+        axes = self.axes
+        for idx, value in zip(moving.tolist(), position.tolist()):
+            axis = axes[idx]
+            record = axis._record
+            if record is not None:
+                record._readback_batch(value, stamp)
+            if axis._callbacks[SimAxis.SUB_READBACK]:
+                axis._run_subs(SimAxis.SUB_READBACK, value=value,
+                               timestamp=now)
+
+        for axis, status, moved_cb in finished:
+            axis._run_subs(axis.SUB_DONE, value=axis.position,
+                           timestamp=now)
+            if status is not None:
+                self._finish(axis, status, moved_cb)
+
+        return moving
+
+    def _tick_loop(self):
+        clock = stats.clock
+        while self._running:
+            t0 = clock()
+            try:
+                self.tick()
+            except Exception as ex:
+                logger.error('Motor farm tick failed: %s', ex, exc_info=ex)
+
+            elapsed = clock() - t0
+            self._stop_event.wait(max(self.period - elapsed, 0.0))
+
+    def start(self):
+        '''Start ticking in a background thread'''
+        if self._thread is not None:
+            return
+
+        self._running = True
+        self._last_tick = None
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._tick_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self, wait=True):
+        '''Stop the tick thread (axes freeze where they are)'''
+        if self._thread is None:
+            return
+
+        self._running = False
+        self._stop_event.set()
+        if wait:
+            self._thread.join()
+        self._thread = None
@@ -0,0 +1,402 @@
+# vi: ts=4 sw=4
+'''
+:mod:`pypvserver.stats` - Server statistics
+===========================================
+
+.. module:: pypvserver.stats
+   :synopsis: Lightweight counters, histograms and callback timing used to
+              instrument the channel access server
+'''
+
+from __future__ import print_function
+
+import bisect
+import functools
+import itertools
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Monotonic, high resolution where available
+clock = getattr(time, 'perf_counter', time.time)
+
+#: The active :class:`CallbackTimer`, or None when timing is disabled
+timer = None
+
+
+class Histogram(object):
+    '''Latency histogram with fixed, logarithmically-spaced buckets
+
+    Parameters
+    ----------
+    bounds : sequence, optional
+        Upper bound of each bucket, in seconds. Values larger than the last
+        bound are counted in an overflow bucket. Defaults to doubling buckets
+        from 1us to ~16s.
+
+    Attributes
+    ----------
+    buckets : list
+        Count per bucket, with one extra overflow bucket at the end
+    count : int
+        Number of values recorded
+    total : float
+        Sum of all values recorded
+    last : float
+        The most recently recorded value
+    '''
+
+    default_bounds = tuple(1e-6 * 2 ** i for i in range(25))
+
+    def __init__(self, bounds=None):
+        if bounds is None:
+            bounds = self.default_bounds
+
+        self.bounds = tuple(bounds)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''Clear all recorded values'''
+        with self._lock:
+            self.buckets = [0] * (len(self.bounds) + 1)
+            self.count = 0
+            self.total = 0.0
+            self.last = 0.0
+            self.min = float('inf')
+            self.max = 0.0
+
+    def record(self, value):
+        '''Record a single value'''
+        idx = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.buckets[idx] += 1
+            self.count += 1
+            self.total += value
+            self.last = value
+            if value > self.max:
+                self.max = value
+            if value < self.min:
+                self.min = value
+
+    def snapshot(self):
+        '''A consistent copy of (buckets, count, total)'''
+        with self._lock:
+            return list(self.buckets), self.count, self.total
+
+    @property
+    def mean(self):
+        '''Mean of all recorded values'''
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, q):
+        '''Approximate percentile (0-100), as the upper bound of the bucket it
+        falls in'''
+        with self._lock:
+            buckets = list(self.buckets)
+            count = self.count
+            max_ = self.max
+
+        if not count:
+            return 0.0
+
+        threshold = count * q / 100.0
+        seen = 0
+        for bound, num in zip(self.bounds, buckets):
+            seen += num
+            if seen >= threshold:
+                return min(bound, max_)
+
+        return max_
+
+    def __repr__(self):
+        return ('{0}(count={1.count}, mean={1.mean:g}, max={1.max:g})'
+                ''.format(self.__class__.__name__, self))
+
+
+class ServerCounters(object):
+    '''Counters of a single server, incremented in its hot paths
+
+    Each :class:`pypvserver.server.PypvServer` has its own (see its
+    `counters` attribute). Increments come from the channel access, scan and
+    worker threads, so they go through `increment`, which holds a lock.
+    Consumers (e.g., :class:`pypvserver.monitor.ServerMonitor`) compute rates
+    from the difference between snapshots.
+
+    Attributes
+    ----------
+    search_hits : int
+        Name searches answered with "exists here"
+    search_misses : int
+        Name searches for PVs not on this server
+    events : int
+        Monitor events posted to clients
+    writes : int
+        Channel access writes
+    scan_overruns : int
+        Scans which took longer than their scan period
+    async_pending : int
+        Asynchronous writes currently in progress
+    loop_period : Histogram
+        Duration of each process-loop iteration, including the wait for
+        events (up to the loop timeout, when idle)
+    scan_jitter : Histogram
+        Deviation of the time between periodic scans from the scan period
+    '''
+
+    __slots__ = ('search_hits', 'search_misses', 'events', 'writes',
+                 'scan_overruns', 'async_pending', 'loop_period',
+                 'scan_jitter', '_lock')
+
+    _counts = ('search_hits', 'search_misses', 'events', 'writes',
+               'scan_overruns', 'async_pending')
+
+    def __init__(self):
+        self.loop_period = Histogram()
+        self.scan_jitter = Histogram()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def increment(self, attr, count=1):
+        '''Add `count` (which may be negative) to a counter'''
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + count)
+
+    def reset(self):
+        '''Zero all counters'''
+        with self._lock:
+            for attr in self._counts:
+                setattr(self, attr, 0)
+
+        self.loop_period.reset()
+        self.scan_jitter.reset()
+
+    def snapshot(self):
+        '''Current counts, as a dictionary'''
+        with self._lock:
+            return dict((attr, getattr(self, attr)) for attr in self._counts)
+
+
+class FunctionStats(object):
+    '''Execution statistics of a single function (see
+    :class:`pypvserver.function.PypvFunction`)
+
+    Attributes
+    ----------
+    calls : int
+        Calls completed
+    errors : int
+        Calls which failed (including those aborted)
+    in_flight : int
+        Calls started but not yet completed
+    exec_time : Histogram
+        Time spent running each call
+    queue_wait : Histogram
+        Time each call waited for a worker before starting
+    '''
+
+    __slots__ = ('calls', 'errors', 'in_flight', 'exec_time', 'queue_wait',
+                 '_lock')
+
+    def __init__(self):
+        self.exec_time = Histogram()
+        self.queue_wait = Histogram()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''Zero all counters'''
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.exec_time.reset()
+        self.queue_wait.reset()
+
+    def started(self):
+        '''A call was started (or queued)'''
+        with self._lock:
+            self.in_flight += 1
+
+    def finished(self, exec_time, queue_wait=0.0, failed=False):
+        '''A call completed'''
+        with self._lock:
+            self.in_flight -= 1
+            self.calls += 1
+            if failed:
+                self.errors += 1
+
+        self.exec_time.record(exec_time)
+        self.queue_wait.record(queue_wait)
+
+    def __repr__(self):
+        return ('{0}(calls={1.calls}, errors={1.errors}, '
+                'in_flight={1.in_flight}, exec_time={1.exec_time!r})'
+                ''.format(self.__class__.__name__, self))
+
+
+class CallbackTimer(object):
+    '''Times server callbacks, keeping a histogram per (PV name, callback type)
+
+    Callbacks such as `written_cb` and `getValue` run on the channel access
+    process thread, so a slow one stalls the whole server. Callbacks which
+    exceed `budget` are logged and counted in `slow_counts`.
+
+    Parameters
+    ----------
+    budget : float, optional
+        Time budget per callback, in seconds
+    watchdog : bool, optional
+        Start a thread which reports callbacks that are still running past
+        their budget, while they are still stalling the server
+
+    Attributes
+    ----------
+    histograms : dict
+        (name, kind) to :class:`Histogram`
+    slow_counts : dict
+        (name, kind) to the number of callbacks which exceeded the budget
+    '''
+
+    def __init__(self, budget=0.1, watchdog=True):
+        self.budget = float(budget)
+        self.histograms = {}
+        self.slow_counts = {}
+
+        self._running = {}
+        self._tokens = itertools.count()
+        self._lock = threading.Lock()
+        self._watchdog = None
+        self._watching = False
+
+        if watchdog:
+            self.start_watchdog()
+
+    def start(self, name, kind):
+        '''Mark the start of a callback, returning a token for `stop`'''
+        token = next(self._tokens)
+        self._running[token] = [name, kind, clock(), False]
+        return token
+
+    def stop(self, token):
+        '''Mark the end of a callback, returning its duration'''
+        t1 = clock()
+        name, kind, t0, reported = self._running.pop(token)
+        elapsed = t1 - t0
+        key = (name, kind)
+
+        try:
+            hist = self.histograms[key]
+        except KeyError:
+            hist = self.histograms.setdefault(key, Histogram())
+
+        hist.record(elapsed)
+
+        if elapsed > self.budget:
+            with self._lock:
+                self.slow_counts[key] = self.slow_counts.get(key, 0) + 1
+
+            logger.warning('Slow %s callback for %s: %.3fs (budget %.3fs)%s',
+                           kind, name, elapsed, self.budget,
+                           ' [reported by watchdog]' if reported else '')
+
+        return elapsed
+
+    @property
+    def slow_total(self):
+        '''Total number of callbacks which exceeded the budget'''
+        return sum(self.slow_counts.values())
+
+    def running(self):
+        '''Callbacks currently running: list of (name, kind, elapsed)'''
+        now = clock()
+        return [(name, kind, now - t0)
+                for name, kind, t0, reported in list(self._running.values())]
+
+    def start_watchdog(self):
+        '''Start the watchdog thread'''
+        if self._watchdog is not None:
+            return
+
+        self._watching = True
+        self._watchdog = threading.Thread(target=self._watchdog_loop)
+        self._watchdog.daemon = True
+        self._watchdog.start()
+
+    def stop_watchdog(self, wait=True):
+        '''Stop the watchdog thread'''
+        self._watching = False
+        if self._watchdog is not None and wait:
+            self._watchdog.join()
+        self._watchdog = None
+
+    def _watchdog_loop(self):
+        period = min(max(self.budget / 2.0, 0.01), 1.0)
+        while self._watching:
+            time.sleep(period)
+
+            now = clock()
+            for entry in list(self._running.values()):
+                name, kind, t0, reported = entry
+                if not reported and now - t0 > self.budget:
+                    entry[3] = True
+                    logger.warning('%s callback for %s still running after '
+                                   '%.3fs (budget %.3fs)', kind, name,
+                                   now - t0, self.budget)
+
+
+def enable_timing(budget=0.1, watchdog=True):
+    '''Enable callback timing for all PVs
+
+    Parameters
+    ----------
+    budget : float, optional
+        Time budget per callback, in seconds
+    watchdog : bool, optional
+        Report callbacks still running past their budget
+
+    Returns
+    -------
+    timer : CallbackTimer
+    '''
+    global timer
+
+    disable_timing()
+    timer = CallbackTimer(budget=budget, watchdog=watchdog)
+    return timer
+
+
+def disable_timing():
+    '''Disable callback timing'''
+    global timer
+
+    if timer is not None:
+        timer.stop_watchdog(wait=False)
+    timer = None
+
+
+def timed(kind):
+    '''Method decorator: time calls with the active :class:`CallbackTimer`
+
+    Calls are recorded against the PV name. When timing is disabled, the
+    only overhead is a single global lookup.
+    '''
+    def wrapper(fcn):
+        @functools.wraps(fcn)
+        def wrapped(self, *args, **kwargs):
+            timer_ = timer
+            if timer_ is None:
+                return fcn(self, *args, **kwargs)
+
+            token = timer_.start(self._name, kind)
+            try:
+                return fcn(self, *args, **kwargs)
+            finally:
+                timer_.stop(token)
+
+        return wrapped
+    return wrapper
@@ -19,7 +19,8 @@ setup(name='pypvserver',
       url="https://github.com/klauer/pypvserver",
       packages=['pypvserver'],
       # package_data={'pypvserver': ['files/*']},
-      install_requires=['numpy', 'pcaspy>=0.6.0'],
+      install_requires=['numpy', 'pcaspy>=0.6.0',
+                        'futures; python_version < "3"'],
       classifiers=[
           "Development Status :: 3 - Alpha",
           "Programming Language :: Python :: 2.7",
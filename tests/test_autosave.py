@@ -0,0 +1,141 @@
+from __future__ import print_function
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from pypvserver import (PypvServer, PyPV, PypvRecord)
+from pypvserver.autosave import (Autosave, NAME_SIZE)
+
+
+logger = logging.getLogger(__name__)
+
+
+class AutosaveTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, 'test.sav')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _make_pvs(self, float_=0.0, str_='', enum=0, arr=None, egu=''):
+        if arr is None:
+            arr = np.zeros(5)
+
+        pvs = [PyPV('autosave_float', float_),
+               PyPV('autosave_str', str_),
+               PyPV('autosave_enum', ['a', 'b', 'c']),
+               PyPV('autosave_arr', arr)]
+        pvs[2].value = enum
+
+        record = PypvRecord('autosave_rec', float_)
+        record.add_field('EGU', egu)
+        return pvs, record
+
+    def test_roundtrip(self):
+        autosave = Autosave(self.filename)
+        pvs, record = self._make_pvs(1.5, 'test', 1, np.arange(5.0), 'mm')
+        for pv in pvs:
+            autosave.add(pv)
+        autosave.add(record, fields=['VAL', 'EGU'])
+
+        self.assertEquals(autosave.save(), 6)
+        # nothing changed since the last save
+        self.assertEquals(autosave.save(), 0)
+
+        pvs[0].value = 2.5
+        pvs[3][1:3] = 7
+        self.assertEquals(autosave.save(), 2)
+        autosave.close()
+
+        restore = Autosave(self.filename)
+        pvs, record = self._make_pvs()
+        self.assertEquals(sorted(restore.restore(record)),
+                          ['autosave_rec', 'autosave_rec.EGU'])
+        for pv in pvs:
+            restore.add(pv)
+
+        self.assertEquals(pvs[0].value, 2.5)
+        self.assertEquals(pvs[1].value, 'test')
+        self.assertEquals(pvs[2].value, 1)
+        assert_array_equal(pvs[3].value, [0, 7, 7, 3, 4])
+        self.assertEquals(record.value, 1.5)
+        self.assertEquals(record['EGU'].value, 'mm')
+        restore.close()
+
+    def test_server_restore(self):
+        server = PypvServer.default_instance
+        if server is None:
+            server = PypvServer('')
+
+        def make_record(value, egu):
+            record = PypvRecord('autosave_served', value, server=server)
+            record.add_field('EGU', egu)
+            return record
+
+        autosave = Autosave(self.filename, server=server)
+        try:
+            record = make_record(1.5, 'mm')
+            autosave.add(record, fields=['VAL', 'EGU'])
+            self.assertEquals(autosave.save(), 2)
+            autosave.close()
+            server.remove_pv(record)
+
+            # restored as the record, then the later field, are served
+            autosave = Autosave(self.filename, server=server)
+            record = make_record(0.0, '')
+            self.assertEquals(record.value, 1.5)
+            self.assertEquals(record['EGU'].value, 'mm')
+            server.remove_pv(record)
+        finally:
+            autosave.close()
+            server.autosave = None
+
+    def test_unchanged_values(self):
+        autosave = Autosave(self.filename)
+        pv = PyPV('autosave_unchanged', 1.0)
+        autosave.add(pv)
+        self.assertEquals(autosave.save(), 1)
+
+        # an update to the same value leaves nothing to save
+        pv.value = 1.0
+        self.assertEquals(autosave.save(), 0)
+        pv.value = 2.0
+        self.assertEquals(autosave.save(), 1)
+
+        long_pv = PyPV('autosave_' + 'x' * NAME_SIZE, 1.0)
+        self.assertRaises(ValueError, autosave.add, long_pv)
+        self.assertNotIn(long_pv.name, autosave.pvs)
+        autosave.close()
+
+    def test_value_set_later(self):
+        autosave = Autosave(self.filename)
+        pv = PyPV('autosave_later', None, type_=float)
+        autosave.add(pv)
+        self.assertEquals(autosave.save(), 0)
+
+        pv.value = 3.5
+        self.assertEquals(autosave.save(), 1)
+        autosave.close()
+
+        restore = Autosave(self.filename)
+        pv = PyPV('autosave_later', 0.0)
+        restore.add(pv)
+        self.assertEquals(pv.value, 3.5)
+        restore.close()
+
+    def test_bad_file(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'not an autosave file')
+
+        autosave = Autosave(self.filename)
+        pv = PyPV('autosave_bad', 1.0)
+        autosave.add(pv)
+        self.assertEquals(pv.value, 1.0)
+        autosave.close()
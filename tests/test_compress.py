@@ -0,0 +1,73 @@
+from __future__ import print_function
+
+import logging
+import unittest
+
+from numpy.testing import assert_array_equal
+
+from pypvserver.pv import PyPV
+from pypvserver.compress import PypvCompress
+
+
+logger = logging.getLogger(__name__)
+
+
+class CompressTests(unittest.TestCase):
+    def test_subscribe(self):
+        pv = PyPV('compress_sub', 0.0)
+        updates = []
+        callback = pv.subscribe(lambda value=None, **kwargs:
+                                updates.append(value))
+        pv.value = 1.0
+        pv.clear_sub(callback)
+        pv.value = 2.0
+        self.assertEquals(updates, [1.0])
+
+    def test_algorithms(self):
+        source = PyPV('compress_source', 0.0)
+        records = dict((alg, PypvCompress('compress_%s' % alg, source,
+                                          algorithm=alg, n=4, size=3))
+                       for alg in PypvCompress.algorithms)
+
+        for value in (3, 1, 4, 1, 5, 9, 2, 6):
+            source.value = float(value)
+
+        assert_array_equal(records['mean'].value, [2.25, 5.5, 0])
+        assert_array_equal(records['min'].value, [1, 2, 0])
+        assert_array_equal(records['max'].value, [4, 9, 0])
+        assert_array_equal(records['median'].value, [2, 5.5, 0])
+        self.assertEquals(records['mean']['NUSE'].value, 2)
+
+        # the circular buffer keeps the last `size` values, oldest first
+        assert_array_equal(records['circular'].value, [9, 2, 6])
+        self.assertEquals(records['circular']['NUSE'].value, 3)
+
+        records['mean'].reset()
+        self.assertEquals(records['mean']['NUSE'].value, 0)
+        records['mean'].detach()
+        source.value = 1.0
+        self.assertEquals(records['mean']._in_group, 0)
+
+        self.assertRaises(ValueError, PypvCompress, 'compress_bad',
+                          algorithm='mode')
+
+    def test_posted_outputs(self):
+        record = PypvCompress('compress_posted', algorithm='circular', size=2)
+        posted = []
+        record.subscribe(lambda value=None, **kwargs:
+                         posted.append(list(value)))
+
+        record.process_value(1.0)
+        record.process_value(1.0)
+        # NUSE and VAL are posted together
+        self.assertIs(record['NUSE']._timestamp, record._timestamp)
+
+        # VAL is posted for every output, even if unchanged
+        record.process_value(1.0)
+        self.assertEquals(posted, [[1.0, 0.0], [1.0, 1.0], [1.0, 1.0]])
+
+        self.assertEquals(record.update_fields({'VAL': [1.0, 1.0],
+                                                'NUSE': 2}), [])
+        self.assertEquals(record.update_fields({'VAL': [1.0, 1.0],
+                                                'NUSE': 2}, force=['NUSE']),
+                          ['NUSE'])
@@ -0,0 +1,193 @@
+from __future__ import print_function
+
+import logging
+import threading
+import time
+import unittest
+
+from concurrent.futures import (CancelledError, TimeoutError)
+
+import numpy as np
+
+from pypvserver.executor import (WorkerPool, ProcessPool, DeadlineScheduler,
+                                 register_function)
+from pypvserver.errors import QueueFullError
+
+
+logger = logging.getLogger(__name__)
+
+
+def sleep(duration):
+    time.sleep(duration)
+    return duration
+
+
+def ramp(count=10, scale=1.0):
+    if count < 0:
+        raise ValueError('Negative count')
+    return np.arange(count) * scale
+
+
+register_function(ramp)
+register_function(sleep)
+
+
+class WorkerPoolTests(unittest.TestCase):
+    def test_submit(self):
+        pool = WorkerPool(max_workers=2, ca_context=False)
+        futures = [pool.submit(pow, i, 2) for i in range(10)]
+        self.assertEquals([future.result(timeout=1.0) for future in futures],
+                          [i ** 2 for i in range(10)])
+        self.assertTrue(pool.workers <= 2)
+
+        future = pool.submit(int, 'abc')
+        self.assertRaises(ValueError, future.result, timeout=1.0)
+        pool.shutdown()
+        self.assertEquals(pool.workers, 0)
+
+    def test_queue_full(self):
+        release = threading.Event()
+        depths = []
+
+        pool = WorkerPool(max_workers=1, max_queue=2, ca_context=False)
+        pool.add_listener(lambda pool: depths.append((pool.queued,
+                                                      pool.busy)))
+
+        futures = [pool.submit(release.wait)]
+        while not pool.busy:
+            release.wait(0.01)
+
+        futures.extend(pool.submit(release.wait) for i in range(2))
+        self.assertEquals(pool.queued, 2)
+        self.assertRaises(QueueFullError, pool.submit, release.wait)
+
+        release.set()
+        for future in futures:
+            self.assertTrue(future.result(timeout=1.0))
+
+        pool.shutdown()
+        self.assertIn((2, 1), depths)
+        self.assertEquals(depths[-1], (0, 0))
+
+    def test_block(self):
+        release = threading.Event()
+        pool = WorkerPool(max_workers=1, max_queue=1, block=True,
+                          ca_context=False)
+        pool.submit(release.wait)
+        while not pool.busy:
+            release.wait(0.01)
+
+        pool.submit(release.wait)
+
+        # the third call blocks until the first completes
+        submitted = []
+        thread = threading.Thread(
+            target=lambda: submitted.append(pool.submit(release.wait)))
+        thread.start()
+        thread.join(0.1)
+        self.assertEquals(submitted, [])
+
+        # callers which cannot block are rejected instead
+        self.assertRaises(QueueFullError, pool.submit_nowait, release.wait)
+
+        release.set()
+        thread.join(1.0)
+        self.assertTrue(submitted[0].result(timeout=1.0))
+        pool.shutdown()
+
+    def test_cancel(self):
+        release = threading.Event()
+        pool = WorkerPool(max_workers=1, ca_context=False)
+        hung = pool.submit(release.wait)
+        queued = pool.submit(pow, 2, 2)
+        while not pool.busy:
+            release.wait(0.01)
+
+        self.assertTrue(pool.cancel(queued))
+        self.assertTrue(queued.cancelled())
+        self.assertEquals(pool.queued, 0)
+
+        # the hung worker is abandoned and replaced
+        self.assertTrue(pool.cancel(hung))
+        self.assertRaises(CancelledError, hung.result, 0)
+        self.assertEquals(pool.busy, 0)
+        self.assertEquals(pool.submit(pow, 3, 2).result(1.0), 9)
+
+        release.set()
+        pool.shutdown()
+
+    def test_abandoned_limit(self):
+        release = threading.Event()
+        pool = WorkerPool(max_workers=1, max_abandoned=1, ca_context=False)
+
+        def cancel_hung():
+            hung = pool.submit(release.wait)
+            while not pool.busy:
+                release.wait(0.01)
+            pool.cancel(hung)
+
+        # the first hung worker is replaced
+        cancel_hung()
+        self.assertTrue(pool.degraded)
+        self.assertEquals(pool.submit(pow, 3, 2).result(1.0), 9)
+
+        # the second is not: its call blocks the pool until it returns
+        cancel_hung()
+        self.assertEquals(pool.abandoned, 2)
+        self.assertEquals(pool.workers, 0)
+        queued = pool.submit(pow, 2, 2)
+        self.assertRaises(TimeoutError, queued.result, 0.1)
+
+        release.set()
+        self.assertEquals(queued.result(1.0), 4)
+        while pool.abandoned:
+            time.sleep(0.01)
+        self.assertFalse(pool.degraded)
+        pool.shutdown()
+
+
+class DeadlineSchedulerTests(unittest.TestCase):
+    def test_call_later(self):
+        scheduler = DeadlineScheduler()
+        called = []
+        scheduler.call_later(0.1, lambda: called.append(2))
+        scheduler.call_later(0.05, lambda: called.append(1))
+        scheduler.cancel(scheduler.call_later(0.01,
+                                              lambda: called.append(0)))
+        time.sleep(0.2)
+        self.assertEquals(called, [1, 2])
+
+
+class ProcessPoolTests(unittest.TestCase):
+    def test_submit(self):
+        pool = ProcessPool(max_workers=2, shm_threshold=1024)
+        try:
+            # small results come back through the pipe, large ones through
+            # shared memory
+            for count in (10, 100000):
+                result = pool.submit(ramp, count, scale=2.0).result(5.0)
+                self.assertEquals(result.shape, (count, ))
+                self.assertEquals(result[-1], 2.0 * (count - 1))
+
+            future = pool.submit(ramp, -1)
+            self.assertRaises(ValueError, future.result, 5.0)
+            self.assertRaises(ValueError, pool.submit, len, 'abc')
+        finally:
+            pool.shutdown()
+
+        self.assertEquals(pool.workers, 0)
+
+    def test_cancel(self):
+        pool = ProcessPool(max_workers=1)
+        try:
+            future = pool.submit(sleep, 10.0)
+            while not pool.busy:
+                time.sleep(0.01)
+
+            # the worker process is terminated, and replaced for the next
+            # call
+            self.assertTrue(pool.cancel(future))
+            self.assertRaises(CancelledError, future.result, 0)
+            self.assertEquals(pool.submit(sleep, 0.0).result(5.0), 0.0)
+        finally:
+            pool.shutdown()
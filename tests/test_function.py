@@ -0,0 +1,414 @@
+from __future__ import print_function
+
+import logging
+import sys
+import threading
+import time
+import unittest
+import warnings
+
+import epics
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from pypvserver import PypvServer
+from pypvserver import executor
+from pypvserver.errors import (QueueFullError, RequestIdError)
+from pypvserver.function import PypvFunction
+
+
+server = None
+logger = logging.getLogger(__name__)
+
+
+def setUpModule():
+    global server
+
+    server = PypvServer.default_instance
+    if server is None:
+        server = PypvServer('')
+
+
+def add(a=0, b=0.0):
+    return a + b
+
+
+def ramp(scale=1.0):
+    return np.arange(100000) * scale
+
+
+class FunctionTests(unittest.TestCase):
+    def test_submit(self):
+        fcn = PypvFunction(prefix='fcn_test_submit:', server=server)(add)
+        self.assertEquals(fcn.submit(a=1, b=2.5).result(1.0), 3.5)
+        self.assertEquals(fcn.get_pv('retval').value, 3.5)
+
+        fcn.get_pv('a').value = 2
+        self.assertEquals(fcn.submit().result(1.0), 2.0)
+
+    def test_sync(self):
+        fcn = PypvFunction(prefix='fcn_test_sync:', server=server,
+                           async_=False)(add)
+        fcn.get_pv('b').value = 1.5
+        self.assertEquals(fcn(), 1.5)
+
+    def test_stats_pvs(self):
+        def slow(value=0.0):
+            time.sleep(0.01)
+            if value < 0:
+                raise ValueError('Negative value')
+            return value
+
+        fcn = PypvFunction(prefix='fcn_test_stats:', server=server,
+                           stats_pvs=True, stats_period=0.5,
+                           failed_cb=lambda **kwargs: None)(slow)
+        posted = []
+        fcn.get_pv('mean_time').subscribe(
+            lambda value=None, **kwargs: posted.append(value))
+
+        for i in range(10):
+            fcn.submit(value=float(i)).result(1.0)
+        fcn.submit(value=-1.0).result(1.0)
+
+        # counts are posted as calls complete
+        self.assertEquals(fcn.get_pv('call_count').value, 11)
+        self.assertEquals(fcn.get_pv('error_count').value, 1)
+        self.assertEquals(fcn.get_pv('in_flight').value, 0)
+
+        # times only on the scan
+        t0 = time.time()
+        while fcn.get_pv('mean_time').value != fcn.stats.exec_time.mean:
+            self.assertLess(time.time() - t0, 2.0)
+            time.sleep(0.05)
+
+        self.assertLessEqual(len(posted), 2)
+        self.assertGreaterEqual(fcn.get_pv('p99_time').value, 0.01)
+        self.assertEquals(fcn.get_pv('last_time').value,
+                          fcn.stats.exec_time.last)
+
+    def test_deprecated_async(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            wrapper = PypvFunction(prefix='fcn_test_deprecated:',
+                                   server=server, **{'async': False})
+
+        self.assertFalse(wrapper._async)
+        self.assertEquals([w.category for w in caught], [DeprecationWarning])
+
+    def test_arguments(self):
+        wrapper = PypvFunction(prefix='fcn_test_args:', server=server)
+
+        def positional(a, b=1):
+            pass
+
+        self.assertRaises(ValueError, wrapper, positional)
+
+    def test_cache(self):
+        calls = []
+
+        def double(value=1.0):
+            calls.append(value)
+            return value * 2
+
+        fcn = PypvFunction(prefix='fcn_test_cache:', server=server,
+                           cache_size=2)(double)
+        hits, misses = fcn.get_pv('cache_hits'), fcn.get_pv('cache_misses')
+
+        # miss: through the Process PV, which looks the call up once
+        fcn.get_pv('process').process(wait=True, timeout=1.0)
+        self.assertEquals(calls, [1.0])
+        self.assertEquals((hits.value, misses.value), (0, 1))
+
+        # hit: answered without calling the function
+        fcn.get_pv('process').process(wait=True, timeout=1.0)
+        self.assertEquals(fcn.submit().result(1.0), 2.0)
+        self.assertEquals(calls, [1.0])
+        self.assertEquals((hits.value, misses.value), (2, 1))
+
+        self.assertEquals(fcn.submit(value=3.0).result(1.0), 6.0)
+        self.assertEquals((hits.value, misses.value), (2, 2))
+
+        # invalidation
+        fcn.clear_cache()
+        self.assertEquals(fcn.submit().result(1.0), 2.0)
+        self.assertEquals(calls, [1.0, 3.0, 1.0])
+        self.assertEquals((hits.value, misses.value), (2, 3))
+
+    def test_cache_ttl(self):
+        calls = []
+
+        def double(value=1.0):
+            calls.append(value)
+            return value * 2
+
+        fcn = PypvFunction(prefix='fcn_test_cache_ttl:', server=server,
+                           cache_size=2, cache_ttl=0.1)(double)
+        self.assertEquals(fcn.submit().result(1.0), 2.0)
+        self.assertEquals(fcn.submit().result(1.0), 2.0)
+        self.assertEquals(len(calls), 1)
+
+        time.sleep(0.2)
+        self.assertEquals(fcn.submit().result(1.0), 2.0)
+        self.assertEquals(len(calls), 2)
+
+    def _overlapping_puts(self, prefix, **kwargs):
+        calls = []
+
+        def slow(value=1.0):
+            calls.append(value)
+            time.sleep(0.3)
+            return value
+
+        fcn = PypvFunction(prefix=prefix, server=server, **kwargs)(slow)
+        pvname = fcn.get_pvnames()['process']
+        clients = [epics.PV(pvname), epics.PV(pvname)]
+        for pvc in clients:
+            self.assertTrue(pvc.wait_for_connection(timeout=2.0))
+
+        completed = []
+
+        def put_done(**kwargs):
+            completed.append(time.time())
+
+        def wait_completed(count):
+            t1 = time.time() + 2.0
+            while len(completed) < count and time.time() < t1:
+                time.sleep(0.01)
+
+        t0 = time.time()
+        clients[0].put(1, use_complete=True, callback=put_done)
+        time.sleep(0.05)
+        # overlaps the first put, with the same parameters
+        clients[1].put(1, use_complete=True, callback=put_done)
+        wait_completed(2)
+        self.assertEquals(len(completed), 2)
+
+        # a new put after both completed runs the function again
+        clients[0].put(1, use_complete=True, callback=put_done)
+        wait_completed(3)
+        self.assertEquals(len(completed), 3)
+        return calls, max(completed[:2]) - t0
+
+    def test_joined_puts(self):
+        # the overlapping put joins the first call
+        calls, elapsed = self._overlapping_puts('fcn_test_join:',
+                                                coalesce=True)
+        self.assertEquals(calls, [1.0, 1.0])
+        self.assertLess(elapsed, 0.5)
+
+        # without coalescing, it waits for, then makes, its own call
+        calls, elapsed = self._overlapping_puts('fcn_test_nojoin:')
+        self.assertEquals(calls, [1.0, 1.0, 1.0])
+        self.assertGreater(elapsed, 0.5)
+
+    def test_generator(self):
+        def count(n=3):
+            for i in range(n):
+                time.sleep(0.01)
+                yield float(i)
+
+        fcn = PypvFunction(prefix='fcn_test_generator:', server=server)(count)
+        posted = []
+        fcn.get_pv('retval').subscribe(
+            lambda value=None, **kwargs: posted.append(value))
+
+        self.assertEquals(fcn.submit(n=5).result(1.0), 4.0)
+        # every value is posted as it is yielded, the last one only once
+        self.assertEquals(posted, [0.0, 1.0, 2.0, 3.0, 4.0])
+
+        del posted[:]
+        fcn.get_pv('n').value = 2
+        fcn.get_pv('process').process(wait=True, timeout=1.0)
+        self.assertEquals(posted, [0.0, 1.0])
+        self.assertEquals(fcn.get_pv('retval').value, 1.0)
+
+    def test_batch(self):
+        fcn = PypvFunction(prefix='fcn_test_batch:', server=server,
+                           batch_size=10)(add)
+
+        # the count defaults to the shortest input given; other inputs come
+        # from the Batch:<param> waveforms
+        fcn.get_pv('batch:a').value = np.ones(10)
+        results = fcn.batch(b=np.arange(4.0)).result(1.0)
+        assert_array_equal(results, [1.0, 2.0, 3.0, 4.0])
+        assert_array_equal(fcn.get_pv('batch_retval').value[:4], results)
+
+        results = fcn.batch(a=[1, 2, 3], b=np.arange(4.0)).result(1.0)
+        assert_array_equal(results, [1.0, 3.0, 5.0])
+
+        self.assertRaises(ValueError, fcn.batch, b=np.arange(11.0))
+        self.assertRaises(ValueError, fcn.batch, count=0)
+
+    def test_batch_vectorized(self):
+        calls = []
+
+        def scale(value=0.0, factor=2.0):
+            calls.append(value)
+            return value * factor
+
+        fcn = PypvFunction(prefix='fcn_test_batch_vec:', server=server,
+                           batch_size=10, vectorized=True)(scale)
+        results = fcn.batch(value=np.arange(5.0)).result(1.0)
+        assert_array_equal(results, np.arange(5.0) * 2)
+        # a single call for the whole batch
+        self.assertEquals(len(calls), 1)
+
+    def test_batch_pvs(self):
+        fcn = PypvFunction(prefix='fcn_test_batch_pvs:', server=server,
+                           batch_size=10)(add)
+        pvnames = fcn.get_pvnames()
+
+        epics.caput(pvnames['batch:b'], np.arange(10.0), wait=True)
+        epics.caput(pvnames['batch_count'], 3, wait=True)
+        # completes once the results are posted
+        epics.caput(pvnames['batch_process'], 1, wait=True, timeout=2.0)
+
+        results = epics.caget(pvnames['batch_retval'], use_monitor=False)
+        assert_array_equal(results[:3], [0.0, 1.0, 2.0])
+        assert_array_equal(results[3:], np.zeros(7))
+
+    def test_request_pvs(self):
+        def slow(value=1.0):
+            time.sleep(0.2)
+            return value * 2
+
+        fcn = PypvFunction(prefix='fcn_test_request:', server=server,
+                           max_requests=2)(slow)
+        pvnames = fcn.get_pvnames()
+
+        epics.caput(pvnames['value'], 4.0, wait=True)
+        epics.caput(pvnames['call'], 7, wait=True)
+        epics.caput(pvnames['req_id'], 7, wait=True)
+        self.assertEquals(epics.caget(pvnames['req_status'],
+                                      use_monitor=False), 'Pending')
+
+        self.assertEquals(fcn.get_result(7, timeout=1.0), 8.0)
+        time.sleep(0.05)
+        self.assertEquals(epics.caget(pvnames['req_status'],
+                                      use_monitor=False), 'Done')
+        self.assertEquals(epics.caget(pvnames['req_val'],
+                                      use_monitor=False), 8.0)
+
+        epics.caput(pvnames['req_id'], 8, wait=True)
+        self.assertEquals(epics.caget(pvnames['req_status'],
+                                      use_monitor=False), 'Unknown')
+
+    def test_request_race(self):
+        def slow(value=1.0):
+            time.sleep(0.2)
+            return value
+
+        fcn = PypvFunction(prefix='fcn_test_request_race:', server=server,
+                           max_requests=2)(slow)
+
+        start = threading.Event()
+        outcomes = []
+
+        def request(req_id):
+            start.wait()
+            try:
+                fcn.request(req_id, value=float(req_id))
+            except (RequestIdError, QueueFullError) as ex:
+                outcomes.append(ex.__class__)
+            else:
+                outcomes.append(None)
+
+        # the same request ID from several threads at once
+        threads = [threading.Thread(target=request, args=(1, ))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(outcomes.count(None), 1)
+        self.assertEquals(outcomes.count(RequestIdError), 7)
+        self.assertEquals(fcn.get_result(1, timeout=1.0), 1.0)
+
+        # distinct IDs: no more than max_requests in progress
+        start.clear()
+        del outcomes[:]
+        threads = [threading.Thread(target=request, args=(i, ))
+                   for i in range(2, 10)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(outcomes.count(None), 2)
+        self.assertEquals(outcomes.count(QueueFullError), 6)
+
+    def test_process(self):
+        fcn = PypvFunction(prefix='fcn_test_process:', server=server,
+                           executor='process', type_=np.float64,
+                           count=100000)(ramp)
+
+        unpacked = []
+        unpack_result = executor._unpack_result
+
+        def recording_unpack(kind, result):
+            unpacked.append(kind)
+            return unpack_result(kind, result)
+
+        executor._unpack_result = recording_unpack
+        try:
+            result = fcn.submit(scale=2.0).result(5.0)
+        finally:
+            executor._unpack_result = unpack_result
+            fcn.wrapper.executor.shutdown()
+
+        assert_array_equal(result, np.arange(100000) * 2.0)
+        assert_array_equal(fcn.get_pv('retval').value, result)
+        if executor.shared_memory is not None:
+            # 800kB of results are returned through shared memory
+            self.assertEquals(unpacked, ['shm'])
+
+    @unittest.skipIf(sys.version_info < (3, 5), 'Requires async def')
+    def test_coroutine(self):
+        namespace = {}
+        exec('async def scale(value=1.0, factor=2.0):\n'
+             '    import asyncio\n'
+             '    await asyncio.sleep(0.01)\n'
+             '    return value * factor\n', namespace)
+
+        fcn = PypvFunction(prefix='fcn_test_coroutine:',
+                           server=server)(namespace['scale'])
+        self.assertEquals(fcn.submit(value=3.0).result(1.0), 6.0)
+        self.assertEquals(fcn.get_pv('retval').value, 6.0)
+
+    @unittest.skipIf(sys.version_info < (3, 5), 'Requires async def')
+    def test_sync_rejected(self):
+        namespace = {}
+        exec('async def scale(value=1.0):\n'
+             '    return value\n', namespace)
+
+        # would block the server thread on every put
+        wrapper = PypvFunction(prefix='fcn_test_sync_coroutine:',
+                               server=server, async_=False)
+        self.assertRaises(ValueError, wrapper, namespace['scale'])
+
+        wrapper = PypvFunction(prefix='fcn_test_sync_process:',
+                               server=server, executor='process',
+                               use_process=False)
+        self.assertRaises(ValueError, wrapper, ramp)
+
+    @unittest.skipIf(sys.version_info < (3, 6), 'Requires async generators')
+    def test_async_generator(self):
+        namespace = {}
+        exec('async def count(n=3):\n'
+             '    for i in range(n):\n'
+             '        yield float(i)\n', namespace)
+
+        fcn = PypvFunction(prefix='fcn_test_async_gen:',
+                           server=server)(namespace['count'])
+        self.assertEquals(fcn.submit(n=4).result(1.0), 3.0)
+        self.assertEquals(fcn.get_pv('retval').value, 3.0)
+
+
+if __name__ == '__main__':
+    fmt = '%(asctime)-15s [%(levelname)s] %(message)s'
+    logging.basicConfig(format=fmt, level=logging.DEBUG)
+
+    unittest.main()
@@ -0,0 +1,81 @@
+from __future__ import print_function
+
+import logging
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from pypvserver import PypvServer
+from pypvserver.pv import PyPV
+from pypvserver.history import History
+
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryTests(unittest.TestCase):
+    def test_ring_buffer(self):
+        history = History(4)
+        for i in range(6):
+            history.append(float(i), i * 10.0, severity=i % 3)
+
+        self.assertEquals(len(history), 4)
+        times, values, severities = history.last()
+        assert_array_equal(times, [2, 3, 4, 5])
+        assert_array_equal(values, [20, 30, 40, 50])
+        assert_array_equal(severities, [2, 0, 1, 2])
+
+        assert_array_equal(history.last(2)[1], [40, 50])
+        assert_array_equal(history.range(3, 5)[0], [3, 4])
+        assert_array_equal(history.range(start=4.5)[1], [50])
+
+        times, values, severities = history.decimate(2)
+        assert_array_equal(times, [3, 5])
+        assert_array_equal(values, [25, 45])
+        assert_array_equal(severities, [2, 2])
+
+        history.clear()
+        self.assertEquals(len(history.last()[0]), 0)
+
+    def test_pv_history(self):
+        pv = PyPV('history_pv', 0.0, history=100, history_waveforms=3)
+        for value in (1.0, 2.0, 3.0, 4.0):
+            pv.value = value
+
+        times, values, severities = pv.history.last()
+        assert_array_equal(values, [0.0, 1.0, 2.0, 3.0, 4.0])
+        self.assertTrue(np.all(np.diff(times) >= 0.0))
+
+        time_pv, value_pv, severity_pv, count_pv = pv.history_pvs
+        self.assertEquals(value_pv.name, 'history_pv:HistVal')
+        value_pv.refresh()
+        count_pv.refresh()
+        assert_array_equal(value_pv.value, [2.0, 3.0, 4.0])
+        self.assertEquals(count_pv.value, 3)
+
+        string_pv = PyPV('history_str', 'abc')
+        self.assertRaises(ValueError, string_pv.enable_history, 10)
+
+    def test_server_history_pvs(self):
+        server = PypvServer.default_instance
+        if server is None:
+            server = PypvServer('')
+
+        pv = PyPV('history_added', 0.0, history=10, history_waveforms=3)
+        server.add_pv(pv)
+        for suffix in ('HistTime', 'HistVal', 'HistSevr', 'HistN'):
+            self.assertIn('history_added:%s' % suffix, server)
+        self.assertIs(server.get_pv('history_added:HistVal'),
+                      pv.history_pvs[1])
+
+        server.remove_pv('history_added')
+        self.assertNotIn('history_added', server)
+        self.assertNotIn('history_added:HistVal', server)
+        self.assertIs(pv.history_pvs[1]._server, None)
+
+        # and in one batch
+        server.add_pvs([pv])
+        self.assertIn('history_added:HistN', server)
+        server.remove_pv(pv)
+        self.assertNotIn('history_added:HistN', server)
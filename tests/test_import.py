@@ -0,0 +1,66 @@
+from __future__ import print_function
+
+import logging
+import os
+import subprocess
+import sys
+import unittest
+
+
+logger = logging.getLogger(__name__)
+
+HEAVY_MODULES = ('pcaspy', 'numpy', 'epics')
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(statement):
+    '''Run `statement` in a fresh interpreter with `-X importtime`
+
+    Returns
+    -------
+    times : dict
+        Module name to cumulative import time, in seconds
+    '''
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c',
+                             statement],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            cwd=REPO_ROOT)
+    _, stderr = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(stderr.decode('utf-8', 'replace'))
+
+    times = {}
+    for line in stderr.decode('utf-8').splitlines():
+        if not line.startswith('import time:'):
+            continue
+
+        fields = line[len('import time:'):].split('|')
+        try:
+            cumulative_us = int(fields[1])
+        except (IndexError, ValueError):
+            # header line
+            continue
+
+        times[fields[2].strip()] = cumulative_us * 1e-6
+
+    return times
+
+
+@unittest.skipIf(sys.version_info < (3, 7), '-X importtime requires 3.7+')
+class ImportTests(unittest.TestCase):
+    def test_light_import(self):
+        for statement in ('import pypvserver',
+                          'import pypvserver.utils',
+                          'from pypvserver.utils import record_field'):
+            times = import_times(statement)
+            logger.info('%s: %.1f ms', statement,
+                        times['pypvserver'] * 1e3)
+
+            for module in HEAVY_MODULES:
+                self.assertNotIn(module, times,
+                                 '%r imported %s' % (statement, module))
+
+    def test_pv_import(self):
+        times = import_times('from pypvserver import PyPV')
+        self.assertIn('pcaspy', times)
+        self.assertNotIn('epics', times)
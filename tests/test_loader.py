@@ -0,0 +1,143 @@
+from __future__ import print_function
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import warnings
+
+from pypvserver.loader import (substitute, parse, parse_db, build_records,
+                               load_database)
+
+
+logger = logging.getLogger(__name__)
+
+DATABASE = '''
+# A comment
+record(ai, "$(P)temp") {
+    field(DESC, "Temperature")
+    field(EGU, "degC")
+    field(PREC, "3")
+    field(VAL, "1.5")
+    field(HIHI, "10")
+    field(CUST, "12")
+    info(autosave, "VAL")
+}
+
+record(bo, "$(P)onoff") {
+    field(ZNAM, "Off")
+    field(ONAM, "On")
+    field(OSV, "MAJOR")
+    field(VAL, "1")
+}
+
+record(mbbi, "$(P)mode") {
+    field(ZRST, "A")
+    field(ONST, "B")
+}
+
+record(waveform, "$(P)wf") {
+    field(FTVL, "FLOAT")
+    field(NELM, "10")
+}
+
+record(stringin, "${P}str") {
+    field(VAL, "$(STR=default)")
+}
+'''
+
+
+class LoaderTests(unittest.TestCase):
+    def test_substitute(self):
+        self.assertEquals(substitute('$(A)${B}$(C=c)', dict(A='a', B='b')),
+                          'abc')
+        self.assertRaises(ValueError, substitute, '$(A)', {})
+
+    def test_parse_db(self):
+        records = parse_db(substitute(DATABASE, dict(P='TEST:')))
+        self.assertEquals([(rec['type'], rec['name']) for rec in records],
+                          [('ai', 'TEST:temp'), ('bo', 'TEST:onoff'),
+                           ('mbbi', 'TEST:mode'), ('waveform', 'TEST:wf'),
+                           ('stringin', 'TEST:str')])
+        self.assertEquals(records[0]['fields']['EGU'], 'degC')
+        self.assertEquals(records[4]['fields']['VAL'], 'default')
+
+        self.assertRaises(ValueError, parse_db, 'record(ai, "a"')
+        self.assertRaises(ValueError, parse_db, 'path "x"')
+
+    def test_build(self):
+        temp, onoff, mode, wf, str_ = build_records(
+            parse(DATABASE, macros=dict(P='TEST:', STR='abc')))
+
+        self.assertEquals(temp.value, 1.5)
+        self.assertEquals(temp['DESC'].value, 'Temperature')
+        self.assertEquals(temp['RTYP'].value, 'ai')
+        self.assertEquals(temp['CUST'].value, 12)
+        self.assertEquals(temp.limits.hihi, 10.0)
+        self.assertEquals(temp._units, 'degC')
+        self.assertEquals(temp._precision, 3)
+
+        self.assertEquals(onoff._enums, ['Off', 'On'])
+        self.assertEquals(onoff.value, 1)
+        self.assertEquals(onoff.major_states, ['On'])
+        self.assertEquals(mode._enums, ['A', 'B'])
+
+        self.assertEquals(wf.count, 10)
+        self.assertEquals(wf.value.dtype.name, 'float32')
+        self.assertEquals(str_.value, 'abc')
+
+    def test_load_json(self):
+        path = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(path, 'test.json')
+            with open(filename, 'w') as f:
+                json.dump({'records': [{'type': 'longout',
+                                        'name': '$(P)pv%d' % i,
+                                        'fields': {'VAL': i}}
+                                       for i in range(100)]}, f)
+
+            records = load_database(filename, macros=dict(P='JSON:'))
+        finally:
+            shutil.rmtree(path)
+
+        self.assertEquals(len(records), 100)
+        self.assertEquals(records[-1].name, 'JSON:pv99')
+        self.assertEquals(records[-1].value, 99)
+
+    def test_build_time(self):
+        records = [{'type': 'ai', 'name': 'BULK:ai%d' % i,
+                    'fields': {'DESC': 'Input', 'EGU': 'mm', 'PREC': '3',
+                               'VAL': '1.5', 'HIHI': '10'}}
+                   for i in range(20000)]
+
+        t0 = time.time()
+        built = build_records(records)
+        elapsed = time.time() - t0
+
+        # 100k records should take a couple of seconds; allow for a slow
+        # machine
+        self.assertLess(elapsed, 1.0)
+
+        # the field PVs are only created when used
+        record = built[-1]
+        self.assertEquals(sorted(record._fields), ['VAL'])
+        self.assertEquals(record['DESC'].value, 'Input')
+        self.assertEquals(record['DESC'].name, 'BULK:ai19999.DESC')
+        self.assertEquals(sorted(record.fields), ['DESC', 'RTYP', 'VAL'])
+
+    def test_scan_thread(self):
+        record, = build_records([{'type': 'ai', 'name': 'SCAN:ai',
+                                  'fields': {'SCAN': '.5 second'}}])
+        try:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                thread = record.thread
+
+            self.assertTrue(thread.is_alive())
+            self.assertEquals([w.category for w in caught],
+                              [DeprecationWarning])
+        finally:
+            record.stop()
@@ -1,6 +1,8 @@
 from __future__ import print_function
 
+import ctypes
 import logging
+import threading
 import unittest
 import time
 
@@ -11,6 +13,7 @@ import epics
 
 from pypvserver import (PypvServer, PyPV, PypvRecord, Limits, AsyncCompletion)
 from pypvserver.alarms import alarms
+from pypvserver.compress import PypvCompress
 from pypvserver.utils import record_field
 
 
@@ -26,7 +29,9 @@ def setUpModule():
 
 
 def tearDownModule():
-    epics.ca.destroy_context()
+    # pyepics clears its cached channels at exit, which crashes once the
+    # context is destroyed; finalize_libca clears them now instead
+    epics.ca.finalize_libca()
 
     logger.debug('Cleaning up')
     server.cleanup()
@@ -50,6 +55,24 @@ def client_pv(pvname):
     return pvc
 
 
+def put_status(pvc, values, timeout=2.0):
+    '''Put with completion, returning the status the server replied with
+
+    (pyepics drops the status of completed puts)
+    '''
+    status = []
+    callback = epics.dbr.make_callback(lambda args: status.append(args.status),
+                                       epics.dbr.event_handler_args)
+    data = (ctypes.c_double * len(values))(*values)
+    epics.ca.libca.ca_array_put_callback(epics.dbr.DOUBLE, len(values),
+                                         pvc.chid, data, callback, None)
+    epics.ca.flush_io()
+    t0 = time.time()
+    while not status and time.time() - t0 < timeout:
+        epics.ca.poll()
+    return status[0] if status else None
+
+
 def get_pvname():
     server._pv_idx += 1
     return 'cas_test_pv_%d' % server._pv_idx
@@ -139,6 +162,60 @@ class CASTests(unittest.TestCase):
 
         caget(pvc)
 
+    def test_process_wait(self):
+        def written_to_async(**kwargs):
+            timer = threading.Timer(0.1, pvs.async_done)
+            timer.start()
+            raise AsyncCompletion()
+
+        pvs = PyPV(get_pvname(), 1.0, server=server,
+                   written_cb=written_to_async)
+
+        t0 = time.time()
+        self.assertEquals(pvs.process(wait=True), 1.0)
+        self.assertGreaterEqual(time.time() - t0, 0.09)
+        self.assertTrue(pvs.wait_async(timeout=0))
+
+        self.assertEquals(pvs.process(wait=False), 1.0)
+        self.assertFalse(pvs.wait_async(timeout=0))
+        self.assertTrue(pvs.wait_async(timeout=1.0))
+
+    def test_sync_during_async(self):
+        calls = []
+
+        def written_to(**kwargs):
+            calls.append(kwargs['value'])
+            if len(calls) == 1:
+                raise AsyncCompletion()
+
+        pvs = PyPV(get_pvname(), 1.0, server=server, written_cb=written_to)
+        self.assertEquals(pvs.process(wait=False), 1.0)
+
+        # a synchronous write must not complete the outstanding async one
+        pvs.process()
+        self.assertFalse(pvs.wait_async(timeout=0))
+
+        pvs.async_done()
+        self.assertTrue(pvs.wait_async(timeout=0))
+        self.assertEquals(len(calls), 2)
+
+    def test_put_callback(self):
+        def written_to_async(**kwargs):
+            timer = threading.Timer(0.2, pvs.async_done)
+            timer.start()
+            raise AsyncCompletion()
+
+        pv_name = get_pvname()
+        pvs = PyPV(pv_name, 1.0, server=server,
+                   written_cb=written_to_async)
+        pvc = client_pv(pv_name)
+
+        t0 = time.time()
+        pvc.put(2.0, wait=True, timeout=2.0)
+        self.assertGreaterEqual(time.time() - t0, 0.15)
+        # the client may be notified before async_done returns
+        self.assertTrue(pvs.wait_async(timeout=1.0))
+
     def test_numpy(self):
         pv_name = get_pvname()
         arr = np.arange(10)
@@ -182,6 +259,60 @@ class CASTests(unittest.TestCase):
         assert_array_equal(caget(record_pvc), caget(field_pvc))
         self.assertEquals(caget(egu_pvc), 'testing')
 
+    def test_read_only_put(self):
+        pv_name = get_pvname()
+        record = PypvCompress(pv_name, algorithm='circular', size=2,
+                              server=server)
+        record.process_value(1.0)
+        pvc = client_pv(pv_name)
+
+        # ECA_PUTFAIL
+        self.assertEquals(put_status(pvc, [5.0, 5.0]), 160)
+        assert_array_equal(caget(pvc), [1.0, 0.0])
+        assert_array_equal(record.value, [1.0, 0.0])
+
+    def test_monitor(self):
+        monitor = server.start_monitor(prefix='cas_test_monitor:',
+                                       period=0.05)
+        try:
+            self.assertIs(server.monitor, monitor)
+            pvc = client_pv('cas_test_monitor:PVCount')
+            time.sleep(0.2)
+            self.assertEquals(caget(pvc), len(server._pvs))
+
+            pv_names = [get_pvname() for i in range(20)]
+            for pv_name in pv_names:
+                PyPV(pv_name, 0, server=server)
+            time.sleep(0.2)
+            self.assertEquals(caget(pvc), len(server._pvs))
+
+            # Rates are per update period, so sample them while busy; each
+            # new client channel needs a search
+            pvc = client_pv(pv_names.pop())
+            writes = client_pv('cas_test_monitor:WriteRate')
+            hits = client_pv('cas_test_monitor:SearchHitRate')
+            write_rate = hit_rate = 0.0
+            t0 = time.time()
+            while time.time() - t0 < 2.0:
+                pvc.put(1, wait=True)
+                if pv_names:
+                    client_pv(pv_names.pop())
+                write_rate = max(write_rate, caget(writes))
+                hit_rate = max(hit_rate, caget(hits))
+                if write_rate > 0 and hit_rate > 0:
+                    break
+
+            self.assertGreater(write_rate, 0.0)
+            self.assertGreater(hit_rate, 0.0)
+
+            period = caget(client_pv('cas_test_monitor:LoopPeriod'))
+            self.assertGreater(period, 0.0)
+            self.assertLess(period, 0.2)
+        finally:
+            server.stop_monitor()
+
+        self.assertNotIn('cas_test_monitor:PVCount', server)
+
 
 if __name__ == '__main__':
     fmt = '%(asctime)-15s [%(levelname)s] %(message)s'
@@ -0,0 +1,276 @@
+from __future__ import print_function
+
+import logging
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from pypvserver.simmotor import SimMotorFarm
+from pypvserver.motor import PseudoMotorGroup
+
+
+logger = logging.getLogger(__name__)
+
+
+class SimMotorFarmTests(unittest.TestCase):
+    def setUp(self):
+        self.farm = SimMotorFarm(10, velocity=1.0, limits=(-10, 10),
+                                 start=False)
+
+    def test_tick(self):
+        farm = self.farm
+        readbacks = []
+        farm[0].subscribe(lambda value=None, **kwargs:
+                          readbacks.append(value), run=False)
+
+        status = farm[0].move(1.5)
+        farm[1].move(-0.5)
+        self.assertEquals(status.target, 1.5)
+
+        assert_array_equal(farm.tick(1.0), [0, 1])
+        self.assertEquals(farm[0].position, 1.0)
+        self.assertEquals(farm[1].position, -0.5)
+        self.assertFalse(farm[1].moving)
+        self.assertFalse(status.done())
+
+        farm.tick(1.0)
+        self.assertEquals(status.result(0), 1.5)
+        self.assertEquals(readbacks, [1.0, 1.5])
+
+        # idle axes are skipped entirely
+        self.assertEquals(len(farm.tick(1.0)), 0)
+        self.assertEquals(readbacks, [1.0, 1.5])
+
+    def test_stop_and_limits(self):
+        farm = self.farm
+        moved = []
+        status = farm[2].move(5.0, moved_cb=lambda obj=None:
+                              moved.append(obj.name))
+        farm.tick(1.0)
+        farm[2].stop()
+        farm.tick(1.0)
+        self.assertEquals(status.result(0), 1.0)
+        self.assertEquals(moved, ['axis2'])
+
+        self.assertRaises(ValueError, farm[2].move, 20.0)
+
+        # a stopped axis could never arrive
+        farm[3].velocity = 0.0
+        self.assertRaises(ValueError, farm[3].move, 1.0)
+        self.assertFalse(farm[3].moving)
+        status = farm[3].move(0.0)
+        farm.tick(1.0)
+        self.assertEquals(status.result(0), 0.0)
+
+        farm[2].set_position(3.0)
+        self.assertEquals(farm[2].position, 3.0)
+        self.assertFalse(farm[2].moving)
+
+    def test_motor(self):
+        motor, = SimMotorFarm(['x'], start=False).create_motors('sim:%s')
+        self.assertEquals(motor['EGU'].value, 'mm')
+        farm = motor._pos.farm
+
+        status = motor.move(2.0)
+        farm.tick(1.0)
+        self.assertEquals(motor['RBV'].value, 1.0)
+        farm.tick(1.0)
+        self.assertEquals(motor['RBV'].value, 2.0)
+        self.assertEquals(motor['MOVN'].value, 0)
+        self.assertEquals(status.result(0), 2.0)
+        self.assertEquals(motor.value, 2.0)
+
+    def test_batched_readbacks(self):
+        farm = SimMotorFarm(['x', 'y'], start=False)
+        motors = farm.create_motors('sim:%s')
+        # readbacks go straight to the records, not through subscriptions
+        self.assertEquals(farm[0]._callbacks[farm[0].SUB_READBACK], [])
+
+        for motor in motors:
+            motor.move(2.0)
+        farm.tick(1.0)
+        self.assertEquals([motor['RBV'].value for motor in motors],
+                          [1.0, 1.0])
+        # posted as one batch, with one timestamp
+        self.assertIs(motors[0]['RBV']._timestamp,
+                      motors[1]['RBV']._timestamp)
+
+    def test_move_status(self):
+        motor, = SimMotorFarm(['x'], limits=(-5, 5),
+                              start=False).create_motors('sim:%s')
+        farm = motor._pos.farm
+        done = []
+
+        status = motor.tweak(1.0)
+        status.add_done_callback(lambda status: done.append(status.target))
+        failed = motor.tweak(10.0)
+        self.assertTrue(failed.done())
+        self.assertIsInstance(failed.exception(0), ValueError)
+        self.assertEquals(motor.value, 1.0)
+        farm.tick(1.0)
+        self.assertEquals(status.wait(0), 1.0)
+        self.assertEquals(done, [1.0])
+
+        # a new move completes the one it replaces
+        first = motor.move(3.0)
+        second = motor.move(-1.0)
+        self.assertTrue(first.done())
+        farm.tick(0.5)
+        motor.stop()
+        farm.tick(0.5)
+        self.assertTrue(second.stopped)
+        self.assertEquals(second.result(0), 0.5)
+
+        status = motor.set_position(4.0)
+        self.assertEquals(status.result(0), 4.0)
+        self.assertEquals(motor['RBV'].value, 4.0)
+        self.assertEquals(motor['DMOV'].value, True)
+
+    def test_rbv_throttle(self):
+        motor, = SimMotorFarm(['x'], start=False).create_motors(
+            'sim:%s', rbv_deadband=0.5)
+        farm = motor._pos.farm
+        farm[0].velocity = 0.2
+
+        motor.move(0.8)
+        farm.tick(1.0)
+        farm.tick(1.0)
+        self.assertEquals(motor['RBV'].value, 0.0)
+        farm.tick(1.0)
+        self.assertAlmostEqual(motor['RBV'].value, 0.6)
+
+        # the end point is posted on completion, within the deadband
+        farm.tick(1.0)
+        self.assertEquals(motor['RBV'].value, 0.8)
+        self.assertEquals(motor['DMOV'].value, 1)
+
+    def test_atomic_status(self):
+        motor, = SimMotorFarm(['x'], start=False).create_motors('sim:%s')
+        self.assertEquals(motor._update_status(moving=0), [])
+
+        changed = motor._update_status(moving=1)
+        self.assertEquals(sorted(changed), ['DMOV', 'MOVN', 'MSTA'])
+        self.assertIs(motor['MOVN']._timestamp, motor['DMOV']._timestamp)
+        self.assertIs(motor['MSTA']._timestamp, motor['DMOV']._timestamp)
+
+        self.assertEquals(motor.update_fields({'TWV': 1.0, 'DESC': 'a'}),
+                          ['DESC'])
+
+
+def _sum_diff(positions):
+    return np.array([positions[0] + positions[1],
+                     positions[0] - positions[1]])
+
+
+def _inverse_sum_diff(positions):
+    return np.array([positions[0] + positions[1],
+                     positions[0] - positions[1]]) / 2.0
+
+
+class PseudoMotorTests(unittest.TestCase):
+    def setUp(self):
+        self.farm = SimMotorFarm(['a', 'b'], velocity=1.0, limits=(-5, 5),
+                                 start=False)
+        self.motors = self.farm.create_motors('real:%s')
+        self.group = PseudoMotorGroup('pseudo', self.motors,
+                                      ['pseudo:sum', 'pseudo:diff'],
+                                      _sum_diff, _inverse_sum_diff)
+
+    def test_group_move(self):
+        group, farm = self.group, self.farm
+        assert_array_equal(group.forward([[1, 2], [3, 4]]),
+                           [[4, 6], [-2, -2]])
+
+        status = group.move([2.0, 1.0])
+        assert_array_equal(farm.target, [1.5, 0.5])
+        self.assertEquals(group.record['DMOV'].value, False)
+
+        farm.tick(1.0)
+        self.assertFalse(status.done())
+        farm.tick(1.0)
+        assert_array_equal(status.result(0), [2.0, 1.0])
+        assert_array_equal(group.record['RBV'].value, [2.0, 1.0])
+        self.assertEquals(group.axes[1]['RBV'].value, 1.0)
+        self.assertEquals(group.axes[1]['DMOV'].value, True)
+
+    def test_back_to_back_moves(self):
+        group, farm = self.group, self.farm
+        first = group.move([2.0, 1.0])
+        farm.tick(0.5)
+
+        # the real moves it replaces completing must not end the group move
+        second = group.move([3.0, 1.0])
+        self.assertFalse(second.done())
+        self.assertTrue(group.moving)
+        self.assertEquals(group.record['DMOV'].value, False)
+
+        farm.tick(0.5)
+        self.assertFalse(second.done())
+        farm.tick(1.0)
+        assert_array_equal(second.result(0), [3.0, 1.0])
+        assert_array_equal(first.result(0), [3.0, 1.0])
+        self.assertEquals(group.record['DMOV'].value, True)
+
+    def test_replaced_real_move(self):
+        group, farm = self.group, self.farm
+        status = group.move([3.0, 1.0])
+        farm.tick(0.5)
+
+        # a put to a real motor replaces its part of the group move, which
+        # fails once the other real motor is done
+        self.motors[0].move(0.0)
+        self.assertFalse(status.done())
+        self.assertEquals(group.record['DMOV'].value, False)
+
+        farm.tick(0.5)
+        self.assertRaises(RuntimeError, status.result, 0)
+        self.assertEquals(group.record['DMOV'].value, True)
+
+        status = group.move([1.0, 1.0])
+        group.stop()
+        farm.tick(1.0)
+        self.assertRaises(RuntimeError, status.result, 0)
+
+        # the next move is unaffected
+        status = group.move([2.0, 0.0])
+        farm.tick(2.0)
+        assert_array_equal(status.result(0), [2.0, 0.0])
+
+    def test_axis_move(self):
+        group, farm = self.group, self.farm
+        status = group.axes[0].move(4.0)
+        farm.tick(2.0)
+        assert_array_equal(status.result(0), [4.0, 0.0])
+        assert_array_equal(farm.position, [2.0, 2.0])
+
+        self.assertRaises(ValueError, group.move, [20.0, 0.0])
+        self.assertEquals(group.record['LVIO'].value, 1)
+
+
+class TrajectoryTests(unittest.TestCase):
+    def test_trajectory(self):
+        farm = SimMotorFarm(['x'], velocity=1.0, limits=(-10, 10),
+                            period=0.005)
+        try:
+            motor, = farm.create_motors('traj:%s', trajectory_size=10,
+                                        capture_chunk=2)
+            times = np.linspace(0.05, 0.2, 4)
+            positions = np.array([0.5, 1.0, 1.5, 2.0])
+            status = motor.run_trajectory(times, positions)
+            self.assertRaises(RuntimeError, motor.run_trajectory, times,
+                              positions)
+
+            captured = status.result(2.0)
+            self.assertEquals(len(captured), 4)
+            np.testing.assert_allclose(captured, positions, atol=0.1)
+            self.assertEquals(motor['TCNT'].value, 4)
+            self.assertEquals(motor['TNPT'].value, 4)
+            self.assertEquals(motor['DMOV'].value, True)
+            # the segment velocities are restored afterward
+            self.assertEquals(farm[0].velocity, 1.0)
+
+            self.assertRaises(ValueError, motor.run_trajectory, times,
+                              positions * 10)
+        finally:
+            farm.shutdown()
@@ -0,0 +1,180 @@
+from __future__ import print_function
+
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import time
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+from pypvserver import stats
+
+
+logger = logging.getLogger(__name__)
+
+
+class _FakePV(object):
+    _name = 'fake'
+
+    @stats.timed('write')
+    def write(self, delay):
+        time.sleep(delay)
+        return delay
+
+
+class _FakeServer(object):
+    prefix = 'fake:'
+
+    def __init__(self):
+        self.counters = stats.ServerCounters()
+        self._pvs = {}
+
+
+class StatsTests(unittest.TestCase):
+    def tearDown(self):
+        stats.disable_timing()
+
+    def test_histogram(self):
+        hist = stats.Histogram()
+        for value in (1e-6, 1e-5, 1e-4, 1e-3):
+            hist.record(value)
+
+        self.assertEquals(hist.count, 4)
+        self.assertEquals(hist.last, 1e-3)
+        self.assertEquals(hist.max, 1e-3)
+        self.assertAlmostEqual(hist.mean, sum((1e-6, 1e-5, 1e-4, 1e-3)) / 4)
+        self.assertLessEqual(hist.percentile(50), 1.28e-4)
+        self.assertEquals(hist.percentile(100), 1e-3)
+
+        hist.reset()
+        self.assertEquals(hist.count, 0)
+        self.assertEquals(hist.percentile(99), 0.0)
+
+    def test_function_stats(self):
+        fcn_stats = stats.FunctionStats()
+        fcn_stats.started()
+        fcn_stats.started()
+        self.assertEquals(fcn_stats.in_flight, 2)
+
+        fcn_stats.finished(0.5, queue_wait=0.25)
+        fcn_stats.finished(1.5, failed=True)
+        self.assertEquals((fcn_stats.calls, fcn_stats.errors,
+                           fcn_stats.in_flight), (2, 1, 0))
+        self.assertEquals(fcn_stats.exec_time.last, 1.5)
+        self.assertEquals(fcn_stats.exec_time.mean, 1.0)
+        self.assertEquals(fcn_stats.queue_wait.mean, 0.125)
+
+        fcn_stats.reset()
+        self.assertEquals(fcn_stats.calls, 0)
+        self.assertEquals(fcn_stats.exec_time.count, 0)
+
+    def test_server_counters(self):
+        counters = stats.ServerCounters()
+
+        def count():
+            for i in range(10000):
+                counters.increment('events')
+
+        threads = [threading.Thread(target=count) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        counters.increment('async_pending')
+        counters.increment('async_pending', -1)
+        self.assertEquals(counters.snapshot()['events'], 40000)
+        self.assertEquals(counters.async_pending, 0)
+        self.assertEquals(stats.ServerCounters().events, 0)
+
+    def test_disabled(self):
+        self.assertIs(stats.timer, None)
+        self.assertEquals(_FakePV().write(0), 0)
+
+    def test_slow_callback(self):
+        timer = stats.enable_timing(budget=0.01, watchdog=True)
+        pv = _FakePV()
+        pv.write(0.0)
+        pv.write(0.05)
+
+        key = ('fake', 'write')
+        self.assertEquals(timer.histograms[key].count, 2)
+        self.assertEquals(timer.slow_counts[key], 1)
+        self.assertEquals(timer.slow_total, 1)
+        self.assertEquals(timer.running(), [])
+
+    def test_format_metrics(self):
+        from pypvserver.exporter import format_metrics
+
+        timer = stats.enable_timing(watchdog=False)
+        timer.stop(timer.start('fake"pv', 'write'))
+
+        text = format_metrics(counters=stats.ServerCounters())
+        self.assertIn('# TYPE pypvserver_searches_total counter', text)
+        self.assertIn('pypvserver_process_loop_seconds_count', text)
+        self.assertIn('pypvserver_callback_seconds_bucket{kind="write",'
+                      'le="+Inf",pv="fake\\"pv"} 1', text)
+
+    def test_exporter_tcp(self):
+        from pypvserver.exporter import MetricsExporter
+
+        server = _FakeServer()
+        server.counters.writes = 3
+        exporter = MetricsExporter(server, port=0)
+        try:
+            host, port = exporter.address[:2]
+            response = urlopen('http://%s:%d/metrics' % (host, port),
+                               timeout=5.0)
+            text = response.read().decode('utf-8')
+        finally:
+            exporter.stop()
+
+        self.assertIn('pypvserver_writes_total 3', text)
+        self.assertIn('pypvserver_pvs{prefix="fake:"} 0', text)
+
+    def test_exporter_unix(self):
+        from pypvserver.exporter import MetricsExporter
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'metrics.sock')
+
+            # a stale socket is replaced, other files are left alone
+            stale = socket.socket(socket.AF_UNIX)
+            stale.bind(path)
+            stale.close()
+
+            exporter = MetricsExporter(_FakeServer(), path=path)
+            try:
+                client = socket.socket(socket.AF_UNIX)
+                client.settimeout(5.0)
+                client.connect(path)
+                client.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+                response = b''
+                while True:
+                    data = client.recv(4096)
+                    if not data:
+                        break
+                    response += data
+                client.close()
+            finally:
+                exporter.stop()
+
+            self.assertFalse(os.path.exists(path))
+            self.assertIn(b' 200 ', response.split(b'\r\n')[0])
+            self.assertIn(b'pypvserver_searches_total', response)
+
+            with open(path, 'w') as f:
+                f.write('data')
+            self.assertRaises(ValueError, MetricsExporter, _FakeServer(),
+                              path=path)
+            self.assertTrue(os.path.exists(path))
+        finally:
+            shutil.rmtree(tmpdir)